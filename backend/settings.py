@@ -50,6 +50,7 @@ REST_FRAMEWORK = {
 }
     
 MIDDLEWARE = [
+    'main.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -134,3 +135,108 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# State inference
+# `aggregation` runs the innferStates pipeline in MongoDB, `compiled` evaluates
+# the compiled State rules in process. Can be overridden per request with ?engine=
+
+INFERENCE_STATE_ENGINE = 'compiled'
+
+# `aggregation` runs innferBehaviors in MongoDB, `bitset` matches state bitmasks in process
+INFERENCE_BEHAVIOR_ENGINE = 'bitset'
+
+# Seconds a worker trusts its cached State/Behavior catalog before re-reading the version document
+CATALOG_VERSION_CHECK_INTERVAL = 1.0
+
+INFERENCE_BATCH_SIZE = 1000
+
+# Students per unordered bulk_write when storing inferred states/behaviors
+INFERENCE_WRITEBACK_CHUNK_SIZE = 1000
+
+# Re-infer only the affected students/states/behaviors after feature and rule writes
+INFERENCE_INCREMENTAL = True
+# Rule edits reaching more students than this are re-inferred by a background job, answered with 202
+INFERENCE_INCREMENTAL_MAX_STUDENTS = 10000
+
+
+# Student list pagination (?after=<cursor>&limit=) and streaming (?stream=json|ndjson)
+
+PAGE_SIZE = 100
+
+MAX_PAGE_SIZE = 1000
+
+STREAM_BATCH_SIZE = 500
+
+
+# Records per validation query and bulk_write in /api/students/features/bulk/
+INGEST_CHUNK_SIZE = 1000
+
+
+# Cache of single-student inference results, keyed by student and catalog versions.
+# BACKEND is 'local' (per process LRU), 'django' (the CACHES entry named by ALIAS) or None.
+
+INFERENCE_CACHE = {
+    'BACKEND': 'local',
+    'MAX_ENTRIES': 10000,
+    'TTL': 300,
+}
+
+
+# Background full-population inference jobs (/api/infer/jobs/): worker threads per
+# process and students per `_id` range processed between progress updates
+
+INFERENCE_JOB_WORKERS = 2
+
+INFERENCE_PARTITION_SIZE = 5000
+
+# Pending or running jobs without progress for this many seconds are marked failed when
+# jobs are read, as their worker process is gone. Running jobs report after every range,
+# pending ones have to wait for a free worker: keep it above the longest queue wait
+INFERENCE_JOB_STALE_AFTER = 900
+
+# Concurrent `_id` range partitions for ?parallel=1 on /api/infer/states/ and /api/infer/behaviors/
+INFERENCE_PARALLEL_WORKERS = 4
+
+
+# Database used by the seed and benchmark management commands
+BENCHMARK_DATABASE = 'vibes_bench'
+
+# Database the engine equivalence tests in main/tests.py seed and clear; they are skipped without a server
+TEST_DATABASE = 'vibes_test'
+
+
+# Requests slower than this many milliseconds are logged as warnings by
+# main.middleware.ServerTimingMiddleware. Keys are URL routes, e.g. 'api/students/'.
+SLOW_REQUEST_THRESHOLDS = {
+    'default': 1000,
+    'api/students/': 300,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'main.timing': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
+
+# /api/metrics serves Prometheus metrics. With several worker processes, set the
+# PROMETHEUS_MULTIPROC_DIR environment variable to an empty directory shared by them.
+
+
+# How student features are stored: 'list' (Student.features) or 'map' (Student.featureMap,
+# keyed by feature id). Convert existing students with `manage.py featurelayout`.
+STUDENT_FEATURE_LAYOUT = 'list'
+
+
+# Age in seconds after which the in-memory feature matrix of the 'snapshot' state
+# engine is rebuilt. Writes made through this process are applied to it immediately.
+INFERENCE_SNAPSHOT_TTL = 60
+
+# Most equal width bins a /api/features/<id>/distribution/?bins= histogram may ask for
+DISTRIBUTION_MAX_BINS = 200
@@ -0,0 +1,98 @@
+import math
+
+from .models import Feature
+
+# BSON integers are at most 8 bytes
+INT64_MAX = 2 ** 63 - 1
+
+TRUE = {'true', 't', 'yes', 'y', '1'}
+FALSE = {'false', 'f', 'no', 'n', '0'}
+
+
+def toNumber(value):
+    if isinstance(value, bool):
+        raise ValueError(f'Expected a number, got {value}.')
+    if isinstance(value, str):
+        text = value.strip()
+        try:
+            value = int(text)
+        except ValueError:
+            try:
+                value = float(text)
+            except ValueError:
+                raise ValueError(f'Expected a number, got "{value}".')
+    if not isinstance(value, (int, float)) or (isinstance(value, float) and not math.isfinite(value)):
+        raise ValueError(f'Expected a number, got {value!r}.')
+
+    # Integral floats are stored as integers so equal values share one index key form,
+    # as long as they fit in an int64. Larger integers are kept as floats
+    if isinstance(value, float) and value.is_integer() and abs(value) <= INT64_MAX:
+        return int(value)
+    if isinstance(value, int) and abs(value) > INT64_MAX:
+        return float(value)
+    return value
+
+def toBoolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in TRUE | FALSE:
+        return value.strip().lower() in TRUE
+    raise ValueError(f'Expected a boolean, got {value!r}.')
+
+def toCategory(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    raise ValueError(f'Expected a category, got {value!r}.')
+
+COERCIONS = {
+    'numeric': toNumber,
+    'boolean': toBoolean,
+    'categorical': toCategory,
+}
+
+def coerceValue(type, value):
+    """Normalises a student value or state base to the feature type. Raises ValueError when it cannot."""
+    if value is None or type not in COERCIONS:
+        return value
+    return COERCIONS[type](value)
+
+def featureTypes(featureIds) -> dict:
+    """{featureId: type or None} for the features that exist, in one query."""
+    if not featureIds:
+        return {}
+
+    return {
+        feature['_id']: feature.get('type')
+        for feature in Feature._get_collection().find({'_id': {'$in': list(featureIds)}}, {'type': 1})
+    }
+
+def coerceItems(items, field, types = None) -> list:
+    """
+    Coerces `field` of every `{feature, ...}` item in place, returning one error
+    dict per item, empty for valid items.
+    """
+    if types is None:
+        types = featureTypes({item.get('feature') for item in items if item.get('feature') is not None})
+
+    errors = [{} for _ in items]
+    for index, item in enumerate(items):
+        try:
+            item[field] = coerceValue(types.get(item.get('feature')), item.get(field))
+        except ValueError as e:
+            errors[index][field] = [str(e)]
+
+    return errors
+
+def parseValue(type, text):
+    """Reads a value given as text, such as a query parameter. Untyped features take numbers where they parse."""
+    if type in COERCIONS:
+        return coerceValue(type, text)
+
+    try:
+        return toNumber(text)
+    except ValueError:
+        return text
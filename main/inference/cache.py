@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+from bson.objectid import ObjectId
+from django.conf import settings
+from django.core.cache import caches
+
+from ..metrics import CACHE_REQUESTS
+from ..models import Student
+from .catalog import getCatalog
+
+
+class LocalInferenceCache:
+    """In-process LRU cache with a time to live per entry."""
+
+    def __init__(self, maxEntries = 10000, ttl = 300):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                CACHE_REQUESTS.labels('miss').inc()
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.labels('hit').inc()
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+
+class DjangoInferenceCache:
+    """Stores entries in a Django cache backend so workers can share them; eviction is the backend's."""
+
+    def __init__(self, alias = 'default', ttl = 300):
+        self.cache = caches[alias]
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def cacheKey(self, key) -> str:
+        return 'inference:' + ':'.join(str(part) for part in key)
+
+    def get(self, key):
+        value = self.cache.get(self.cacheKey(key))
+        if value is None:
+            self.misses += 1
+            CACHE_REQUESTS.labels('miss').inc()
+        else:
+            self.hits += 1
+            CACHE_REQUESTS.labels('hit').inc()
+        return value
+
+    def set(self, key, value):
+        self.cache.set(self.cacheKey(key), value, self.ttl)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class NoInferenceCache:
+
+    hits = misses = 0
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+BACKENDS = {
+    'local': lambda options: LocalInferenceCache(options.get('MAX_ENTRIES', 10000), options.get('TTL', 300)),
+    'django': lambda options: DjangoInferenceCache(options.get('ALIAS', 'default'), options.get('TTL', 300)),
+    None: lambda options: NoInferenceCache(),
+}
+
+instance = None
+
+def getInferenceCache():
+    global instance
+    if instance is None:
+        options = getattr(settings, 'INFERENCE_CACHE', {})
+        instance = BACKENDS[options.get('BACKEND')](options)
+    return instance
+
+def studentVersion(idStudent):
+    student = Student._get_collection().find_one({'_id': ObjectId(idStudent)}, {'version': 1})
+    if student is None:
+        return None
+    return student.get('version', 0)
+
+def bumpStudentVersion(idStudent):
+    """Invalidates the cached inference results of one student. Call after any write to it."""
+    Student._get_collection().update_one({'_id': ObjectId(idStudent)}, {'$inc': {'version': 1}})
+
+def inferenceKey(kind, engine, idStudent):
+    """
+    Key of a single-student inference result: it changes whenever the student
+    (features, states, profile) or the rule catalog changes.
+    Returns None for unknown students, which are never cached.
+    """
+    version = studentVersion(idStudent)
+    if version is None:
+        return None
+    return (kind, engine, str(idStudent), version, getCatalog().version)
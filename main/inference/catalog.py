@@ -0,0 +1,84 @@
+import threading
+import time
+
+from django.conf import settings
+
+from ..models import State, Behavior, CatalogVersion
+from .rules import StateRuleIndex, BehaviorBitIndex
+
+CATALOG_ID = 'rules'
+
+
+class Catalog:
+    """An immutable snapshot of every `State` and `Behavior` at one catalog version."""
+
+    def __init__(self, version, states, behaviors):
+        self.version = version
+        self.states = list(states)
+        self.behaviors = list(behaviors)
+        self.statesById = {state['_id']: state for state in self.states}
+        self.behaviorsById = {behavior['_id']: behavior for behavior in self.behaviors}
+        self.cache = {}
+
+    @classmethod
+    def load(cls, version):
+        return cls(
+            version,
+            State._get_collection().find({}, {'name': 1, 'domain': 1, 'features': 1}),
+            Behavior._get_collection().find({}, {'name': 1, 'domain': 1, 'states': 1})
+        )
+
+    def derived(self, name, factory):
+        """Builds a structure from this snapshot once and keeps it for the life of the version."""
+        if name not in self.cache:
+            self.cache[name] = factory(self)
+        return self.cache[name]
+
+    @property
+    def stateIndex(self) -> StateRuleIndex:
+        return self.derived('stateIndex', lambda catalog: StateRuleIndex(catalog.states))
+
+    @property
+    def behaviorIndex(self) -> BehaviorBitIndex:
+        return self.derived('behaviorIndex', lambda catalog: BehaviorBitIndex(catalog.behaviors))
+
+
+lock = threading.Lock()
+current = None
+# Highest version this process has seen, so its own writes are never served stale
+latest = 0
+checkedAt = 0.0
+
+def catalogVersion() -> int:
+    document = CatalogVersion._get_collection().find_one({'_id': CATALOG_ID}, {'version': 1})
+    return document['version'] if document else 0
+
+def bumpCatalogVersion() -> int:
+    """Marks every worker's cached catalog as stale. Call after any State/Behavior write."""
+    global latest
+
+    version = CatalogVersion.objects(id=CATALOG_ID).modify(upsert=True, new=True, inc__version=1).version
+    with lock:
+        latest = max(latest, version)
+
+    return version
+
+def getCatalog() -> Catalog:
+    """
+    Returns the process-local catalog, reloading it when the version document in
+    MongoDB moved. The version is read at most once per CATALOG_VERSION_CHECK_INTERVAL.
+    """
+    global current, latest, checkedAt
+
+    interval = getattr(settings, 'CATALOG_VERSION_CHECK_INTERVAL', 1.0)
+    catalog = current
+    if catalog is not None and catalog.version >= latest and time.monotonic() - checkedAt < interval:
+        return catalog
+
+    version = catalogVersion()
+    with lock:
+        latest = max(latest, version)
+        if current is None or current.version < latest:
+            current = Catalog.load(latest)
+        checkedAt = time.monotonic()
+        return current
@@ -0,0 +1,188 @@
+from django.conf import settings
+
+from ..layouts import FEATURE_FIELDS, studentFeatures, featureQuery
+from ..models import Student
+from .catalog import getCatalog
+from .rules import StateRuleIndex, BehaviorBitIndex
+from .writeback import WriteBackResult, bulkSet, chunked
+
+STUDENT_PROJECTION = {**FEATURE_FIELDS, 'states': 1, 'behaviors': 1}
+
+
+class DependencyIndex:
+    """Which states read a feature and which behaviors read a state."""
+
+    def __init__(self, states, behaviors):
+        self.statesByFeature = {}
+        self.behaviorsByState = {}
+
+        for state in states:
+            for rule in state.get('features') or []:
+                self.statesByFeature.setdefault(rule.get('feature'), set()).add(state['_id'])
+
+        for behavior in behaviors:
+            for behaviorState in behavior.get('states') or []:
+                self.behaviorsByState.setdefault(behaviorState.get('state'), set()).add(behavior['_id'])
+
+    @classmethod
+    def load(cls):
+        return getCatalog().derived('dependencies', lambda catalog: cls(catalog.states, catalog.behaviors))
+
+    def statesFor(self, featureIds) -> set:
+        return set().union(*(self.statesByFeature.get(featureId, ()) for featureId in featureIds))
+
+    def behaviorsFor(self, stateIds) -> set:
+        return set().union(*(self.behaviorsByState.get(stateId, ()) for stateId in stateIds))
+
+
+def isEnabled() -> bool:
+    return getattr(settings, 'INFERENCE_INCREMENTAL', True)
+
+def mergeIds(current, affected, matched) -> list:
+    # Keeps the stored order for ids that are still held and appends new ones
+    kept = [id for id in current if id not in affected or id in matched]
+    return kept + [id for id in matched if id not in kept]
+
+def applyStates(students, stateIds) -> dict:
+    """Re-evaluates `stateIds` for raw student documents, returning {studentId: changed state ids}."""
+    stateIds = set(stateIds)
+    statesById = getCatalog().statesById
+    index = StateRuleIndex(statesById[stateId] for stateId in stateIds if stateId in statesById)
+
+    updates, changed = [], {}
+    for student in students:
+        current = student.get('states') or []
+        matched = [state.id for state in index.match(studentFeatures(student))]
+        states = mergeIds(current, stateIds, matched)
+
+        if set(states) != set(current):
+            updates.append((student['_id'], states))
+            changed[student['_id']] = set(states) ^ set(current)
+            student['states'] = states
+
+    bulkSet(updates, 'states', WriteBackResult())
+    return changed
+
+def applyBehaviors(students, behaviorIds) -> int:
+    """Re-evaluates `behaviorIds` for raw student documents, returning how many changed."""
+    behaviorIds = set(behaviorIds)
+    behaviorsById = getCatalog().behaviorsById
+    index = BehaviorBitIndex(behaviorsById[behaviorId] for behaviorId in behaviorIds if behaviorId in behaviorsById)
+
+    updates = []
+    for student in students:
+        current = student.get('behaviors') or []
+        matched = [behavior.id for behavior in index.match(student.get('states') or [])]
+        newBehaviors = mergeIds(current, behaviorIds, matched)
+
+        if set(newBehaviors) != set(current):
+            updates.append((student['_id'], newBehaviors))
+            student['behaviors'] = newBehaviors
+
+    bulkSet(updates, 'behaviors', WriteBackResult())
+    return len(updates)
+
+def propagate(students, changedStates, index) -> int:
+    # Behaviors only need a second look for students whose states moved
+    affected = [student for student in students if student['_id'] in changedStates]
+    if not affected:
+        return 0
+
+    behaviorIds = index.behaviorsFor(set().union(*changedStates.values()))
+    if not behaviorIds:
+        return 0
+
+    return applyBehaviors(affected, behaviorIds)
+
+def reinferStudent(studentId, featureIds) -> dict:
+    """After a feature write, re-infers the states reading `featureIds` for one student."""
+    index = DependencyIndex.load()
+    stateIds = index.statesFor(featureIds)
+    if not stateIds:
+        return {'states': 0, 'behaviors': 0}
+
+    students = list(Student._get_collection().find({'_id': studentId}, STUDENT_PROJECTION))
+    changed = applyStates(students, stateIds)
+
+    return {'states': len(changed), 'behaviors': propagate(students, changed, index)}
+
+def reinferStudents(studentIds) -> dict:
+    """Re-infers every state, then the affected behaviors, for a set of students."""
+    index = DependencyIndex.load()
+    # States without rules too, so a student still holding one loses it
+    stateIds = getCatalog().statesById.keys()
+    students = list(Student._get_collection().find({'_id': {'$in': list(studentIds)}}, STUDENT_PROJECTION))
+    changed = applyStates(students, stateIds)
+
+    return {'states': len(changed), 'behaviors': propagate(students, changed, index)}
+
+def stateStudents(stateId, featureIds) -> dict:
+    """Students a rule edit can move: holding the state's (old or new) features, or the state itself."""
+    return {'$or': [featureQuery(featureIds), {'states': stateId}]}
+
+def behaviorStudents(behaviorId, stateIds) -> dict:
+    return {'$or': [{'states': {'$in': list(stateIds)}}, {'behaviors': behaviorId}]}
+
+def studentChunks(query, chunkSize = None):
+    """Reads the students matching `query` in chunks, so only one chunk is held in memory."""
+    chunkSize = chunkSize or getattr(settings, 'INFERENCE_BATCH_SIZE', 1000)
+    return chunked(Student._get_collection().find(query, STUDENT_PROJECTION, batch_size=chunkSize), chunkSize)
+
+def reinferState(stateId, featureIds, progress = None) -> dict:
+    """
+    After a rule edit, re-infers one state for the students holding its (old or new) features,
+    one chunk and one bulk write at a time. `progress(students, changed)` is called after each chunk.
+    """
+    index = DependencyIndex.load()
+    counts = {'states': 0, 'behaviors': 0}
+
+    for students in studentChunks(stateStudents(stateId, featureIds)):
+        changed = applyStates(students, [stateId])
+        behaviors = propagate(students, changed, index)
+        counts['states'] += len(changed)
+        counts['behaviors'] += behaviors
+        if progress:
+            progress(len(students), len(changed) + behaviors)
+
+    return counts
+
+def reinferBehavior(behaviorId, stateIds, progress = None) -> dict:
+    """After a behavior edit, re-infers it for the students holding its (old or new) states, chunk by chunk."""
+    counts = {'states': 0, 'behaviors': 0}
+
+    for students in studentChunks(behaviorStudents(behaviorId, stateIds)):
+        changed = applyBehaviors(students, [behaviorId])
+        counts['behaviors'] += changed
+        if progress:
+            progress(len(students), changed)
+
+    return counts
+
+RULES = {
+    'state': (reinferState, stateStudents),
+    'behavior': (reinferBehavior, behaviorStudents),
+}
+
+def affectedCount(kind, id, sourceIds) -> int:
+    """How many students re-inferring the edited `kind` ('state' or 'behavior') reads."""
+    return Student._get_collection().count_documents(RULES[kind][1](id, sourceIds))
+
+def reinferRule(kind, id, sourceIds, progress = None) -> dict:
+    return RULES[kind][0](id, sourceIds, progress)
+
+def changedFeatures(oldFeatures, newFeatures) -> set:
+    """Feature ids whose values differ between two lists of `{feature, value}` items."""
+    def byFeature(features):
+        values = {}
+        for feature in features or []:
+            values.setdefault(feature.get('feature'), []).append(feature.get('value'))
+        return values
+
+    old, new = byFeature(oldFeatures), byFeature(newFeatures)
+    return {featureId for featureId in old.keys() | new.keys() if old.get(featureId) != new.get(featureId)}
+
+def stateFeatureIds(state) -> set:
+    return {rule.get('feature') for rule in state.to_mongo().get('features', [])}
+
+def behaviorStateIds(behavior) -> set:
+    return {behaviorState.get('state') for behaviorState in behavior.to_mongo().get('states', [])}
@@ -0,0 +1,162 @@
+import numpy as np
+
+from .rules import MISSING, TESTS, typeRank, compileRule
+from .snapshot import isColumnValue, getSnapshot
+
+
+class ValueIndex:
+    """
+    Sorted numeric values of one feature across the snapshot, with the student id
+    of each in `ids`, so threshold counts, histograms and quantiles are binary
+    searches. Students holding a value that is not a plain number, or the feature
+    more than once, are kept in `others` as (student id, every value they hold)
+    and evaluated with the compiled rules.
+    """
+
+    def __init__(self, values, ids, others):
+        self.values = values
+        self.ids = ids
+        self.others = others
+
+    @classmethod
+    def build(cls, matrix, featureId):
+        column = matrix.columns.get(featureId)
+        if column is None:
+            return cls(np.zeros(0), np.empty(0, dtype=object), [])
+
+        size = matrix.size
+        regular = matrix.alive[:size] & matrix.present[:size, column]
+        others = []
+
+        for row, features in matrix.irregular.items():
+            if regular[row]:
+                regular[row] = False
+                others.append((matrix.ids[row], [feature.get('value', MISSING) for feature in features if feature.get('feature') == featureId]))
+
+        for row, value in matrix.others.get(column, {}).items():
+            if regular[row]:
+                others.append((matrix.ids[row], [value]))
+
+        numeric = regular & matrix.numeric[:size, column]
+        values = matrix.values[:size, column][numeric]
+        order = np.argsort(values, kind='stable')
+        return cls(values[order], matrix.ids[:size][numeric][order], others)
+
+    def add(self, studentId, value = None, others = None):
+        """Adds one student with its numeric `value`, or every value it holds as `others`, keeping the order."""
+        if others is not None:
+            self.others.append((studentId, others))
+            return
+
+        position = int(np.searchsorted(self.values, value, 'right'))
+        self.values = np.insert(self.values, position, value)
+        self.ids = np.insert(self.ids, position, studentId)
+
+    def remove(self, studentId, value = None, others = None):
+        """Removes the entry `add` made for the same arguments."""
+        if others is not None:
+            self.others = [entry for entry in self.others if entry[0] != studentId]
+            return
+
+        left = int(np.searchsorted(self.values, value, 'left'))
+        right = int(np.searchsorted(self.values, value, 'right'))
+        positions = [position for position in range(left, right) if self.ids[position] == studentId]
+        if positions:
+            self.values = np.delete(self.values, positions[0])
+            self.ids = np.delete(self.ids, positions[0])
+
+    @property
+    def students(self) -> int:
+        return len(self.values) + len(self.others)
+
+    def span(self, operator, threshold) -> tuple:
+        """Start and stop, in the sorted values, of those passing `operator` against a column threshold."""
+        left = int(np.searchsorted(self.values, threshold, 'left'))
+        right = int(np.searchsorted(self.values, threshold, 'right'))
+        return {
+            'lt': (0, left),
+            'lte': (0, right),
+            'gt': (right, len(self.values)),
+            'gte': (left, len(self.values)),
+            'eq': (left, right),
+        }.get(operator, (0, 0))
+
+    def passing(self, operator, threshold):
+        """Slice, or mask, of the sorted values passing `operator` against `threshold`."""
+        if isColumnValue(threshold):
+            return slice(*self.span(operator, threshold))
+
+        predicate = compileRule(operator, threshold)
+        if typeRank(threshold) == typeRank(0):
+            # A number the float64 values cannot hold exactly
+            return np.array([predicate(value) for value in self.values.tolist()], dtype=bool)
+        # Every number compares the same way against a threshold of another type
+        return slice(None) if predicate(0) else slice(0)
+
+    def count(self, operator, threshold) -> int:
+        """Students whose value passes `operator` against `threshold`, as a single rule of a state would."""
+        predicate = compileRule(operator, threshold)
+        passed = len(self.values[self.passing(operator, threshold)])
+        return passed + sum(1 for _, values in self.others if all(predicate(value) for value in values))
+
+    def studentIds(self, operator, threshold) -> list:
+        """Ids of the students `count` counts, numeric values first in ascending order."""
+        predicate = compileRule(operator, threshold)
+        return self.ids[self.passing(operator, threshold)].tolist() + [
+            id for id, values in self.others if all(predicate(value) for value in values)
+        ]
+
+    def counts(self, thresholds, operators = None) -> list:
+        operators = operators or list(TESTS)
+        return [
+            {'threshold': threshold, **{operator: self.count(operator, threshold) for operator in operators}}
+            for threshold in thresholds
+        ]
+
+    def histogram(self, edges) -> list:
+        """Numeric values per `[lower, upper)` bin of the ascending `edges`, the last bin closed."""
+        if len(edges) < 2:
+            return []
+
+        positions = np.searchsorted(self.values, edges, 'left')
+        positions[-1] = np.searchsorted(self.values, edges[-1], 'right')
+        return [
+            {'lower': lower, 'upper': upper, 'count': int(positions[index + 1] - positions[index])}
+            for index, (lower, upper) in enumerate(zip(edges, edges[1:]))
+        ]
+
+    def bins(self, count) -> list:
+        """Edges of `count` equal width bins between the lowest and highest numeric value."""
+        if not len(self.values):
+            return []
+        return np.linspace(self.values[0], self.values[-1], count + 1).tolist()
+
+    def quantiles(self, fractions) -> list:
+        """Linearly interpolated quantiles of the numeric values, read from the sorted array."""
+        if not len(self.values):
+            return [{'quantile': fraction, 'value': None} for fraction in fractions]
+
+        result = []
+        for fraction in fractions:
+            position = fraction * (len(self.values) - 1)
+            lower = int(position)
+            upper = min(lower + 1, len(self.values) - 1)
+            value = self.values[lower] + (self.values[upper] - self.values[lower]) * (position - lower)
+            result.append({'quantile': fraction, 'value': float(value)})
+        return result
+
+
+def getValueIndex(featureId) -> ValueIndex:
+    """
+    The value index of `featureId` over the current snapshot, built on first use.
+    Snapshot writes update the indexes of the features they touch in place.
+    """
+    matrix = getSnapshot()
+    with matrix.lock:
+        column = matrix.columns.get(featureId)
+        if column is None:
+            return ValueIndex.build(matrix, featureId)
+
+        if column not in matrix.valueIndexes:
+            matrix.valueIndexes[column] = ValueIndex.build(matrix, featureId)
+        return matrix.valueIndexes[column]
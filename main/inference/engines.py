@@ -0,0 +1,179 @@
+from bson.objectid import ObjectId
+from django.conf import settings
+
+from ..layouts import FEATURE_FIELDS, featureLayout, studentFeatures
+from ..models import Student
+from ..pipelines.student import innferStates, innferBehaviors
+from .catalog import getCatalog
+from .partitions import inferPartitions
+from .snapshot import getSnapshot
+from .rules import StateRuleIndex, BehaviorBitIndex
+
+
+class AggregationStateEngine:
+    """Infers states server side with the `innferStates` pipeline."""
+
+    name = 'aggregation'
+
+    def infer(self, idStudent = None, match = None):
+        pipeline = innferStates(idStudent=idStudent, match=match, layout=featureLayout())
+        return Student.objects().aggregate(pipeline)
+
+    def merge(self, idStudent = None, match = None):
+        """Runs the pipeline with a final $merge, so the results are written without leaving the server."""
+        Student.objects().aggregate(innferStates(idStudent=idStudent, match=match, merge=True, layout=featureLayout()), allowDiskUse=True)
+
+
+class CompiledStateEngine:
+    """Evaluates students in process against the compiled rules of the cached catalog."""
+
+    name = 'compiled'
+
+    def __init__(self, batchSize = None):
+        self.batchSize = batchSize or getattr(settings, 'INFERENCE_BATCH_SIZE', 1000)
+
+    def loadIndex(self) -> StateRuleIndex:
+        return getCatalog().stateIndex
+
+    def infer(self, idStudent = None, match = None):
+        index = self.loadIndex()
+
+        query = dict(match or {})
+        if idStudent:
+            query['_id'] = ObjectId(idStudent)
+
+        students = Student._get_collection().find(
+            query,
+            {'alias': 1, 'age': 1, 'gender': 1, **FEATURE_FIELDS},
+            batch_size=self.batchSize
+        )
+
+        for student in students:
+            states = index.match(studentFeatures(student))
+            if not states:
+                continue
+
+            yield {
+                '_id': student['_id'],
+                'alias': student.get('alias'),
+                'age': student.get('age'),
+                'gender': student.get('gender'),
+                'states': [state.asOutput() for state in states],
+            }
+
+
+class SnapshotStateEngine:
+    """Evaluates the rules as vectorized column comparisons over the in-memory feature matrix."""
+
+    name = 'snapshot'
+
+    def infer(self, idStudent = None, match = None):
+        # The snapshot has no `_id` ranges, partitions read the collection instead
+        if match:
+            return CompiledStateEngine().infer(idStudent=idStudent, match=match)
+
+        return getSnapshot().infer(idStudent)
+
+
+STATE_ENGINES = {
+    AggregationStateEngine.name: AggregationStateEngine,
+    CompiledStateEngine.name: CompiledStateEngine,
+    SnapshotStateEngine.name: SnapshotStateEngine,
+}
+
+def getStateEngine(name = None):
+    name = name or getattr(settings, 'INFERENCE_STATE_ENGINE', AggregationStateEngine.name)
+    if name not in STATE_ENGINES:
+        raise ValueError(f'Unknown state engine "{name}", expected one of: {", ".join(STATE_ENGINES)}')
+
+    return STATE_ENGINES[name]()
+
+
+class AggregationBehaviorEngine:
+    """Infers behaviors server side with the `innferBehaviors` pipeline."""
+
+    name = 'aggregation'
+
+    def describe(self, idStudent = None):
+        return innferBehaviors(idStudent=idStudent)
+
+    def infer(self, idStudent = None, match = None):
+        pipeline = innferBehaviors(idStudent=idStudent, match=match)
+        return Student.objects().aggregate(pipeline)
+
+    def merge(self, idStudent = None, match = None):
+        """Runs the pipeline with a final $merge, so the results are written without leaving the server."""
+        Student.objects().aggregate(innferBehaviors(idStudent=idStudent, match=match, merge=True), allowDiskUse=True)
+
+
+class BitsetBehaviorEngine:
+    """Matches each student's state bitmask against the required-state mask of every `Behavior`."""
+
+    name = 'bitset'
+
+    def __init__(self, batchSize = None):
+        self.batchSize = batchSize or getattr(settings, 'INFERENCE_BATCH_SIZE', 1000)
+
+    def describe(self, idStudent = None):
+        return {'engine': self.name, 'student': idStudent}
+
+    def loadIndex(self) -> BehaviorBitIndex:
+        return getCatalog().behaviorIndex
+
+    def infer(self, idStudent = None, match = None):
+        index = self.loadIndex()
+
+        query = {**(match or {}), 'states.0': {'$exists': True}}
+        if idStudent:
+            query['_id'] = ObjectId(idStudent)
+
+        students = Student._get_collection().find(
+            query,
+            {'alias': 1, 'age': 1, 'gender': 1, 'states': 1},
+            batch_size=self.batchSize
+        )
+
+        for student in students:
+            behaviors = index.match(student['states'])
+            if not behaviors:
+                continue
+
+            yield {
+                '_id': student['_id'],
+                'alias': student.get('alias'),
+                'age': student.get('age'),
+                'gender': student.get('gender'),
+                'behaviors': [behavior.asOutput() for behavior in behaviors],
+            }
+
+
+BEHAVIOR_ENGINES = {
+    AggregationBehaviorEngine.name: AggregationBehaviorEngine,
+    BitsetBehaviorEngine.name: BitsetBehaviorEngine,
+}
+
+def getBehaviorEngine(name = None):
+    name = name or getattr(settings, 'INFERENCE_BEHAVIOR_ENGINE', AggregationBehaviorEngine.name)
+    if name not in BEHAVIOR_ENGINES:
+        raise ValueError(f'Unknown behavior engine "{name}", expected one of: {", ".join(BEHAVIOR_ENGINES)}')
+
+    return BEHAVIOR_ENGINES[name]()
+
+
+class PartitionedEngine:
+    """Runs a full-population inference of `engine` as concurrent `_id` range partitions."""
+
+    def __init__(self, engine, workers = None, partitionSize = None):
+        self.engine = engine
+        self.name = engine.name
+        self.workers = workers
+        self.partitionSize = partitionSize
+
+    def describe(self, idStudent = None):
+        return self.engine.describe(idStudent=idStudent)
+
+    def infer(self, idStudent = None, match = None):
+        if idStudent or match:
+            return self.engine.infer(idStudent=idStudent, match=match)
+
+        return inferPartitions(self.engine, self.workers, self.partitionSize)
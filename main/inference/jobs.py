@@ -0,0 +1,160 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+
+from ..models import Student, InferenceJob
+from ..metrics import inferenceRun
+from . import dependencies
+from .engines import getStateEngine, getBehaviorEngine
+from .partitions import studentIdRanges, rangeMatch
+from .writeback import writeBack
+
+logger = logging.getLogger(__name__)
+
+KINDS = {
+    'states': getStateEngine,
+    'behaviors': getBehaviorEngine,
+}
+
+lock = threading.Lock()
+executor = None
+
+def getExecutor() -> ThreadPoolExecutor:
+    global executor
+    with lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'INFERENCE_JOB_WORKERS', 2),
+                thread_name_prefix='inference-job'
+            )
+        return executor
+
+def now():
+    return datetime.now(timezone.utc)
+
+def startJob(kind, engineName = None) -> InferenceJob:
+    """Stores a pending job and queues it on the local worker pool. Raises ValueError for unknown kinds or engines."""
+    if kind not in KINDS:
+        raise ValueError(f'Unknown job kind "{kind}", expected one of: {", ".join(KINDS)}')
+
+    engine = KINDS[kind](engineName)
+    job = InferenceJob(kind=kind, engine=engine.name, status='pending', createdAt=now())
+    job.save()
+
+    getExecutor().submit(runJob, job.id)
+    return job
+
+def startRuleJob(kind, targetId, sourceIds) -> InferenceJob:
+    """Queues the incremental re-inference of an edited state or behavior ('state' or 'behavior')."""
+    job = InferenceJob(
+        kind=kind,
+        engine='incremental',
+        target=targetId,
+        sources=list(sourceIds),
+        status='pending',
+        createdAt=now()
+    )
+    job.save()
+
+    getExecutor().submit(runRuleJob, job.id)
+    return job
+
+def claimJob(jobId, total) -> bool:
+    """Moves a pending job to running. False when it is no longer pending, as after `reapStaleJobs`."""
+    return InferenceJob._get_collection().update_one({'_id': jobId, 'status': 'pending'}, {'$set': {
+        'status': 'running',
+        'total': total,
+        'startedAt': now(),
+        'updatedAt': now(),
+    }}).matched_count > 0
+
+def failJob(jobId, error):
+    logger.exception('Inference job %s failed', jobId)
+    InferenceJob._get_collection().update_one({'_id': jobId}, {'$set': {
+        'status': 'failed',
+        'error': str(error),
+        'finishedAt': now(),
+        'updatedAt': now(),
+    }})
+
+def reapStaleJobs() -> int:
+    """
+    Marks failed the jobs whose worker is gone: pending or running without progress
+    for INFERENCE_JOB_STALE_AFTER seconds. Returns how many were marked.
+    """
+    cutoff = now() - timedelta(seconds=getattr(settings, 'INFERENCE_JOB_STALE_AFTER', 900))
+    return InferenceJob._get_collection().update_many(
+        {'$or': [
+            {'status': 'pending', 'createdAt': {'$lt': cutoff}},
+            {'status': 'running', 'updatedAt': {'$lt': cutoff}},
+        ]},
+        {'$set': {
+            'status': 'failed',
+            'error': 'The job stopped reporting progress, its worker is gone.',
+            'finishedAt': now(),
+            'updatedAt': now(),
+        }}
+    ).modified_count
+
+def runJob(jobId):
+    """
+    Infers and writes back `kind` for the whole population, one `_id` range at a time,
+    recording progress on the job document after every range.
+    """
+    collection = InferenceJob._get_collection()
+
+    try:
+        job = InferenceJob.objects.get(id=jobId)
+        engine = KINDS[job.kind](job.engine)
+        students = Student._get_collection()
+
+        if not claimJob(job.id, students.estimated_document_count()):
+            return
+
+        with inferenceRun(job.kind, engine.name, 'job') as run:
+            for lower, upper in studentIdRanges():
+                match = rangeMatch(lower, upper)
+                report = writeBack(
+                    ((student['_id'], [item['_id'] for item in student[job.kind]]) for student in engine.infer(match=match)),
+                    job.kind,
+                    scope=match
+                )
+
+                processed = students.count_documents(match)
+                run['students'] += processed
+                collection.update_one({'_id': job.id}, {
+                    '$inc': {
+                        'processed': processed,
+                        'matched': report.matched,
+                        'modified': report.modified,
+                        'skipped': report.skipped,
+                    },
+                    '$set': {'updatedAt': now()},
+                })
+
+        collection.update_one({'_id': job.id}, {'$set': {'status': 'done', 'finishedAt': now(), 'updatedAt': now()}})
+    except Exception as e:
+        failJob(jobId, e)
+
+def runRuleJob(jobId):
+    """Runs a `startRuleJob` job, recording progress on the job document after every chunk."""
+    collection = InferenceJob._get_collection()
+
+    def progress(students, modified):
+        collection.update_one({'_id': jobId}, {
+            '$inc': {'processed': students, 'modified': modified},
+            '$set': {'updatedAt': now()},
+        })
+
+    try:
+        job = InferenceJob.objects.get(id=jobId)
+        if not claimJob(job.id, dependencies.affectedCount(job.kind, job.target, job.sources)):
+            return
+
+        dependencies.reinferRule(job.kind, job.target, job.sources, progress)
+        collection.update_one({'_id': job.id}, {'$set': {'status': 'done', 'finishedAt': now(), 'updatedAt': now()}})
+    except Exception as e:
+        failJob(jobId, e)
@@ -0,0 +1,65 @@
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from ..models import Student
+
+
+def studentIdRanges(partitionSize = None) -> list:
+    """
+    Splits the student collection into consecutive `_id` ranges of about
+    `partitionSize` students, as (lower, upper) pairs where lower is inclusive,
+    upper exclusive and None means unbounded.
+    """
+    partitionSize = partitionSize or getattr(settings, 'INFERENCE_PARTITION_SIZE', 5000)
+    collection = Student._get_collection()
+
+    boundaries = []
+    query = {}
+    while True:
+        # Each step walks partitionSize keys of the _id index from the previous boundary
+        boundary = next(
+            collection.find(query, {'_id': 1}).sort('_id', 1).skip(partitionSize).limit(1),
+            None
+        )
+        if boundary is None:
+            break
+
+        boundaries.append(boundary['_id'])
+        query = {'_id': {'$gte': boundary['_id']}}
+
+    lowers = [None] + boundaries
+    uppers = boundaries + [None]
+    return list(zip(lowers, uppers))
+
+def rangeMatch(lower, upper) -> dict:
+    bounds = {}
+    if lower is not None:
+        bounds['$gte'] = lower
+    if upper is not None:
+        bounds['$lt'] = upper
+
+    return {'_id': bounds} if bounds else {}
+
+def inferPartitions(engine, workers = None, partitionSize = None):
+    """
+    Runs `engine.infer` on every `_id` range concurrently, at most `workers` ranges
+    in flight, and yields the rows range by range in `_id` order as they complete.
+    """
+    workers = workers or getattr(settings, 'INFERENCE_PARALLEL_WORKERS', 4)
+
+    def infer(bounds) -> list:
+        return sorted(engine.infer(match=rangeMatch(*bounds)), key=lambda row: row['_id'])
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='inference-partition') as executor:
+        pending = deque()
+        for bounds in studentIdRanges(partitionSize):
+            # Keeps the commands of each partition attributed to the calling request
+            pending.append(executor.submit(contextvars.copy_context().run, infer, bounds))
+            if len(pending) >= workers:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
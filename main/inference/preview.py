@@ -0,0 +1,55 @@
+import numpy as np
+from django.conf import settings
+
+from ..layouts import FEATURE_FIELDS, studentFeatures
+from ..models import Student
+from .rules import StateRuleIndex
+from .snapshot import getSnapshot
+
+PREVIEW_ENGINES = ['compiled', 'snapshot']
+
+
+def previewStates(states, sample = 0, engine = 'compiled') -> dict:
+    """
+    Evaluates unsaved `State` definitions against every student in one pass, with the
+    same compiled rules as inference, and writes nothing. Returns the number of students
+    evaluated and, per state in input order, its match count and the first `sample`
+    matching ids.
+    """
+    if engine not in PREVIEW_ENGINES:
+        raise ValueError(f'Unknown preview engine "{engine}", expected one of: {", ".join(PREVIEW_ENGINES)}')
+
+    # Drafts have no ids yet, they are keyed by their position
+    drafts = [{**state, '_id': position} for position, state in enumerate(states)]
+    index = StateRuleIndex(drafts)
+    counts = [0] * len(drafts)
+    samples = [[] for _ in drafts]
+
+    if engine == 'snapshot':
+        snapshot = getSnapshot()
+        rows, matched = snapshot.match(drafts, stateIndex=index)
+        total = len(rows)
+        for position in range(len(drafts)):
+            matchedRows = rows[np.flatnonzero(matched[:, position])]
+            counts[position] = len(matchedRows)
+            samples[position] = sorted(snapshot.ids[matchedRows].tolist())[:sample]
+    else:
+        total = 0
+        students = Student._get_collection().find(
+            {}, FEATURE_FIELDS, sort=[('_id', 1)],
+            batch_size=getattr(settings, 'INFERENCE_BATCH_SIZE', 1000)
+        )
+        for student in students:
+            total += 1
+            for state in index.match(studentFeatures(student)):
+                counts[state.id] += 1
+                if len(samples[state.id]) < sample:
+                    samples[state.id].append(student['_id'])
+
+    return {
+        'students': total,
+        'states': [
+            {'matched': counts[position], 'sample': samples[position]}
+            for position in range(len(drafts))
+        ],
+    }
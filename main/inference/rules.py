@@ -0,0 +1,194 @@
+from datetime import datetime
+
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+# Sentinel for a feature entry without a value, which MongoDB orders below null
+MISSING = object()
+
+TESTS = {
+    'gte': lambda cmp: cmp >= 0,
+    'lte': lambda cmp: cmp <= 0,
+    'lt': lambda cmp: cmp < 0,
+    'gt': lambda cmp: cmp > 0,
+    'eq': lambda cmp: cmp == 0,
+}
+
+def typeRank(value) -> int:
+    # Mirrors the BSON comparison order used by the aggregation operators
+    if value is MISSING:
+        return 0
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float, Decimal128)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+def compareValues(value, base) -> int:
+    valueRank, baseRank = typeRank(value), typeRank(base)
+    if valueRank != baseRank:
+        return -1 if valueRank < baseRank else 1
+
+    if valueRank in (0, 1):
+        return 0
+
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    if isinstance(base, Decimal128):
+        base = base.to_decimal()
+
+    if isinstance(value, dict):
+        value, base = list(value.items()), list(base.items())
+
+    if isinstance(value, (list, tuple)):
+        for left, right in zip(value, base):
+            if isinstance(left, tuple):
+                cmp = compareValues(left[0], right[0]) or compareValues(left[1], right[1])
+            else:
+                cmp = compareValues(left, right)
+            if cmp:
+                return cmp
+        return (len(value) > len(base)) - (len(value) < len(base))
+
+    try:
+        return (value > base) - (value < base)
+    except TypeError:
+        return 0
+
+def compileRule(operator, base):
+    test = TESTS.get(operator)
+    if test is None:
+        return lambda value: False
+
+    return lambda value: test(compareValues(value, base))
+
+
+class CompiledState:
+    __slots__ = ('id', 'name', 'domain', 'rules')
+
+    def __init__(self, document):
+        self.id = document['_id']
+        self.name = document.get('name')
+        self.domain = document.get('domain')
+        self.rules = [
+            (rule.get('feature'), compileRule(rule.get('operator'), rule.get('base', MISSING)))
+            for rule in document.get('features') or []
+        ]
+
+    def asOutput(self) -> dict:
+        return {
+            '_id': self.id,
+            'name': self.name,
+            'domain': self.domain,
+        }
+
+
+class StateRuleIndex:
+    """Compiled `State` rules indexed by the feature each rule reads."""
+
+    def __init__(self, states):
+        self.states = [CompiledState(state) for state in states]
+        self.byFeature = {}
+
+        for stateIndex, state in enumerate(self.states):
+            for ruleIndex, (feature, predicate) in enumerate(state.rules):
+                self.byFeature.setdefault(feature, []).append((stateIndex, ruleIndex, predicate))
+
+    def match(self, features) -> list:
+        passed = {}
+        failed = set()
+
+        for feature in features:
+            value = feature.get('value', MISSING)
+            for stateIndex, ruleIndex, predicate in self.byFeature.get(feature.get('feature'), ()):
+                if stateIndex in failed:
+                    continue
+                if predicate(value):
+                    passed.setdefault(stateIndex, set()).add(ruleIndex)
+                else:
+                    failed.add(stateIndex)
+
+        return [
+            self.states[stateIndex]
+            for stateIndex in sorted(passed)
+            if stateIndex not in failed and len(passed[stateIndex]) == len(self.states[stateIndex].rules)
+        ]
+
+
+
+class CompiledBehavior:
+    __slots__ = ('id', 'name', 'domain', 'required', 'optional')
+
+    def __init__(self, document, required, optional):
+        self.id = document['_id']
+        self.name = document.get('name')
+        self.domain = document.get('domain')
+        self.required = required
+        self.optional = optional
+
+    def asOutput(self) -> dict:
+        return {
+            '_id': self.id,
+            'name': self.name,
+            'domain': self.domain,
+        }
+
+
+class BehaviorBitIndex:
+    """
+    Maps every state referenced by a `Behavior` to a bit, so a student's
+    states and each behavior's required states become integer masks.
+    """
+
+    def __init__(self, behaviors):
+        self.bits = {}
+        self.behaviors = []
+
+        for behavior in behaviors:
+            required = optional = 0
+            for behaviorState in behavior.get('states') or []:
+                bit = self.bit(behaviorState.get('state'))
+                # BehaviorStateSerializer defaults `required` to True
+                if behaviorState.get('required') is False:
+                    optional |= bit
+                else:
+                    required |= bit
+
+            self.behaviors.append(CompiledBehavior(behavior, required, optional))
+
+    def bit(self, stateId) -> int:
+        if stateId not in self.bits:
+            self.bits[stateId] = 1 << len(self.bits)
+        return self.bits[stateId]
+
+    def mask(self, stateIds) -> int:
+        mask = 0
+        for stateId in stateIds:
+            mask |= self.bits.get(stateId, 0)
+        return mask
+
+    def match(self, stateIds) -> list:
+        mask = self.mask(stateIds)
+        if not mask:
+            return []
+
+        # Optional states never block a match; a behavior made only of optional
+        # states needs at least one of them
+        return [
+            behavior for behavior in self.behaviors
+            if mask & behavior.required == behavior.required and (behavior.required or mask & behavior.optional)
+        ]
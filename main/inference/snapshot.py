@@ -0,0 +1,315 @@
+import math
+import threading
+import time
+
+import numpy as np
+from bson.objectid import ObjectId
+from django.conf import settings
+
+from ..layouts import FEATURE_FIELDS, studentFeatures
+from ..models import Student
+from .catalog import getCatalog
+from .rules import MISSING, typeRank, compileRule
+
+PROFILE_FIELDS = {'alias': 1, 'age': 1, 'gender': 1}
+
+COMPARISONS = {
+    'gte': np.greater_equal,
+    'lte': np.less_equal,
+    'lt': np.less,
+    'gt': np.greater,
+    'eq': np.equal,
+}
+
+def isColumnValue(value) -> bool:
+    # Numbers a float64 column holds exactly; anything else is kept aside and compared in Python
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    if isinstance(value, float):
+        return not math.isnan(value)
+    return abs(value) <= 2 ** 53
+
+
+class FeatureMatrix:
+    """
+    Students x features snapshot: a float64 value matrix with `present` and
+    `numeric` masks, rows identified by the `ids` array. Values that are not
+    plain numbers live in `others` and students that repeat a feature in
+    `irregular`, both evaluated with the compiled rules so results match the engines.
+    """
+
+    def __init__(self, rows = 1024, columns = 16):
+        self.size = 0
+        self.ids = np.empty(rows, dtype=object)
+        self.alive = np.zeros(rows, dtype=bool)
+        self.values = np.zeros((rows, columns))
+        self.present = np.zeros((rows, columns), dtype=bool)
+        self.numeric = np.zeros((rows, columns), dtype=bool)
+        self.profiles = [None] * rows
+        self.rows = {}
+        self.columns = {}
+        self.others = {}
+        self.otherColumns = {}
+        self.irregular = {}
+        self.valueIndexes = {}
+        self.lock = threading.RLock()
+        self.builtAt = time.monotonic()
+
+    @classmethod
+    def load(cls, batchSize = None):
+        """Streams every student through a projection of its profile and features."""
+        batchSize = batchSize or getattr(settings, 'INFERENCE_BATCH_SIZE', 1000)
+        matrix = cls()
+        for student in Student._get_collection().find({}, {**PROFILE_FIELDS, **FEATURE_FIELDS}, batch_size=batchSize):
+            matrix.setRow(student)
+        return matrix
+
+    def grow(self, rows, columns):
+        rows = max(rows, self.values.shape[0])
+        columns = max(columns, self.values.shape[1])
+
+        def resized(array, fill):
+            grown = np.full((rows,) + ((columns,) if array.ndim == 2 else ()), fill, dtype=array.dtype)
+            grown[tuple(slice(0, size) for size in array.shape)] = array
+            return grown
+
+        self.ids = resized(self.ids, None)
+        self.alive = resized(self.alive, False)
+        self.values = resized(self.values, 0)
+        self.present = resized(self.present, False)
+        self.numeric = resized(self.numeric, False)
+        self.profiles += [None] * (rows - len(self.profiles))
+
+    def column(self, featureId) -> int:
+        if featureId not in self.columns:
+            if len(self.columns) == self.values.shape[1]:
+                self.grow(0, 2 * len(self.columns))
+            self.columns[featureId] = len(self.columns)
+        return self.columns[featureId]
+
+    def indexEntry(self, row, column, featureId) -> tuple:
+        """(numeric value, None) or (None, every value held) of a row, as the value index of `column` holds it."""
+        if row in self.irregular:
+            return None, [feature.get('value', MISSING) for feature in self.irregular[row] if feature.get('feature') == featureId]
+        if row in self.others.get(column, {}):
+            return None, [self.others[column][row]]
+        return float(self.values[row, column]), None
+
+    def clearRow(self, row):
+        if self.valueIndexes:
+            featureIds = {column: featureId for featureId, column in self.columns.items()}
+            for column in np.flatnonzero(self.present[row]).tolist():
+                if column in self.valueIndexes:
+                    self.valueIndexes[column].remove(self.ids[row], *self.indexEntry(row, column, featureIds[column]))
+
+        self.values[row] = 0
+        self.present[row] = False
+        self.numeric[row] = False
+        for column in self.otherColumns.pop(row, ()):
+            self.others[column].pop(row, None)
+        self.irregular.pop(row, None)
+
+    def setRow(self, student):
+        """Adds or replaces the row of a raw student document."""
+        with self.lock:
+            row = self.rows.get(student['_id'])
+            if row is None:
+                if self.size == self.values.shape[0]:
+                    self.grow(2 * self.size, 0)
+                row = self.rows[student['_id']] = self.size
+                self.size += 1
+            else:
+                self.clearRow(row)
+
+            features = studentFeatures(student)
+            for feature in features:
+                column = self.column(feature.get('feature'))
+                value = feature.get('value', MISSING)
+
+                if self.present[row, column]:
+                    self.irregular[row] = features
+                self.present[row, column] = True
+
+                if isColumnValue(value):
+                    self.values[row, column] = value
+                    self.numeric[row, column] = True
+                else:
+                    self.numeric[row, column] = False
+                    self.others.setdefault(column, {})[row] = value
+                    self.otherColumns.setdefault(row, set()).add(column)
+
+            self.ids[row] = student['_id']
+            self.alive[row] = True
+            self.profiles[row] = {field: student.get(field) for field in PROFILE_FIELDS}
+
+            # Built value indexes take the row in place instead of being rebuilt on the next read
+            for featureId in {feature.get('feature') for feature in features}:
+                column = self.columns[featureId]
+                if column in self.valueIndexes:
+                    self.valueIndexes[column].add(student['_id'], *self.indexEntry(row, column, featureId))
+
+    def removeRow(self, studentId):
+        with self.lock:
+            row = self.rows.pop(studentId, None)
+            if row is not None:
+                self.clearRow(row)
+                self.alive[row] = False
+                self.profiles[row] = None
+
+    def refresh(self, studentIds):
+        """Reloads the rows of `studentIds` after writes, dropping deleted students."""
+        studentIds = set(studentIds)
+        students = Student._get_collection().find({'_id': {'$in': list(studentIds)}}, {**PROFILE_FIELDS, **FEATURE_FIELDS})
+        for student in students:
+            self.setRow(student)
+            studentIds.discard(student['_id'])
+
+        for studentId in studentIds:
+            self.removeRow(studentId)
+
+    def evaluateRule(self, rows, featureId, operator, base):
+        column = self.columns.get(featureId)
+        if column is None or operator not in COMPARISONS:
+            return np.zeros(len(rows), dtype=bool)
+
+        numeric = self.numeric[rows, column]
+        predicate = compileRule(operator, base)
+
+        if isColumnValue(base):
+            passed = numeric & COMPARISONS[operator](self.values[rows, column], base)
+        elif typeRank(base) == typeRank(0):
+            # A number the column cannot hold exactly, compared row by row
+            passed = np.array([bool(number) and predicate(value) for number, value in zip(numeric, self.values[rows, column].tolist())], dtype=bool)
+        else:
+            # Every number compares the same way against a base of another type
+            passed = numeric & predicate(0)
+
+        # Rows are ascending, so the cells kept aside are located by binary search
+        for row, value in self.others.get(column, {}).items():
+            position = np.searchsorted(rows, row)
+            if position < len(rows) and rows[position] == row:
+                passed[position] = predicate(value)
+
+        return passed
+
+    def match(self, states, rows = None, stateIndex = None):
+        """
+        Boolean matrix of `rows` (all live rows by default) x `states`, the raw State
+        documents. `stateIndex` holds the same states compiled, by default the catalog's.
+        """
+        with self.lock:
+            if rows is None:
+                rows = np.flatnonzero(self.alive[:self.size])
+
+            matched = np.zeros((len(rows), len(states)), dtype=bool)
+            for index, state in enumerate(states):
+                rules = state.get('features') or []
+                if not rules:
+                    continue
+
+                passed = np.ones(len(rows), dtype=bool)
+                for rule in rules:
+                    passed &= self.evaluateRule(rows, rule.get('feature'), rule.get('operator'), rule.get('base', MISSING))
+                    if not passed.any():
+                        break
+                matched[:, index] = passed
+
+            if self.irregular:
+                stateIndex = stateIndex or getCatalog().stateIndex
+                positions = {row: position for position, row in enumerate(rows.tolist())}
+                columns = {state['_id']: index for index, state in enumerate(states)}
+                for row, features in self.irregular.items():
+                    if row in positions:
+                        matched[positions[row]] = False
+                        for state in stateIndex.match(features):
+                            if state.id in columns:
+                                matched[positions[row], columns[state.id]] = True
+
+            return rows, matched
+
+    def infer(self, studentId = None):
+        """Yields engine output rows for every student holding at least one state."""
+        catalog = getCatalog()
+        rows = None
+        if studentId is not None:
+            row = self.rows.get(ObjectId(studentId))
+            rows = np.array([] if row is None else [row], dtype=np.int64)
+
+        rows, matched = self.match(catalog.states, rows)
+        for position in np.flatnonzero(matched.any(axis=1)):
+            row = rows[position]
+            profile = self.profiles[row] or {}
+            yield {
+                '_id': self.ids[row],
+                'alias': profile.get('alias'),
+                'age': profile.get('age'),
+                'gender': profile.get('gender'),
+                'states': [
+                    {'_id': catalog.states[index]['_id'], 'name': catalog.states[index].get('name'), 'domain': catalog.states[index].get('domain')}
+                    for index in np.flatnonzero(matched[position])
+                ],
+            }
+
+
+lock = threading.Lock()
+current = None
+# One build at a time; the ids written while it runs are replayed on it before the swap
+building = threading.Lock()
+rebuilding = None
+
+def buildSnapshot() -> FeatureMatrix:
+    """Loads a new snapshot outside `lock` and swaps it in. Call with `building` held."""
+    global current, rebuilding
+
+    with lock:
+        rebuilding = set()
+    try:
+        fresh = FeatureMatrix.load()
+        with lock:
+            if rebuilding:
+                fresh.refresh(rebuilding)
+            current = fresh
+            return fresh
+    finally:
+        with lock:
+            rebuilding = None
+
+def getSnapshot() -> FeatureMatrix:
+    """
+    Returns the process-local snapshot, building it on first use and again once it is
+    older than INFERENCE_SNAPSHOT_TTL seconds, which bounds how long writes made
+    by other processes take to show up. While one request rebuilds an expired
+    snapshot the others keep reading it.
+    """
+    ttl = getattr(settings, 'INFERENCE_SNAPSHOT_TTL', 60)
+    snapshot = current
+    if snapshot is not None and time.monotonic() - snapshot.builtAt <= ttl:
+        return snapshot
+
+    # Only the first build makes other requests wait
+    if not building.acquire(blocking=snapshot is None):
+        return snapshot
+    try:
+        if current is not None and current is not snapshot:
+            return current
+        return buildSnapshot()
+    finally:
+        building.release()
+
+def refreshStudents(studentIds):
+    """Applies this process's writes to its snapshot, if it has one, and to one being built."""
+    if not studentIds:
+        return
+
+    with lock:
+        if rebuilding is not None:
+            rebuilding.update(studentIds)
+        snapshot = current
+
+    if snapshot is not None:
+        snapshot.refresh(studentIds)
+
+def rebuildSnapshot() -> FeatureMatrix:
+    """Replaces the process-local snapshot with one built now, e.g. after the collection was reseeded."""
+    with building:
+        return buildSnapshot()
@@ -0,0 +1,121 @@
+from bson.objectid import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+
+from ..metrics import WRITEBACK_BATCH
+from ..models import Student
+
+
+class WriteBackResult:
+
+    def __init__(self):
+        self.matched = 0
+        self.modified = 0
+        self.skipped = 0
+
+    def asDict(self) -> dict:
+        return {
+            'matched': self.matched,
+            'modified': self.modified,
+            'skipped': self.skipped,
+        }
+
+    def asHeaders(self) -> dict:
+        return {
+            'X-Writeback-Matched': str(self.matched),
+            'X-Writeback-Modified': str(self.modified),
+            'X-Writeback-Skipped': str(self.skipped),
+        }
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def bulkSet(updates, field, report, chunkSize = None) -> WriteBackResult:
+    """Sends (studentId, [ids]) pairs as chunked unordered $set updates on `field`."""
+    chunkSize = chunkSize or getattr(settings, 'INFERENCE_WRITEBACK_CHUNK_SIZE', 1000)
+    collection = Student._get_collection()
+
+    for chunk in chunked(updates, chunkSize):
+        operations = [
+            UpdateOne({'_id': studentId}, {'$set': {field: list(ids)}, '$inc': {'version': 1}})
+            for studentId, ids in chunk
+        ]
+        WRITEBACK_BATCH.labels(field).observe(len(operations))
+        result = collection.bulk_write(operations, ordered=False)
+        report.matched += result.matched_count
+        report.modified += result.modified_count
+
+    return report
+
+def writeBack(results, field, chunkSize = None, scope = None) -> WriteBackResult:
+    """
+    Stores inferred references on `field` ('states' or 'behaviors') for an
+    iterable of (studentId, [ids]) pairs, skipping students whose set is unchanged.
+    `scope` is the query of the students the inference read: those holding ids
+    on `field` but missing from `results` are emptied, as re-inferring them would.
+    """
+    chunkSize = chunkSize or getattr(settings, 'INFERENCE_WRITEBACK_CHUNK_SIZE', 1000)
+    collection = Student._get_collection()
+    report = WriteBackResult()
+    inferred = set()
+
+    for chunk in chunked(results, chunkSize):
+        current = {
+            student['_id']: set(student.get(field) or [])
+            for student in collection.find({'_id': {'$in': [studentId for studentId, _ in chunk]}}, {field: 1})
+        }
+
+        updates = []
+        for studentId, ids in chunk:
+            inferred.add(studentId)
+            if studentId in current and current[studentId] == set(ids):
+                report.skipped += 1
+                continue
+
+            updates.append((studentId, ids))
+
+        bulkSet(updates, field, report, chunkSize)
+
+    if scope is not None:
+        stale = collection.find({'$and': [scope, {field + '.0': {'$exists': True}}]}, {'_id': 1})
+        bulkSet(((student['_id'], []) for student in stale if student['_id'] not in inferred), field, report, chunkSize)
+
+    return report
+
+def versionTotals(query, field) -> dict:
+    totals = list(Student._get_collection().aggregate([
+        {'$match': query},
+        {'$group': {
+            '_id': None,
+            'version': {'$sum': {'$ifNull': ['$version', 0]}},
+            'students': {'$sum': {'$cond': [{'$gt': [{'$size': {'$ifNull': ['$' + field, []]}}, 0]}, 1, 0]}},
+        }},
+    ]))
+    return totals[0] if totals else {'version': 0, 'students': 0}
+
+def mergeBack(engine, field, idStudent = None) -> dict:
+    """
+    Infers and stores `field` server side with the engine's $merge pipeline.
+    $merge reports nothing back, so `modified` is the growth of the student versions
+    around the run (other writes to the same students during it are counted too)
+    and `students` the students holding at least one id on `field` afterwards.
+    """
+    query = {'_id': ObjectId(idStudent)} if idStudent else {}
+
+    before = versionTotals(query, field)
+    engine.merge(idStudent=idStudent)
+    after = versionTotals(query, field)
+
+    return {
+        'modified': after['version'] - before['version'],
+        'students': after['students'],
+    }
@@ -0,0 +1,155 @@
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .layouts import featuresUpdate
+from .featuretypes import featureTypes, coerceValue
+from .models import Student
+from .inference.writeback import chunked
+
+
+class IngestionResult:
+
+    def __init__(self, received):
+        self.received = received
+        self.applied = 0
+        self.matched = 0
+        self.modified = 0
+        self.errors = []
+        self.touched = []
+
+    def fail(self, index, student, errors):
+        self.errors.append({'index': index, 'student': student, 'errors': errors})
+
+    def asDict(self) -> dict:
+        return {
+            'received': self.received,
+            'applied': self.applied,
+            'matched': self.matched,
+            'modified': self.modified,
+            'errors': sorted(self.errors, key=lambda error: error['index']),
+        }
+
+
+def parseId(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+def parseRecord(record) -> tuple:
+    """Returns (studentId, [(featureId, value)], errors) for one `{student, features}` record."""
+    if not isinstance(record, dict):
+        return None, [], {'non_field_errors': ['Expected an object with "student" and "features".']}
+
+    errors = {}
+    studentId = parseId(record.get('student'))
+    if studentId is None:
+        errors['student'] = [f'Invalid pk "{record.get("student")}" - not a valid ObjectId.']
+
+    features = record.get('features')
+    if not isinstance(features, list):
+        errors['features'] = ['Expected a list of items.']
+        return studentId, [], errors
+
+    pairs, featureErrors = [], []
+    for item in features:
+        featureId = parseId(item.get('feature')) if isinstance(item, dict) else None
+        if featureId is None:
+            featureErrors.append({'feature': [f'Invalid pk "{item.get("feature") if isinstance(item, dict) else item}" - not a valid ObjectId.']})
+            continue
+
+        pairs.append((featureId, item.get('value')))
+        featureErrors.append({})
+
+    if any(featureErrors):
+        errors['features'] = featureErrors
+
+    return studentId, pairs, errors
+
+def existingIds(document, ids) -> set:
+    if not ids:
+        return set()
+
+    return {item['_id'] for item in document._get_collection().find({'_id': {'$in': list(ids)}}, {'_id': 1})}
+
+def ingestFeatures(records, chunkSize = None) -> IngestionResult:
+    """
+    Replaces the features of many students, as `StudentFeatureView.post` does for one.
+    Records are validated with one query per collection and chunk, and written with
+    unordered bulk_writes; invalid records are reported without failing the others.
+    When a student appears more than once, its last record wins.
+    """
+    chunkSize = chunkSize or getattr(settings, 'INGEST_CHUNK_SIZE', 1000)
+    result = IngestionResult(len(records))
+
+    parsed = {}
+    for index, record in enumerate(records):
+        studentId, pairs, errors = parseRecord(record)
+        if errors:
+            result.fail(index, record.get('student') if isinstance(record, dict) else None, errors)
+            continue
+
+        parsed.pop(studentId, None)
+        parsed[studentId] = (index, pairs)
+
+    collection = Student._get_collection()
+
+    for chunk in chunked(parsed.items(), chunkSize):
+        students = existingIds(Student, [studentId for studentId, _ in chunk])
+        # Existing features with their types, in one query
+        features = featureTypes({featureId for _, (_, pairs) in chunk for featureId, _ in pairs})
+
+        operations, applied = [], []
+        for studentId, (index, pairs) in chunk:
+            if studentId not in students:
+                result.fail(index, str(studentId), {'student': [f'Invalid pk "{studentId}" - object does not exist.']})
+                continue
+
+            featureErrors = [
+                {'feature': [f'Invalid pk "{featureId}" - object does not exist.']} if featureId not in features else {}
+                for featureId, _ in pairs
+            ]
+            if any(featureErrors):
+                result.fail(index, str(studentId), {'features': featureErrors})
+                continue
+
+            coerced, valueErrors = [], []
+            for featureId, value in pairs:
+                try:
+                    coerced.append((featureId, coerceValue(features[featureId], value)))
+                    valueErrors.append({})
+                except ValueError as e:
+                    valueErrors.append({'value': [str(e)]})
+
+            if any(valueErrors):
+                result.fail(index, str(studentId), {'features': valueErrors})
+                continue
+
+            operations.append(UpdateOne({'_id': studentId}, {**featuresUpdate(coerced), '$inc': {'version': 1}}))
+            applied.append((studentId, index))
+
+        if not operations:
+            continue
+
+        failed = set()
+        try:
+            written = collection.bulk_write(operations, ordered=False)
+            result.matched += written.matched_count
+            result.modified += written.modified_count
+        except BulkWriteError as e:
+            result.matched += e.details.get('nMatched', 0)
+            result.modified += e.details.get('nModified', 0)
+            for error in e.details.get('writeErrors', []):
+                studentId, index = applied[error['index']]
+                failed.add(studentId)
+                result.fail(index, str(studentId), {'non_field_errors': [error.get('errmsg')]})
+
+        for studentId, _ in applied:
+            if studentId not in failed:
+                result.applied += 1
+                result.touched.append(studentId)
+
+    return result
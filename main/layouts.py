@@ -0,0 +1,67 @@
+from bson.objectid import ObjectId
+from django.conf import settings
+
+from .inference.rules import TESTS
+
+# Student features are stored either as the `features` list of {feature, value}
+# or as `featureMap`, keyed by the feature id string
+LIST = 'list'
+MAP = 'map'
+LAYOUTS = [LIST, MAP]
+
+FEATURE_FIELDS = {'features': 1, 'featureMap': 1}
+
+
+def featureLayout() -> str:
+    return getattr(settings, 'STUDENT_FEATURE_LAYOUT', LIST)
+
+def studentFeatures(student) -> list:
+    """`{feature, value}` items of a raw student document in either layout."""
+    featureMap = student.get('featureMap')
+    if featureMap:
+        return [{'feature': ObjectId(key), 'value': value} for key, value in featureMap.items()]
+    return student.get('features') or []
+
+def featuresUpdate(pairs, layout = None) -> dict:
+    """Update that replaces every feature of a student with (featureId, value) pairs."""
+    if (layout or featureLayout()) == MAP:
+        return {'$set': {'featureMap': {str(featureId): value for featureId, value in pairs}, 'features': []}}
+
+    return {
+        '$set': {'features': [{'feature': featureId, 'value': value} for featureId, value in pairs]},
+        '$unset': {'featureMap': ''},
+    }
+
+def featureQuery(featureIds, layout = None) -> dict:
+    """Students holding any of `featureIds`. In the map layout not yet migrated students are matched too."""
+    featureIds = list(featureIds)
+    query = {'features.feature': {'$in': featureIds}}
+    if (layout or featureLayout()) == LIST:
+        return query
+
+    return {'$or': [query] + [{f'featureMap.{featureId}': {'$exists': True}} for featureId in featureIds]}
+
+def ruleQuery(featureId, operator, base) -> dict:
+    """
+    Students whose value of `featureId` passes `operator` against `base`. With typed
+    values this is served by the features.feature + features.value index (or the
+    featureMap wildcard index). Query operators only compare values of the same type.
+    """
+    condition = {f'${operator}': base}
+    query = {'features': {'$elemMatch': {'feature': featureId, 'value': condition}}}
+    if featureLayout() == LIST:
+        return query
+
+    return {'$or': [query, {f'featureMap.{featureId}': condition}]}
+
+def stateQuery(state) -> dict:
+    """
+    Students currently satisfying every rule of a raw `State` document, one
+    $elemMatch per rule. None when the state can never match, as in inference:
+    it has no rules or an unknown operator.
+    """
+    rules = state.get('features') or []
+    if not rules or any(rule.get('operator') not in TESTS for rule in rules):
+        return None
+
+    return {'$and': [ruleQuery(rule.get('feature'), rule['operator'], rule.get('base')) for rule in rules]}
@@ -0,0 +1,136 @@
+import csv
+import json
+import statistics
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.test import APIRequestFactory
+
+from main import views
+from main.models import Student
+from main.seeding import useDatabase, clearCollections, seedCollections
+from main.inference.engines import STATE_ENGINES, BEHAVIOR_ENGINES, PartitionedEngine
+from main.inference.snapshot import rebuildSnapshot
+from main.inference.writeback import writeBack
+from main.management.commands.seed import addSeedArguments, seedOptions
+
+COLUMNS = ['students', 'name', 'runs', 'rows', 'min', 'median', 'mean', 'max']
+
+LIST_ENDPOINTS = [
+    ('GET /api/students/?after=', views.StudentViews, {'after': ''}),
+    ('GET /api/students/?stream=ndjson', views.StudentViews, {'stream': 'ndjson'}),
+    ('GET /api/features/', views.FeatureViews, {}),
+    ('GET /api/states/', views.StateViews, {}),
+    ('GET /api/behaviors/', views.BehaviorViews, {}),
+]
+
+
+def measure(function, repeat, setup = None) -> dict:
+    """Runs `function` `repeat` times and returns its timings in milliseconds and the rows it produced."""
+    timings, rows = [], 0
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        rows = function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'runs': repeat,
+        'rows': rows,
+        'min': round(min(timings), 3),
+        'median': round(statistics.median(timings), 3),
+        'mean': round(statistics.mean(timings), 3),
+        'max': round(max(timings), 3),
+    }
+
+def consume(rows) -> int:
+    return sum(1 for _ in rows)
+
+def requestView(view, params) -> int:
+    response = view.as_view()(APIRequestFactory().get('/', params))
+    if response.streaming:
+        return consume(b''.join(response.streaming_content).splitlines())
+
+    response.render()
+    data = response.data
+    return len(data['results'] if isinstance(data, dict) else data)
+
+def inferredIds(rows, field) -> list:
+    return [(row['_id'], [item['_id'] for item in row[field]]) for row in rows]
+
+
+class Command(BaseCommand):
+    help = (
+        'Seeds a benchmark database at each --sizes student count and times the inference engines, '
+        'the write-back and the list endpoints. Results are written as JSON or CSV.'
+    )
+
+    def add_arguments(self, parser):
+        addSeedArguments(parser)
+        parser.add_argument('--sizes', default='1000,10000', help='Comma separated student counts to benchmark.')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per measurement.')
+        parser.add_argument('--format', choices=['json', 'csv'], default='json')
+        parser.add_argument('--output', help='File to write the results to instead of stdout.')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError('--sizes must be a comma separated list of integers')
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+
+        useDatabase(options['database'])
+
+        results = []
+        for size in sizes:
+            clearCollections()
+            seedCollections(students=size, **seedOptions(options))
+            self.stderr.write(f'{size} students seeded in {options["database"]}')
+
+            for name, timing in self.run(options['repeat']):
+                results.append({'students': size, 'name': name, **timing})
+                self.stderr.write(f'  {name}: {timing["median"]} ms median, {timing["rows"]} rows')
+
+        self.write(results, options['format'], options['output'])
+
+    def run(self, repeat):
+        collection = Student._get_collection()
+
+        for name, engine in STATE_ENGINES.items():
+            if name == 'snapshot':
+                # Built from this size's population right before it is timed, never within its runs
+                yield 'snapshot:build', measure(lambda: rebuildSnapshot().size, repeat)
+            yield f'states:{name}', measure(lambda: consume(engine().infer()), repeat)
+            yield f'states:{name}:parallel', measure(lambda: consume(PartitionedEngine(engine()).infer()), repeat)
+
+        states = inferredIds(STATE_ENGINES['aggregation']().infer(), 'states')
+        yield 'writeback:states', measure(
+            lambda: writeBack(states, 'states').modified,
+            repeat,
+            setup=lambda: collection.update_many({}, {'$set': {'states': []}})
+        )
+        yield 'writeback:states:unchanged', measure(lambda: writeBack(states, 'states').skipped, repeat)
+
+        for name, engine in BEHAVIOR_ENGINES.items():
+            yield f'behaviors:{name}', measure(lambda: consume(engine().infer()), repeat)
+            yield f'behaviors:{name}:parallel', measure(lambda: consume(PartitionedEngine(engine()).infer()), repeat)
+
+        for name, view, params in LIST_ENDPOINTS:
+            yield name, measure(lambda: requestView(view, params), repeat)
+
+    def write(self, results, format, output):
+        stream = open(output, 'w', newline='') if output else sys.stdout
+        try:
+            if format == 'csv':
+                writer = csv.DictWriter(stream, fieldnames=COLUMNS)
+                writer.writeheader()
+                writer.writerows(results)
+            else:
+                json.dump(results, stream, indent=2)
+                stream.write('\n')
+        finally:
+            if output:
+                stream.close()
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from main.featuretypes import coerceValue
+from main.layouts import LIST, MAP, FEATURE_FIELDS, studentFeatures, featuresUpdate, featureQuery
+from main.models import Feature, Student, State
+from main.inference.catalog import bumpCatalogVersion
+from main.inference.writeback import chunked
+
+
+def coercePairs(items, field, types) -> tuple:
+    """Returns ([(featureId, value)], changed, failures) for `{feature, <field>}` items."""
+    pairs, changed, failures = [], False, 0
+    for item in items:
+        value = item.get(field)
+        try:
+            coerced = coerceValue(types.get(item.get('feature')), value)
+        except ValueError:
+            coerced = value
+            failures += 1
+
+        changed = changed or type(coerced) is not type(value) or coerced != value
+        pairs.append((item.get('feature'), coerced))
+
+    return pairs, changed, failures
+
+
+class Command(BaseCommand):
+    help = (
+        'Coerces stored student values and state bases to the type of their feature. '
+        'Run it after setting or changing Feature.type. Values that cannot be coerced are kept and counted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only count the documents that would change.')
+        parser.add_argument('--chunk-size', type=int, default=getattr(settings, 'INGEST_CHUNK_SIZE', 1000))
+
+    def handle(self, *args, **options):
+        types = {
+            feature['_id']: feature['type']
+            for feature in Feature._get_collection().find({'type': {'$ne': None}}, {'type': 1})
+        }
+        if not types:
+            self.stdout.write('No typed features.')
+            return
+
+        students, studentFailures = self.coerceStudents(types, options)
+        states, stateFailures = self.coerceStates(types, options)
+
+        if states and not options['dry_run']:
+            bumpCatalogVersion()
+
+        verb = 'would change' if options['dry_run'] else 'changed'
+        self.stdout.write(self.style.SUCCESS(f'{students} students and {states} states {verb}.'))
+        if studentFailures or stateFailures:
+            self.stdout.write(self.style.WARNING(
+                f'{studentFailures} student values and {stateFailures} state bases could not be coerced.'
+            ))
+
+    def coerceStudents(self, types, options) -> tuple:
+        collection = Student._get_collection()
+        changed = failures = 0
+
+        # Students stored in either layout, whatever the configured one is
+        cursor = collection.find(featureQuery(types.keys(), MAP), FEATURE_FIELDS, batch_size=options['chunk_size'])
+        for chunk in chunked(cursor, options['chunk_size']):
+            operations = []
+            for student in chunk:
+                pairs, modified, failed = coercePairs(studentFeatures(student), 'value', types)
+                failures += failed
+                if modified:
+                    # The stored layout is kept
+                    layout = MAP if student.get('featureMap') else LIST
+                    operations.append(UpdateOne({'_id': student['_id']}, {**featuresUpdate(pairs, layout), '$inc': {'version': 1}}))
+
+            changed += len(operations)
+            if operations and not options['dry_run']:
+                collection.bulk_write(operations, ordered=False)
+
+        return changed, failures
+
+    def coerceStates(self, types, options) -> tuple:
+        collection = State._get_collection()
+        operations, failures = [], 0
+
+        for state in collection.find({'features.feature': {'$in': list(types)}}, {'features': 1}):
+            rules = state.get('features') or []
+            pairs, modified, failed = coercePairs(rules, 'base', types)
+            failures += failed
+            if modified:
+                features = [{**rule, 'base': base} for rule, (_, base) in zip(rules, pairs)]
+                operations.append(UpdateOne({'_id': state['_id']}, {'$set': {'features': features}}))
+
+        if operations and not options['dry_run']:
+            collection.bulk_write(operations, ordered=False)
+
+        return len(operations), failures
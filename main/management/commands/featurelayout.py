@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from main.layouts import LAYOUTS, MAP, featureLayout, studentFeatures, featuresUpdate
+from main.models import Student
+from main.inference.writeback import chunked
+
+
+class Command(BaseCommand):
+    help = (
+        'Converts stored student features between the list and map layouts. Switch '
+        'STUDENT_FEATURE_LAYOUT to "map" before migrating to it: that layout also reads '
+        'students that are not converted yet, the list layout does not.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=LAYOUTS, help='Target layout. Defaults to STUDENT_FEATURE_LAYOUT.')
+        parser.add_argument('--chunk-size', type=int, default=getattr(settings, 'INGEST_CHUNK_SIZE', 1000))
+
+    def handle(self, *args, **options):
+        layout = options['to'] or featureLayout()
+        collection = Student._get_collection()
+
+        # Only students still stored in the other layout
+        if layout == MAP:
+            query = {'features.0': {'$exists': True}}
+        else:
+            query = {'featureMap': {'$exists': True}}
+
+        converted = 0
+        students = collection.find(query, {'features': 1, 'featureMap': 1}, batch_size=options['chunk_size'])
+        for chunk in chunked(students, options['chunk_size']):
+            operations = [
+                UpdateOne(
+                    {'_id': student['_id']},
+                    featuresUpdate([(feature['feature'], feature.get('value')) for feature in studentFeatures(student)], layout)
+                ) for student in chunk
+            ]
+            converted += collection.bulk_write(operations, ordered=False).modified_count
+
+        self.stdout.write(self.style.SUCCESS(f'{converted} students converted to the {layout} layout.'))
+        if layout != featureLayout():
+            self.stdout.write(self.style.WARNING(f'STUDENT_FEATURE_LAYOUT is still "{featureLayout()}".'))
@@ -0,0 +1,168 @@
+from bson.objectid import ObjectId
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import Student, Feature, State, Behavior, InferenceJob
+from main.layouts import featureLayout, featureQuery, stateQuery
+from main.pipelines.student import innferStates, innferBehaviors
+
+DOCUMENTS = [Feature, Student, State, Behavior, InferenceJob]
+
+
+def planStages(plan) -> list:
+    """Flattens a winning plan into (stage, indexName) pairs."""
+    if not plan:
+        return []
+
+    # Slot based engine plans nest the classic plan under queryPlan
+    plan = plan.get('queryPlan', plan)
+    stages = [(plan.get('stage'), plan.get('indexName'))]
+
+    if 'inputStage' in plan:
+        stages += planStages(plan['inputStage'])
+    for inputStage in plan.get('inputStages', []):
+        stages += planStages(inputStage)
+
+    return stages
+
+def describeAccess(stages) -> str:
+    names = [stage for stage, _ in stages]
+    if 'COLLSCAN' in names:
+        return 'COLLSCAN'
+
+    indexes = [index for stage, index in stages if stage == 'IXSCAN' and index]
+    if indexes:
+        return 'IXSCAN ' + ', '.join(indexes)
+
+    return ' > '.join(name for name in names if name) or '-'
+
+def cursorStage(explain) -> dict:
+    stats = explain.get('executionStats', {})
+    return {
+        'stage': '$cursor',
+        'access': describeAccess(planStages(explain.get('queryPlanner', {}).get('winningPlan'))),
+        'millis': stats.get('executionTimeMillis', stats.get('executionTimeMillisEstimate')),
+        'returned': stats.get('nReturned'),
+    }
+
+def aggregationStages(explain) -> list:
+    """Per stage access path and timing from an aggregate explain in executionStats verbosity."""
+    if 'stages' not in explain:
+        # The whole pipeline was pushed down into the query layer
+        return [cursorStage(explain)]
+
+    report = []
+    for stage in explain['stages']:
+        name = next(key for key in stage if key.startswith('$'))
+
+        if name == '$cursor':
+            entry = cursorStage(stage['$cursor'])
+        else:
+            entry = {'stage': name, 'access': '-'}
+            if stage.get('collectionScans'):
+                entry['access'] = 'COLLSCAN'
+            elif stage.get('indexesUsed'):
+                entry['access'] = 'IXSCAN ' + ', '.join(stage['indexesUsed'])
+
+        entry['millis'] = stage.get('executionTimeMillisEstimate', entry.get('millis'))
+        entry['returned'] = stage.get('nReturned', entry.get('returned'))
+        report.append(entry)
+
+    return report
+
+
+class Command(BaseCommand):
+    help = (
+        'Checks the indexes declared in main.models against MongoDB, optionally creates or drops them, '
+        'and explains the inference pipelines and list queries.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--create', action='store_true', help='Create missing indexes.')
+        parser.add_argument('--drop-extra', action='store_true', help='Drop indexes that are not declared in the models.')
+        parser.add_argument('--explain', action='store_true', help='Explain the inference pipelines and list queries.')
+        parser.add_argument(
+            '--student',
+            help='Explain the pipelines for a single student. Without it explain runs them for the whole population.'
+        )
+
+    def handle(self, *args, **options):
+        drift = False
+
+        for document in DOCUMENTS:
+            if options['create']:
+                document.ensure_indexes()
+
+            compared = document.compare_indexes()
+            collection = document._get_collection()
+
+            for index in compared['extra']:
+                if options['drop_extra']:
+                    collection.drop_index(index)
+                    self.stdout.write(f'{collection.name}: dropped {self.formatIndex(index)}')
+                else:
+                    drift = True
+                    self.stdout.write(self.style.WARNING(f'{collection.name}: extra {self.formatIndex(index)}'))
+
+            for index in compared['missing']:
+                drift = True
+                self.stdout.write(self.style.ERROR(f'{collection.name}: missing {self.formatIndex(index)}'))
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('Indexes match the models.'))
+
+        if options['explain']:
+            self.explain(options['student'])
+
+    def formatIndex(self, index) -> str:
+        return ', '.join(f'{field}: {direction}' for field, direction in index)
+
+    def explain(self, idStudent):
+        if idStudent and not ObjectId.is_valid(idStudent):
+            raise CommandError(f'"{idStudent}" is not a valid ObjectId')
+
+        database = Student._get_db()
+        for name, pipeline in [
+            ('innferStates', innferStates(idStudent=idStudent, layout=featureLayout())),
+            ('innferBehaviors', innferBehaviors(idStudent=idStudent)),
+        ]:
+            explain = database.command({
+                'explain': {'aggregate': Student._get_collection_name(), 'pipeline': pipeline, 'cursor': {}},
+                'verbosity': 'executionStats',
+            })
+            self.report(name, aggregationStages(explain))
+
+        for name, document, query in self.listQueries():
+            cursor = document._get_collection().find(query)
+            if document is Student:
+                cursor = cursor.sort('_id').limit(getattr(settings, 'PAGE_SIZE', 100))
+            self.report(name, [cursorStage(cursor.explain())])
+
+    def listQueries(self) -> list:
+        queries = [('students page', Student, {})]
+
+        for name, document in [('features by domain', Feature), ('states by domain', State)]:
+            sample = document._get_collection().find_one({'domain': {'$exists': True}}, {'domain': 1})
+            if sample:
+                queries.append((name, document, {'domain': sample['domain']}))
+
+        feature = Feature._get_collection().find_one({}, {'_id': 1})
+        if feature:
+            queries.append(('students by feature', Student, featureQuery([feature['_id']])))
+
+        state = State._get_collection().find_one({'features.0': {'$exists': True}}, {'features': 1})
+        if state and stateQuery(state):
+            queries.append(('students in state', Student, stateQuery(state)))
+
+        return queries
+
+    def report(self, name, stages):
+        self.stdout.write(self.style.MIGRATE_HEADING(name))
+        for stage in stages:
+            millis = stage.get('millis')
+            line = f"  {stage['stage']:<14} {stage['access']:<40} {'-' if millis is None else millis} ms"
+            if stage.get('returned') is not None:
+                line += f", {stage['returned']} returned"
+
+            style = self.style.WARNING if stage['access'] == 'COLLSCAN' else (lambda text: text)
+            self.stdout.write(style(line))
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.seeding import DISTRIBUTIONS, useDatabase, clearCollections, seedCollections
+
+
+def addSeedArguments(parser):
+    parser.add_argument('--students', type=int, default=1000)
+    parser.add_argument('--features', type=int, default=20, help='Features in the catalog.')
+    parser.add_argument('--features-per-student', type=int, default=10)
+    parser.add_argument('--states', type=int, default=20)
+    parser.add_argument('--features-per-state', type=int, default=2)
+    parser.add_argument('--behaviors', type=int, default=10)
+    parser.add_argument('--states-per-behavior', type=int, default=3)
+    parser.add_argument('--optional-ratio', type=float, default=0.2, help='Share of behavior states that are not required.')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='uniform', help='Distribution of student feature values.')
+    parser.add_argument('--value-max', type=int, default=10, help='Feature values and rule bases are drawn from [0, value-max].')
+    parser.add_argument('--seed', type=int, help='Random seed, for reproducible data sets.')
+    parser.add_argument(
+        '--database',
+        default=getattr(settings, 'BENCHMARK_DATABASE', 'vibes_bench'),
+        help='Database to write to. Defaults to BENCHMARK_DATABASE, never the application database.'
+    )
+
+def seedOptions(options) -> dict:
+    return {
+        'features': options['features'],
+        'featuresPerStudent': options['features_per_student'],
+        'states': options['states'],
+        'featuresPerState': options['features_per_state'],
+        'behaviors': options['behaviors'],
+        'statesPerBehavior': options['states_per_behavior'],
+        'optionalRatio': options['optional_ratio'],
+        'distribution': options['distribution'],
+        'valueMax': options['value_max'],
+        'seed': options['seed'],
+    }
+
+
+class Command(BaseCommand):
+    help = 'Fills the Feature, State, Behavior and Student collections of a benchmark database with synthetic data.'
+
+    def add_arguments(self, parser):
+        addSeedArguments(parser)
+        parser.add_argument('--append', action='store_true', help='Keep the documents already in the database.')
+
+    def handle(self, *args, **options):
+        if options['students'] < 0 or options['features'] < 1:
+            raise CommandError('--students must be >= 0 and --features >= 1')
+
+        useDatabase(options['database'])
+        if not options['append']:
+            clearCollections()
+
+        counts = seedCollections(students=options['students'], **seedOptions(options))
+        self.stdout.write(self.style.SUCCESS(
+            f"{options['database']}: " + ', '.join(f'{count} {name}' for name, count in counts.items())
+        ))
@@ -0,0 +1,68 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess
+
+# Metric values live in PROMETHEUS_MULTIPROC_DIR when it is set, so every worker
+# process of the server contributes to the same scrape.
+
+REQUEST_LATENCY = Histogram(
+    'api_request_duration_seconds',
+    'Latency of API requests by route.',
+    ['method', 'route', 'status'],
+)
+
+INFERENCE_DURATION = Histogram(
+    'inference_run_duration_seconds',
+    'Duration of inference runs.',
+    ['kind', 'engine', 'mode'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+
+INFERENCE_STUDENTS = Histogram(
+    'inference_run_students',
+    'Students returned by an inference run.',
+    ['kind', 'engine', 'mode'],
+    buckets=(1, 10, 100, 1000, 10000, 100000, 1000000),
+)
+
+WRITEBACK_BATCH = Histogram(
+    'inference_writeback_batch_size',
+    'Updates per write-back bulk_write.',
+    ['field'],
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 5000),
+)
+
+MONGO_COMMANDS = Histogram(
+    'mongodb_command_duration_seconds',
+    'Duration of MongoDB commands by command name and outcome.',
+    ['command', 'outcome'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+CACHE_REQUESTS = Counter(
+    'inference_cache_requests_total',
+    'Single-student inference cache lookups by result.',
+    ['result'],
+)
+
+
+@contextmanager
+def inferenceRun(kind, engine, mode):
+    """Times the block as one inference run; set run['students'] to the students it produced."""
+    run = {'students': 0}
+    start = time.perf_counter()
+    try:
+        yield run
+    finally:
+        INFERENCE_DURATION.labels(kind, engine, mode).observe(time.perf_counter() - start)
+        INFERENCE_STUDENTS.labels(kind, engine, mode).observe(run['students'])
+
+def exposition() -> bytes:
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+
+    return generate_latest(REGISTRY)
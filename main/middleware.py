@@ -0,0 +1,91 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+
+from .metrics import REQUEST_LATENCY
+from .monitoring import RequestTimings, current
+
+logger = logging.getLogger('main.timing')
+
+
+def slowThreshold(route) -> float:
+    thresholds = getattr(settings, 'SLOW_REQUEST_THRESHOLDS', {})
+    return thresholds.get(route, thresholds.get('default', 1000))
+
+def serverTiming(timings, total) -> str:
+    entries = [f'db;dur={timings.dbMillis:.1f};desc="{timings.commands} commands"']
+    entries += [f'{name};dur={millis:.1f}' for name, millis in timings.phases.items()]
+    entries.append(f'total;dur={total:.1f}')
+    return ', '.join(entries)
+
+
+class ServerTimingMiddleware:
+    """
+    Times the database commands, the view body and the response rendering of each
+    request, and reports them as a Server-Timing header and a structured log line.
+    Requests slower than SLOW_REQUEST_THRESHOLDS for their route are logged as warnings.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+
+        total = (time.perf_counter() - start) * 1000
+
+        # Responses without a template phase were finished by the time the view returned
+        if 'view' not in timings.phases and hasattr(request, 'viewStartedAt'):
+            timings.phases['view'] = (time.perf_counter() - request.viewStartedAt) * 1000
+
+        response['Server-Timing'] = serverTiming(timings, total)
+        self.log(request, response, timings, total)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.viewStartedAt = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        timings = current.get()
+        if timings is None or not hasattr(request, 'viewStartedAt'):
+            return response
+
+        renderStartedAt = time.perf_counter()
+        timings.phases['view'] = (renderStartedAt - request.viewStartedAt) * 1000
+
+        def rendered(response):
+            timings.phases['render'] = (time.perf_counter() - renderStartedAt) * 1000
+
+        response.add_post_render_callback(rendered)
+        return response
+
+    def log(self, request, response, timings, total):
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match else request.path
+        threshold = slowThreshold(route)
+
+        # Unresolved paths share one label so scanners cannot grow the series
+        REQUEST_LATENCY.labels(request.method, route if match else 'unmatched', response.status_code).observe(total / 1000)
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status_code,
+            'total_ms': round(total, 1),
+            'db_ms': round(timings.dbMillis, 1),
+            'db_commands': timings.commands,
+            'db_failed': timings.failed,
+            **{f'{name}_ms': round(millis, 1) for name, millis in timings.phases.items()},
+            'slow': total > threshold,
+        }
+
+        logger.log(logging.WARNING if record['slow'] else logging.INFO, json.dumps(record))
@@ -1,10 +1,22 @@
 from backend import settings
 from mongoengine import Document, fields, connect, EmbeddedDocument
+from pymongo import monitoring
+
+from .monitoring import CommandTimer
+
+FEATURE_TYPES = ('numeric', 'boolean', 'categorical')
 
 class Feature(Document):
     name = fields.StringField(max_length=150)
     domain = fields.StringField(max_length=150)
     unit = fields.StringField(max_length=150)
+    # Student values and state bases of typed features are coerced to it on write
+    type = fields.StringField(choices=FEATURE_TYPES, null=True)
+
+    meta = {
+        'indexes': ['domain'],
+        'auto_create_index': False,
+    }
 
     class Meta:
         name = "feature"
@@ -23,8 +35,18 @@ class Student(Document):
     age = fields.IntField()
     gender = fields.StringField(max_length=2)
     features = fields.ListField(fields.EmbeddedDocumentField(StudentFeature))
+    # Feature values keyed by feature id, used instead of `features` when STUDENT_FEATURE_LAYOUT is 'map'
+    featureMap = fields.MapField(fields.DynamicField())
     states = fields.ListField(fields.ReferenceField("State"))
     behaviors = fields.ListField(fields.ReferenceField("Behavior"))
+    # Bumped on every write to the student, keys the cached inference results
+    version = fields.IntField(default=0)
+
+    # Used by incremental re-inference to find the students a rule edit affects
+    meta = {
+        'indexes': [('features.feature', 'features.value'), 'featureMap.$**', 'states', 'behaviors'],
+        'auto_create_index': False,
+    }
 
     def update_features(self, features):
         self.features = features
@@ -46,6 +68,12 @@ class State(Document):
     domain = fields.StringField(max_length=150)
     features = fields.ListField(fields.EmbeddedDocumentField(StateFeature))
 
+    # features.feature backs the $lookup in joinStates
+    meta = {
+        'indexes': ['features.feature', 'domain'],
+        'auto_create_index': False,
+    }
+
     class Meta:
 
         name =  "state"
@@ -62,10 +90,57 @@ class Behavior(Document):
     domain = fields.StringField(max_length=150)
     states = fields.ListField(fields.EmbeddedDocumentField(BehaviorState))
 
+    # states.state backs the $lookup in joinBehaviors
+    meta = {
+        'indexes': ['states.state', 'domain'],
+        'auto_create_index': False,
+    }
 
     class Meta:
         name =  "behavior"
 
+class InferenceJob(Document):
+    # Full-population inference run in the background, shared by every web worker
+    # 'state'/'behavior' jobs re-infer one edited rule for the students it reads
+    kind = fields.StringField(choices=('states', 'behaviors', 'state', 'behavior'), required=True)
+    engine = fields.StringField()
+    target = fields.ObjectIdField()
+    sources = fields.ListField(fields.ObjectIdField())
+    status = fields.StringField(choices=('pending', 'running', 'done', 'failed'), default='pending')
+    total = fields.IntField(default=0)
+    processed = fields.IntField(default=0)
+    matched = fields.IntField(default=0)
+    modified = fields.IntField(default=0)
+    skipped = fields.IntField(default=0)
+    error = fields.StringField()
+    createdAt = fields.DateTimeField()
+    startedAt = fields.DateTimeField()
+    updatedAt = fields.DateTimeField()
+    finishedAt = fields.DateTimeField()
+
+    meta = {
+        'indexes': ['-createdAt'],
+        'auto_create_index': False,
+    }
+
+    class Meta:
+        name = "inference_job"
+
+class CatalogVersion(Document):
+    # Bumped on every State/Behavior write so each worker can tell its cached rules are stale
+    id = fields.StringField(primary_key=True)
+    version = fields.IntField(default=0)
+
+    meta = {
+        'auto_create_index': False,
+    }
+
+    class Meta:
+        name = "catalog_version"
+
+# Must be registered before the client is created to see its commands
+monitoring.register(CommandTimer())
+
 try:
     connect(
         db=settings.DATABASES['default']['NAME'],
@@ -0,0 +1,45 @@
+import contextvars
+import threading
+
+from pymongo import monitoring
+
+from .metrics import MONGO_COMMANDS
+
+
+class RequestTimings:
+    """Database commands and phase durations (ms) collected for one request."""
+
+    def __init__(self):
+        self.commands = 0
+        self.failed = 0
+        self.dbMillis = 0.0
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def addCommand(self, micros, failed = False):
+        with self.lock:
+            self.commands += 1
+            self.failed += int(failed)
+            self.dbMillis += micros / 1000
+
+
+current = contextvars.ContextVar('requestTimings', default=None)
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Records every pymongo command, and adds it to the timings of the request that issued it, if any."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMANDS.labels(event.command_name, 'success').observe(event.duration_micros / 1e6)
+        timings = current.get()
+        if timings is not None:
+            timings.addCommand(event.duration_micros)
+
+    def failed(self, event):
+        MONGO_COMMANDS.labels(event.command_name, 'failure').observe(event.duration_micros / 1e6)
+        timings = current.get()
+        if timings is not None:
+            timings.addCommand(event.duration_micros, failed=True)
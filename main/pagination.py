@@ -0,0 +1,96 @@
+import base64
+import binascii
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+STREAM_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+def encodeCursor(id) -> str:
+    return base64.urlsafe_b64encode(ObjectId(id).binary).rstrip(b'=').decode()
+
+def decodeCursor(token) -> ObjectId:
+    try:
+        return ObjectId(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (binascii.Error, InvalidId, TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+def pageLimit(limit) -> int:
+    maxLimit = getattr(settings, 'MAX_PAGE_SIZE', 1000)
+    if not limit:
+        return getattr(settings, 'PAGE_SIZE', 100)
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError('limit must be an integer')
+
+    if limit < 1 or limit > maxLimit:
+        raise ValueError(f'limit must be between 1 and {maxLimit}')
+
+    return limit
+
+def afterCursor(queryset, token):
+    """Orders a queryset by _id and resumes it after the document encoded in `token`."""
+    queryset = queryset.order_by('id')
+    if token:
+        queryset = queryset.filter(id__gt=decodeCursor(token))
+
+    return queryset
+
+def cursorPage(request, queryset, render, limit) -> dict:
+    """One page of raw documents, `render` maps them to their output."""
+    page = list(queryset.limit(limit + 1))
+
+    next = None
+    if len(page) > limit:
+        page = page[:limit]
+        params = request.GET.copy()
+        params['after'] = encodeCursor(page[-1]['_id'])
+        params['limit'] = limit
+        next = request.build_absolute_uri('?' + params.urlencode())
+
+    return {
+        'results': render(page),
+        'next': next,
+    }
+
+def streamItems(queryset, render, format, batchSize):
+    def batches():
+        batch = []
+        for document in queryset:
+            batch.append(document)
+            if len(batch) >= batchSize:
+                yield render(batch)
+                batch = []
+
+        if batch:
+            yield render(batch)
+
+    encoder = JSONEncoder()
+
+    if format == 'ndjson':
+        for batch in batches():
+            yield ''.join(encoder.encode(item) + '\n' for item in batch)
+        return
+
+    yield '['
+    separator = ''
+    for batch in batches():
+        yield separator + ','.join(encoder.encode(item) for item in batch)
+        separator = ','
+    yield ']'
+
+def streamResponse(queryset, render, format, batchSize = None) -> StreamingHttpResponse:
+    """Streams a queryset of raw documents as a JSON array or NDJSON while reading its cursor."""
+    batchSize = batchSize or getattr(settings, 'STREAM_BATCH_SIZE', 500)
+    return StreamingHttpResponse(
+        streamItems(queryset.no_cache().batch_size(batchSize), render, format, batchSize),
+        content_type=STREAM_FORMATS[format]
+    )
@@ -1,5 +1,9 @@
 from bson.objectid import ObjectId
 
+from ..layouts import LIST, MAP
+
+OPERATORS = ['gte', 'lte', 'lt', 'gt', 'eq']
+
 def getUniqueFeatures() -> list:
     query = [
         {
@@ -87,10 +91,9 @@ def joinBehaviors(_as = "behavior") -> list:
 
 def featuresConditions(operatorPath, basePath, valuePath) -> list:
 
-    operators = ['gte', 'lte', 'lt', 'gt', 'eq']
     conditions = []
 
-    for operator in operators:
+    for operator in OPERATORS:
         conditions.append(
             {
                 '$cond': [
@@ -103,7 +106,204 @@ def featuresConditions(operatorPath, basePath, valuePath) -> list:
 
     return conditions 
 
-def innferStates(idStudent = None) -> list:
+def getFeaturePairs() -> list:
+    # {feature, value} items of either layout, so students are read during a migration too
+    query = [
+        {
+            '$addFields': {
+                'featurePairs': {
+                    '$cond': [
+                        { '$gt': [ { '$size': { '$objectToArray': { '$ifNull': [ '$featureMap', {} ] } } }, 0 ] },
+                        {
+                            '$map': {
+                                'input': { '$objectToArray': '$featureMap' },
+                                'in': {
+                                    'feature': { '$toObjectId': '$$this.k' },
+                                    'value': '$$this.v'
+                                }
+                            }
+                        },
+                        { '$ifNull': [ '$features', [] ] }
+                    ]
+                }
+            }
+        }
+    ]
+
+    return query
+
+def ruleHolds(rulePath) -> dict:
+    # Filters the rule's feature out of the student's pairs instead of unwinding them.
+    # Every occurrence of a repeated feature must pass, as in the compiled engine.
+    return {
+        '$let': {
+            'vars': {
+                'pairs': {
+                    '$filter': {
+                        'input': '$featurePairs',
+                        'as': 'pair',
+                        'cond': { '$eq': [ '$$pair.feature', rulePath + '.feature' ] }
+                    }
+                }
+            },
+            'in': {
+                '$and': [
+                    { '$gt': [ { '$size': '$$pairs' }, 0 ] },
+                    {
+                        '$allElementsTrue': [
+                            {
+                                '$map': {
+                                    'input': '$$pairs',
+                                    'as': 'pair',
+                                    'in': {
+                                        '$or': featuresConditions(
+                                            basePath=rulePath + '.base',
+                                            operatorPath=rulePath + '.operator',
+                                            valuePath='$$pair.value'
+                                        )
+                                    }
+                                }
+                            }
+                        ]
+                    }
+                ]
+            }
+        }
+    }
+
+def innferStatesByMap() -> list:
+    """States stages for the map layout: one $lookup per student and no regrouping of its features."""
+    query = getFeaturePairs()
+
+    query += [
+        {
+            '$lookup': {
+                'from': 'state',
+                'localField': 'featurePairs.feature',
+                'foreignField': 'features.feature',
+                'as': 'states'
+            }
+        },
+        {
+            '$unwind': '$states'
+        },
+        {
+            '$match': {
+                '$expr': {
+                    '$allElementsTrue': [
+                        {
+                            '$map': {
+                                'input': '$states.features',
+                                'as': 'rule',
+                                'in': ruleHolds('$$rule')
+                            }
+                        }
+                    ]
+                }
+            }
+        },
+        {
+            '$group': {
+                '_id': '$_id',
+                'alias': {
+                    '$first': '$alias'
+                },
+                'age': {
+                    '$first': '$age'
+                },
+                'gender': {
+                    '$first': '$gender'
+                },
+                'states': {
+                    '$addToSet': {
+                        '_id': '$states._id',
+                        'name': '$states.name',
+                        'domain': '$states.domain'
+                    }
+                }
+            }
+        }
+    ]
+
+    return query
+
+def studentScope(idStudent = None, match = None) -> dict:
+    """Query of the students an inference pipeline reads."""
+    conditions = []
+    if idStudent:
+        conditions.append({ '_id': ObjectId(idStudent) })
+    if match:
+        conditions.append(match)
+    return { '$and': conditions } if conditions else {}
+
+def mergeInto(field, scope = None) -> list:
+    """
+    Final stages that store the inferred ids on `field` of each student server side,
+    bumping the student version only when the set changed. Students of `scope` holding
+    ids on `field` that no longer infer any are merged with an empty set.
+    """
+    return [
+        {
+            '$project': {
+                field: {
+                    '$map': {
+                        'input': '$' + field,
+                        'in': '$$this._id'
+                    }
+                }
+            }
+        },
+        {
+            '$unionWith': {
+                'coll': 'student',
+                'pipeline': [
+                    { '$match': { '$and': [ scope or {}, { field + '.0': { '$exists': True } } ] } },
+                    { '$project': { field: { '$literal': [] } } }
+                ]
+            }
+        },
+        {
+            # An inferred student is also in the union when it held ids, with the empty set
+            '$group': {
+                '_id': '$_id',
+                field: { '$push': '$' + field }
+            }
+        },
+        {
+            '$project': {
+                field: {
+                    '$reduce': {
+                        'input': '$' + field,
+                        'initialValue': [],
+                        'in': { '$concatArrays': [ '$$value', '$$this' ] }
+                    }
+                }
+            }
+        },
+        {
+            '$merge': {
+                'into': 'student',
+                'on': '_id',
+                'whenMatched': [
+                    {
+                        '$set': {
+                            'version': {
+                                '$cond': [
+                                    { '$setEquals': [ { '$ifNull': [ '$' + field, [] ] }, '$$new.' + field ] },
+                                    '$version',
+                                    { '$add': [ { '$ifNull': [ '$version', 0 ] }, 1 ] }
+                                ]
+                            },
+                            field: '$$new.' + field
+                        }
+                    }
+                ],
+                'whenNotMatched': 'discard'
+            }
+        }
+    ]
+
+def innferStates(idStudent = None, match = None, merge = False, layout = LIST) -> list:
     query = []
 
     if idStudent:
@@ -115,6 +315,19 @@ def innferStates(idStudent = None) -> list:
             }
         ]
 
+    if match:
+        query += [
+            {
+                '$match' : match
+            }
+        ]
+
+    if layout == MAP:
+        query += innferStatesByMap()
+        if merge:
+            query += mergeInto('states', studentScope(idStudent, match))
+        return query
+
     query += getUniqueFeatures()
     query += joinStates('states')
 
@@ -123,7 +336,25 @@ def innferStates(idStudent = None) -> list:
             '$unwind' : '$states'
         },
         {
-            '$unwind' : '$states.features'
+            '$addFields': {
+                'states.ruleCount': {
+                    '$size': '$states.features'
+                }
+            }
+        },
+        {
+            '$unwind' : {
+                'path': '$states.features',
+                'includeArrayIndex': 'ruleIndex'
+            }
+        },
+        # Each student value is only checked against the rules on its own feature
+        {
+            '$match': {
+                '$expr': {
+                    '$eq': [ '$features.feature', '$states.features.feature' ]
+                }
+            }
         },
         {
             '$addFields': {
@@ -159,14 +390,24 @@ def innferStates(idStudent = None) -> list:
                 }, 
                 'features': {
                     '$push': '$featuresMatched'
+                },
+                'rules': {
+                    '$addToSet': '$ruleIndex'
+                },
+                'ruleCount': {
+                    '$first': '$states.ruleCount'
                 }
             }
         }, 
         
+        # A state holds when every one of its rules was evaluated and passed
         {
             '$match': {
                 '$expr': {
-                    '$allElementsTrue': '$features'
+                    '$and': [
+                        { '$allElementsTrue': '$features' },
+                        { '$eq': [ { '$size': '$rules' }, '$ruleCount' ] }
+                    ]
                 }
             }
         }, 
@@ -204,9 +445,12 @@ def innferStates(idStudent = None) -> list:
         }
     ]
 
+    if merge:
+        query += mergeInto('states', studentScope(idStudent, match))
+
     return query
 
-def innferBehaviors(idStudent = None) -> list:
+def innferBehaviors(idStudent = None, match = None, merge = False) -> list:
 
     query = []
     if idStudent:
@@ -218,6 +462,13 @@ def innferBehaviors(idStudent = None) -> list:
             }
         ]
 
+    if match:
+        query += [
+            {
+                '$match' : match
+            }
+        ]
+
     query += getUniqueStates()
     query += joinBehaviors('behavior')
 
@@ -225,6 +476,27 @@ def innferBehaviors(idStudent = None) -> list:
         {
             '$unwind': '$behavior'
         }, 
+
+        # Only required states take part in the match, optional ones never block it
+        {
+            '$addFields': {
+                'requiredStates': {
+                    '$setUnion': [
+                        {
+                            '$map': {
+                                'input': {
+                                    '$filter': {
+                                        'input': '$behavior.states',
+                                        'cond': { '$ne': [ '$$this.required', False ] }
+                                    }
+                                },
+                                'in': '$$this.state'
+                            }
+                        }, []
+                    ]
+                }
+            }
+        },
         
         {
             '$match': {
@@ -233,11 +505,11 @@ def innferBehaviors(idStudent = None) -> list:
                         {
                             '$size': {
                                 '$setIntersection': [
-                                    '$behavior.states.state', '$states'
+                                    '$requiredStates', '$states'
                                 ]
                             }
                         }, {
-                            '$size': '$behavior.states'
+                            '$size': '$requiredStates'
                         }
                     ]
                 }
@@ -269,4 +541,7 @@ def innferBehaviors(idStudent = None) -> list:
         }
     ]
 
-    return query
\ No newline at end of file
+    if merge:
+        query += mergeInto('behaviors', studentScope(idStudent, match))
+
+    return query
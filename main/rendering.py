@@ -0,0 +1,131 @@
+from .serializers import referenceId, referenceIds, resolveReferences
+
+# Raw list rendering: reads documents with `as_pymongo()` and builds the same JSON
+# the serializers produce, without constructing Document or Serializer instances.
+# main/tests.py checks both paths stay equivalent.
+
+# Output fields, in serializer order, and the document fields each one reads
+STUDENT_OUTPUT = {
+    'id': ['id'],
+    'alias': ['alias'],
+    'age': ['age'],
+    'gender': ['gender'],
+    'features': ['features', 'featureMap'],
+    'states': ['states'],
+    'behaviors': ['behaviors'],
+}
+STATE_OUTPUT = {'id': ['id'], 'name': ['name'], 'domain': ['domain'], 'features': ['features']}
+BEHAVIOR_OUTPUT = {'id': ['id'], 'name': ['name'], 'domain': ['domain'], 'states': ['states']}
+FEATURE_OUTPUT = {'id': ['id'], 'name': ['name'], 'domain': ['domain'], 'unit': ['unit'], 'type': ['type']}
+
+
+def sparseFields(params, available) -> list:
+    """
+    Output fields selected by the comma separated `fields` and `exclude` query
+    parameters, in `available` order. None when neither is given. Raises ValueError
+    for unknown names.
+    """
+    if not params.get('fields') and not params.get('exclude'):
+        return None
+
+    def names(param):
+        selected = [name.strip() for name in (params.get(param) or '').split(',') if name.strip()]
+        unknown = [name for name in selected if name not in available]
+        if unknown:
+            raise ValueError(f'Unknown {param}: {", ".join(unknown)}. Expected any of: {", ".join(available)}')
+        return selected
+
+    fields, exclude = names('fields') or list(available), names('exclude')
+    return [name for name in available if name in fields and name not in exclude]
+
+def documentFields(available, fields = None) -> list:
+    """Document fields to load, for `queryset.only()`, to render `fields` (all by default). The id is always loaded."""
+    names = available if fields is None else fields
+    return ['id'] + [source for name in names for source in available[name] if source != 'id']
+
+def text(value):
+    # CharField output
+    return None if value is None else str(value)
+
+def integer(value):
+    return None if value is None else int(value)
+
+def boolean(value):
+    return None if value is None else bool(value)
+
+def render(documents, renderers, fields = None) -> list:
+    renderers = {name: renderers[name] for name in fields} if fields is not None else renderers
+    return [{name: renderer(document) for name, renderer in renderers.items()} for document in documents]
+
+def renderStudents(documents, references = None, fields = None) -> list:
+    documents = list(documents)
+    # References are only resolved when their fields are rendered
+    if references is None and (fields is None or 'states' in fields or 'behaviors' in fields):
+        references = resolveReferences(documents)
+
+    def features(document):
+        featureMap = document.get('featureMap')
+        if featureMap:
+            return [{'feature': key, 'value': value} for key, value in featureMap.items()]
+        return [
+            {'feature': str(referenceId(feature.get('feature'))), 'value': feature.get('value')}
+            for feature in document.get('features') or []
+        ]
+
+    def states(document):
+        states = references['states']
+        return [
+            {'id': str(id), 'name': states[id].get('name')}
+            for id in referenceIds(document, 'states') if id in states
+        ]
+
+    def behaviors(document):
+        behaviors = references['behaviors']
+        return [
+            {'id': str(id), 'name': behaviors[id].get('name'), 'domain': behaviors[id].get('domain')}
+            for id in referenceIds(document, 'behaviors') if id in behaviors
+        ]
+
+    return render(documents, {
+        'id': lambda document: str(document['_id']),
+        'alias': lambda document: text(document.get('alias')),
+        'age': lambda document: integer(document.get('age')),
+        'gender': lambda document: text(document.get('gender')),
+        'features': features,
+        'states': states,
+        'behaviors': behaviors,
+    }, fields)
+
+def renderStates(documents, fields = None) -> list:
+    return render(documents, {
+        'id': lambda document: str(document['_id']),
+        'name': lambda document: text(document.get('name')),
+        'domain': lambda document: text(document.get('domain')),
+        'features': lambda document: [
+            {
+                'feature': str(referenceId(feature.get('feature'))),
+                'base': feature.get('base'),
+                'operator': text(feature.get('operator')),
+            } for feature in document.get('features') or []
+        ],
+    }, fields)
+
+def renderBehaviors(documents, fields = None) -> list:
+    return render(documents, {
+        'id': lambda document: str(document['_id']),
+        'name': lambda document: text(document.get('name')),
+        'domain': lambda document: text(document.get('domain')),
+        'states': lambda document: [
+            {'state': str(referenceId(state.get('state'))), 'required': boolean(state.get('required'))}
+            for state in document.get('states') or []
+        ],
+    }, fields)
+
+def renderFeatures(documents, fields = None) -> list:
+    return render(documents, {
+        'id': lambda document: str(document['_id']),
+        'name': lambda document: text(document.get('name')),
+        'domain': lambda document: text(document.get('domain')),
+        'unit': lambda document: text(document.get('unit')),
+        'type': lambda document: document.get('type'),
+    }, fields)
@@ -0,0 +1,123 @@
+import random
+
+from bson.objectid import ObjectId
+from django.conf import settings
+from mongoengine import connect, disconnect
+
+from .layouts import featuresUpdate
+from .models import Student, Feature, State, Behavior
+from .pipelines.student import OPERATORS
+from .inference.catalog import bumpCatalogVersion
+from .inference.writeback import chunked
+
+DOCUMENTS = [Feature, Student, State, Behavior]
+
+DISTRIBUTIONS = ['uniform', 'normal']
+
+
+def useDatabase(name):
+    """Reconnects the default mongoengine alias to database `name` on the configured server."""
+    database = settings.DATABASES['default']
+    disconnect()
+    connect(
+        db=name,
+        host=database['HOST'],
+        port=database['PORT'],
+        username=database['USERNAME'],
+        password=database['PASSWORD']
+    )
+
+def clearCollections():
+    # The catalog version is kept so caches keyed by it never see an older version again
+    for document in DOCUMENTS:
+        document._get_collection().delete_many({})
+
+def valueSampler(generator, distribution, valueMax):
+    if distribution == 'normal':
+        return lambda: min(max(round(generator.gauss(valueMax / 2, valueMax / 6)), 0), valueMax)
+    return lambda: generator.randint(0, valueMax)
+
+def insertMany(document, items, chunkSize) -> int:
+    collection = document._get_collection()
+    inserted = 0
+    for chunk in chunked(items, chunkSize):
+        collection.insert_many(chunk, ordered=False)
+        inserted += len(chunk)
+    return inserted
+
+def seedCollections(
+    students = 1000,
+    features = 20,
+    featuresPerStudent = 10,
+    states = 20,
+    featuresPerState = 2,
+    behaviors = 10,
+    statesPerBehavior = 3,
+    optionalRatio = 0.2,
+    distribution = 'uniform',
+    valueMax = 10,
+    seed = None,
+    chunkSize = None,
+) -> dict:
+    """
+    Inserts synthetic features, states, behaviors and students. Feature values and
+    rule bases are integers in [0, valueMax]; states and behaviors pick their
+    features/states uniformly and students use the configured feature layout.
+    Returns the number of documents inserted per collection.
+    """
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f'Unknown distribution "{distribution}", expected one of: {", ".join(DISTRIBUTIONS)}')
+
+    chunkSize = chunkSize or getattr(settings, 'INGEST_CHUNK_SIZE', 1000)
+    generator = random.Random(seed)
+    value = valueSampler(generator, distribution, valueMax)
+
+    featureIds = [ObjectId() for _ in range(features)]
+    stateIds = [ObjectId() for _ in range(states)]
+
+    counts = {
+        'features': insertMany(Feature, (
+            {'_id': featureId, 'name': f'feature {index}', 'domain': f'domain {index % 5}', 'unit': 'points'}
+            for index, featureId in enumerate(featureIds)
+        ), chunkSize),
+
+        'states': insertMany(State, (
+            {
+                '_id': stateId,
+                'name': f'state {index}',
+                'domain': f'domain {index % 5}',
+                'features': [
+                    {'feature': featureId, 'operator': generator.choice(OPERATORS), 'base': generator.randint(0, valueMax)}
+                    for featureId in generator.sample(featureIds, min(featuresPerState, features))
+                ],
+            } for index, stateId in enumerate(stateIds)
+        ), chunkSize),
+
+        'behaviors': insertMany(Behavior, (
+            {
+                'name': f'behavior {index}',
+                'domain': f'domain {index % 5}',
+                'states': [
+                    {'state': stateId, 'required': generator.random() >= optionalRatio}
+                    for stateId in generator.sample(stateIds, min(statesPerBehavior, states))
+                ],
+            } for index in range(behaviors)
+        ), chunkSize),
+
+        'students': insertMany(Student, (
+            {
+                'alias': f's{index}'[:10],
+                'age': generator.randint(10, 18),
+                'gender': generator.choice(['F', 'M']),
+                **featuresUpdate(
+                    [(featureId, value()) for featureId in generator.sample(featureIds, min(featuresPerStudent, features))]
+                )['$set'],
+                'states': [],
+                'behaviors': [],
+                'version': 0,
+            } for index in range(students)
+        ), chunkSize),
+    }
+
+    bumpCatalogVersion()
+    return counts
@@ -1,9 +1,154 @@
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 from rest_framework import serializers
-from .models import Student, Feature, StudentFeature, State, StateFeature, Behavior, BehaviorState
+from rest_framework.exceptions import ErrorDetail
+from .models import Student, Feature, StudentFeature, State, StateFeature, Behavior, BehaviorState, InferenceJob, FEATURE_TYPES
+from .inference.catalog import getCatalog, bumpCatalogVersion
+from .layouts import MAP, featureLayout
+from .featuretypes import coerceItems
+
+def referenceId(reference):
+    # DBRef, ObjectId or an already dereferenced Document
+    return getattr(reference, 'id', reference)
+
+def referenceIds(document, field) -> list:
+    """Stored ids of a list of references of a Document or raw document, read without dereferencing them."""
+    data = document._data if hasattr(document, '_data') else document
+    return [referenceId(reference) for reference in data.get(field) or []]
+
+def resolveReferences(students) -> dict:
+    """
+    Resolves the states and behaviors referenced by `students` from the cached catalog,
+    falling back to one $in query per collection for ids it does not know yet.
+    """
+    stateIds, behaviorIds = set(), set()
+    for student in students:
+        stateIds.update(referenceIds(student, 'states'))
+        behaviorIds.update(referenceIds(student, 'behaviors'))
+
+    catalog = getCatalog()
+
+    def load(document, ids, cached):
+        found = {id: cached[id] for id in ids if id in cached}
+        missing = [id for id in ids if id not in cached]
+        if missing:
+            cursor = document._get_collection().find({'_id': {'$in': missing}}, {'name': 1, 'domain': 1})
+            found.update((item['_id'], item) for item in cursor)
+        return found
+
+    return {
+        'states': load(State, stateIds, catalog.statesById),
+        'behaviors': load(Behavior, behaviorIds, catalog.behaviorsById),
+    }
+
+def validateReferences(serializer, items) -> list:
+    """
+    Checks that the ids held by the `ReferenceIdField`s of `serializer` exist,
+    with one $in query per target collection for all `items` at once.
+    Returns one error dict per item, empty for valid items.
+    """
+    errors = [{} for _ in items]
+
+    for name, field in serializer.fields.items():
+        if not isinstance(field, ReferenceIdField) or field.read_only:
+            continue
+
+        ids = {item[name] for item in items if item.get(name) is not None}
+        if not ids:
+            continue
+
+        document = field.get_queryset()._document
+        found = {found['_id'] for found in document._get_collection().find({'_id': {'$in': list(ids)}}, {'_id': 1})}
+
+        for index, item in enumerate(items):
+            if item.get(name) is not None and item[name] not in found:
+                errors[index][name] = [ErrorDetail(field.error_messages['does_not_exist'].format(pk_value=item[name]), code='does_not_exist')]
+
+    return errors
+
+class SparseFieldsMixin:
+    """
+    Takes `fields`, the output fields to keep. The others are dropped before
+    rendering, so their attributes and SerializerMethodFields are never read.
+    """
+
+    def __init__(self, *args, fields = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+class EmbeddedListSerializer(serializers.ListSerializer):
+    """
+    Reads embedded documents from `_data`, so mongoengine does not dereference their references,
+    and validates the references of all items in one batch. Children with a `typedField`
+    get that field coerced to the type of their feature.
+    """
+
+    def get_attribute(self, instance):
+        if hasattr(instance, '_data'):
+            return instance._data.get(self.source) or []
+        return super().get_attribute(instance)
+
+    def to_internal_value(self, data):
+        try:
+            items = super().to_internal_value(data)
+        except serializers.ValidationError as e:
+            # Newer DRF versions key per-item errors by index; keep one entry per item
+            if isinstance(e.detail, dict) and e.detail and all(isinstance(index, int) for index in e.detail):
+                raise serializers.ValidationError([e.detail.get(index, {}) for index in range(len(data))])
+            raise
+
+        # Same shape as the per-item errors raised by ListSerializer: one dict per item, empty for valid ones
+        errors = validateReferences(self.child, items)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+
+        typedField = getattr(self.child, 'typedField', None)
+        if typedField:
+            errors = coerceItems(items, typedField)
+            if any(errors):
+                raise serializers.ValidationError(errors)
+
+        return items
+
+class ReferenceIdField(serializers.PrimaryKeyRelatedField):
+    """
+    Renders the stored id of a mongoengine reference without dereferencing it.
+    Input is only checked to be an ObjectId; existence is checked by `validateReferences`.
+    """
+
+    def get_attribute(self, instance):
+        if hasattr(instance, '_data'):
+            return referenceId(instance._data.get(self.source))
+        return super().get_attribute(instance)
+
+    def to_representation(self, value):
+        return referenceId(value)
+
+    def to_internal_value(self, data):
+        if isinstance(data, ObjectId):
+            return data
+        if not isinstance(data, str):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+        try:
+            return ObjectId(data)
+        except InvalidId:
+            self.fail('does_not_exist', pk_value=data)
+
+def referenceValue(serializer, name, data):
+    # For serializers that build their own internal value but still need the reference checked
+    try:
+        return serializer.fields[name].run_validation(data.get(name))
+    except serializers.ValidationError as e:
+        raise serializers.ValidationError({name: e.detail})
 
 class StudentFeatureSerializer(serializers.Serializer):
     value = serializers.SerializerMethodField()
-    feature = serializers.PrimaryKeyRelatedField(queryset=Feature.objects.all())
+    feature = ReferenceIdField(queryset=Feature.objects.all())
+
+    typedField = 'value'
 
     def get_value(self, obj):
         return obj.value
@@ -17,14 +162,22 @@ class StudentFeatureSerializer(serializers.Serializer):
     def to_internal_value(self, data):
         value = data.get('value')
         # Convert the value to the appropriate type based on your logic
-        return {'value': value, 'feature': data.get('feature')}
+        return {'value': value, 'feature': referenceValue(self, 'feature', data)}
 
 
     class Meta:
         model = StudentFeature
         fields = "__all__"
+        list_serializer_class = EmbeddedListSerializer
+
+class StudentListSerializer(serializers.ListSerializer):
 
-class StudentSerializer(serializers.Serializer):
+    def to_representation(self, data):
+        students = list(data)
+        self._context['references'] = resolveReferences(students)
+        return super().to_representation(students)
+
+class StudentSerializer(SparseFieldsMixin, serializers.Serializer):
 
     id = serializers.CharField(read_only=True)  # Include the ID field
 
@@ -37,17 +190,29 @@ class StudentSerializer(serializers.Serializer):
     behaviors = serializers.SerializerMethodField()
 
     def get_states(self, obj):
-        my_objects = obj.states
-        serialized_objects = StateSerializer(my_objects, many=True).data
-        return serialized_objects
+        states = self.references['states']
+        return [
+            {
+                'id': str(id),
+                'name': states[id].get('name')
+            } for id in referenceIds(obj, 'states') if id in states
+        ]
 
     def get_behaviors(self, obj):
-        my_objects = obj.behaviors
-        serialized_objects = BehaviorSerializer(my_objects, many=True).data
-        return serialized_objects
+        behaviors = self.references['behaviors']
+        return [
+            {
+                'id': str(id),
+                'name': behaviors[id].get('name'),
+                'domain': behaviors[id].get('domain')
+            } for id in referenceIds(obj, 'behaviors') if id in behaviors
+        ]
 
 
     def create(self, validated_data):
+        if featureLayout() == MAP:
+            features = validated_data.pop('features', None) or []
+            validated_data['featureMap'] = {str(feature['feature']): feature['value'] for feature in features}
         return Student.objects.create(**validated_data)
     
     def update(self, instance, validated_data):
@@ -62,40 +227,39 @@ class StudentSerializer(serializers.Serializer):
         return instance
         
     def to_representation(self, instance):
-        data = super().to_representation(instance)
-        data['features'] = [
-            {
-                'feature': str(feature['feature']), 
-                'value': feature['value']
-            } for feature in data['features']
-        ]
-
-        data['states'] = [
-            {
-                'id': str(state['id']), 
-                'name': state['name']
-            } for state in data['states']
-        ]
+        # A list serializer resolves the references of the whole page at once
+        if 'states' in self.fields or 'behaviors' in self.fields:
+            self.references = self.context.get('references') or resolveReferences([instance])
 
-        data['behaviors'] = [
-            {
-                'id': str(behavior['id']), 
-                'name': behavior['name'],
-                'domain': behavior['domain']
-            } for behavior in data['behaviors']
-        ]
+        data = super().to_representation(instance)
+        if 'features' not in data:
+            return data
+
+        featureMap = instance._data.get('featureMap') if hasattr(instance, '_data') else None
+        if featureMap:
+            data['features'] = [{'feature': key, 'value': value} for key, value in featureMap.items()]
+        else:
+            data['features'] = [
+                {
+                    'feature': str(feature['feature']), 
+                    'value': feature['value']
+                } for feature in data['features']
+            ]
         
         return data
 
     class Meta:
         model = Student
         fields = "__all__"
+        list_serializer_class = StudentListSerializer
         
         
 class StateFeatureSerializer(serializers.Serializer):
     base = serializers.CharField()
     operator = serializers.CharField()
-    feature = serializers.PrimaryKeyRelatedField(queryset=Feature.objects.all())
+    feature = ReferenceIdField(queryset=Feature.objects.all())
+
+    typedField = 'base'
 
     def get_base(self, obj):
         # Define your custom logic here to return the appropriate base value
@@ -111,15 +275,16 @@ class StateFeatureSerializer(serializers.Serializer):
     def to_internal_value(self, data):
         base = data.get('base')
         # Convert the base value to the appropriate type based on your logic
-        return {'base': base, 'operator': data.get('operator'), 'feature': data.get('feature')}
+        return {'base': base, 'operator': data.get('operator'), 'feature': referenceValue(self, 'feature', data)}
 
 
 
     class Meta:
         model = StudentFeature
         fields = "__all__"
+        list_serializer_class = EmbeddedListSerializer
 
-class StateSerializer(serializers.Serializer):
+class StateSerializer(SparseFieldsMixin, serializers.Serializer):
 
     id = serializers.CharField(read_only=True)  # Include the ID field
     name = serializers.CharField(max_length=150)
@@ -127,7 +292,9 @@ class StateSerializer(serializers.Serializer):
     features = StateFeatureSerializer(many=True, required=True)
 
     def create(self, validated_data):
-        return State.objects.create(**validated_data)
+        state = State.objects.create(**validated_data)
+        bumpCatalogVersion()
+        return state
     
     def update(self, instance, validated_data):
         features = validated_data.pop('features', [])
@@ -139,10 +306,14 @@ class StateSerializer(serializers.Serializer):
             instance.features.append(StateFeature(**feature))
 
         instance.save()
+        bumpCatalogVersion()
         return instance
         
     def to_representation(self, instance):
         data = super().to_representation(instance)
+        if 'features' not in data:
+            return data
+
         data['features'] = [
             {
                 'feature': str(feature['feature']), 
@@ -159,13 +330,14 @@ class StateSerializer(serializers.Serializer):
 
 class BehaviorStateSerializer(serializers.Serializer):
     required = serializers.BooleanField(required=False, default=True)
-    state = serializers.PrimaryKeyRelatedField(queryset=State.objects.all())
+    state = ReferenceIdField(queryset=State.objects.all())
 
     class Meta:
         model = BehaviorState
         fields = "__all__"
+        list_serializer_class = EmbeddedListSerializer
 
-class BehaviorSerializer(serializers.Serializer):
+class BehaviorSerializer(SparseFieldsMixin, serializers.Serializer):
 
     id = serializers.CharField(read_only=True)  # Include the ID field
     name = serializers.CharField(max_length=150)
@@ -173,7 +345,9 @@ class BehaviorSerializer(serializers.Serializer):
     states = BehaviorStateSerializer(many=True, required=True)
 
     def create(self, validated_data):
-        return Behavior.objects.create(**validated_data)
+        behavior = Behavior.objects.create(**validated_data)
+        bumpCatalogVersion()
+        return behavior
     
     def update(self, instance, validated_data):
         states = validated_data.pop('states', [])
@@ -185,10 +359,14 @@ class BehaviorSerializer(serializers.Serializer):
             instance.states.append(BehaviorState(**feature))
 
         instance.save()
+        bumpCatalogVersion()
         return instance
         
     def to_representation(self, instance):
         data = super().to_representation(instance)
+        if 'states' not in data:
+            return data
+
         data['states'] = [
             {
                 'state': str(state['state']), 
@@ -203,12 +381,14 @@ class BehaviorSerializer(serializers.Serializer):
         fields = "__all__"
 
 
-class FeatureSerializer(serializers.Serializer):
+class FeatureSerializer(SparseFieldsMixin, serializers.Serializer):
 
     id = serializers.CharField(read_only=True)  # Include the ID field
     name = serializers.CharField()
     domain = serializers.CharField()  
     unit = serializers.CharField(required=False)  
+    # Changing it does not convert stored values, run `manage.py coercefeatures` afterwards
+    type = serializers.ChoiceField(choices=FEATURE_TYPES, required=False, allow_null=True)
     
     class Meta:
         model = Feature
@@ -223,3 +403,36 @@ class FeatureSerializer(serializers.Serializer):
         instance.save()
         return instance
 
+
+class InferenceJobSerializer(serializers.Serializer):
+
+    id = serializers.CharField(read_only=True)
+    kind = serializers.ChoiceField(choices=['states', 'behaviors'])
+    engine = serializers.CharField(required=False, allow_null=True, default=None)
+    target = serializers.CharField(read_only=True)
+    status = serializers.CharField(read_only=True)
+    total = serializers.IntegerField(read_only=True)
+    processed = serializers.IntegerField(read_only=True)
+    progress = serializers.SerializerMethodField()
+    matched = serializers.IntegerField(read_only=True)
+    modified = serializers.IntegerField(read_only=True)
+    skipped = serializers.IntegerField(read_only=True)
+    error = serializers.CharField(read_only=True)
+    createdAt = serializers.DateTimeField(read_only=True)
+    startedAt = serializers.DateTimeField(read_only=True)
+    finishedAt = serializers.DateTimeField(read_only=True)
+    duration = serializers.SerializerMethodField()
+
+    def get_progress(self, instance):
+        if not instance.total:
+            return 1.0 if instance.status == 'done' else 0.0
+        return min(instance.processed / instance.total, 1.0)
+
+    def get_duration(self, instance):
+        if not instance.startedAt:
+            return None
+        return ((instance.finishedAt or instance.updatedAt or instance.startedAt) - instance.startedAt).total_seconds()
+
+    class Meta:
+        model = InferenceJob
+        fields = "__all__"
@@ -1,3 +1,1329 @@
-from django.test import TestCase
+from datetime import datetime, timedelta, timezone
+from io import BytesIO, StringIO
+from unittest import skipUnless
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from bson.dbref import DBRef
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from .models import Student, Feature, State, Behavior, InferenceJob
+from .inference.catalog import Catalog, bumpCatalogVersion
+from .inference import cache, dependencies
+from .inference import snapshot
+from .inference.snapshot import FeatureMatrix
+from .inference.jobs import runJob, runRuleJob, reapStaleJobs
+from .inference.partitions import studentIdRanges, rangeMatch, inferPartitions
+from .inference.engines import getStateEngine, getBehaviorEngine
+from .inference.writeback import writeBack
+from .inference.distribution import ValueIndex, getValueIndex
+from .inference.preview import previewStates
+from .metrics import CACHE_REQUESTS
+from .featuretypes import toNumber, toBoolean, toCategory, coerceValue, coerceItems, parseValue
+from .inference.rules import MISSING, TESTS, compareValues, compileRule, StateRuleIndex, BehaviorBitIndex
+from .ingestion import parseRecord, ingestFeatures
+from .layouts import stateQuery
+from .parsers import NDJSONParser
+from .pagination import encodeCursor, decodeCursor, pageLimit, cursorPage
+from .rendering import STUDENT_OUTPUT, sparseFields, documentFields, renderStudents, renderStates, renderBehaviors, renderFeatures
+from .seeding import useDatabase, clearCollections
+from .serializers import StudentSerializer, FeatureSerializer, StateSerializer, BehaviorSerializer
+from . import views
+
+
+def mongoAvailable() -> bool:
+    database = settings.DATABASES['default']
+    client = MongoClient(database['HOST'], database['PORT'], serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+class RawRenderingTests(SimpleTestCase):
+    """The raw list path must render exactly what the serializers render, key order included."""
+
+    def assertSameJSON(self, serialized, rendered):
+        self.assertEqual(JSONRenderer().render(serialized), JSONRenderer().render(rendered))
+
+    def test_students(self):
+        featureA, featureB = ObjectId(), ObjectId()
+        stateA, stateB, unknown = ObjectId(), ObjectId(), ObjectId()
+        behavior = ObjectId()
+        references = {
+            'states': {stateA: {'_id': stateA, 'name': 'calm'}, stateB: {'_id': stateB, 'name': 'tired'}},
+            'behaviors': {behavior: {'_id': behavior, 'name': 'focused', 'domain': 'school'}},
+        }
+        documents = [
+            {
+                '_id': ObjectId(), 'alias': 'ana', 'age': 12, 'gender': 'F',
+                'features': [{'feature': featureA, 'value': 3}, {'feature': featureB, 'value': 'high'}, {'feature': featureA}],
+                'states': [stateB, unknown, stateA], 'behaviors': [behavior],
+            },
+            {
+                '_id': ObjectId(), 'alias': 'bo', 'age': 14.0, 'gender': 'M',
+                'featureMap': {str(featureA): 2.5, str(featureB): True}, 'features': [],
+                'states': [DBRef('state', stateA)], 'behaviors': [],
+            },
+            {'_id': ObjectId()},
+        ]
+
+        serialized = [
+            StudentSerializer(Student._from_son(document), context={'references': references}).data
+            for document in documents
+        ]
+        self.assertSameJSON(serialized, renderStudents(documents, references))
+
+    def test_states(self):
+        feature = ObjectId()
+        documents = [
+            {
+                '_id': ObjectId(), 'name': 'calm', 'domain': 'mood',
+                'features': [
+                    {'feature': feature, 'operator': 'gte', 'base': 3},
+                    {'feature': feature, 'operator': 'eq', 'base': 'low'},
+                    {'feature': feature, 'base': None},
+                ],
+            },
+            {'_id': ObjectId(), 'name': 'empty'},
+        ]
+
+        serialized = [StateSerializer(State._from_son(document)).data for document in documents]
+        self.assertSameJSON(serialized, renderStates(documents))
+
+    def test_behaviors(self):
+        state = ObjectId()
+        documents = [
+            {
+                '_id': ObjectId(), 'name': 'focused', 'domain': 'school',
+                'states': [{'state': state, 'required': True}, {'state': state, 'required': False}, {'state': state}],
+            },
+            {'_id': ObjectId(), 'name': 'idle', 'domain': 'school', 'states': []},
+        ]
+
+        serialized = [BehaviorSerializer(Behavior._from_son(document)).data for document in documents]
+        self.assertSameJSON(serialized, renderBehaviors(documents))
+
+    def test_features(self):
+        documents = [
+            {'_id': ObjectId(), 'name': 'attention', 'domain': 'school', 'unit': 'points', 'type': 'numeric'},
+            {'_id': ObjectId(), 'name': 'mood', 'domain': 'home'},
+        ]
+
+        serialized = [FeatureSerializer(Feature._from_son(document)).data for document in documents]
+        self.assertSameJSON(serialized, renderFeatures(documents))
+
+    def test_sparse_fields(self):
+        documents = [{'_id': ObjectId(), 'alias': 'ana', 'features': [{'feature': ObjectId(), 'value': 1}], 'states': [ObjectId()]}]
+
+        # Neither path resolves references when states and behaviors are left out
+        for fields in (['id', 'alias'], ['features'], []):
+            serialized = [StudentSerializer(Student._from_son(document), fields=fields).data for document in documents]
+            self.assertSameJSON(serialized, renderStudents(documents, fields=fields))
+
+        states = [{'_id': ObjectId(), 'name': 'calm', 'features': []}]
+        self.assertSameJSON([StateSerializer(State._from_son(states[0]), fields=['name']).data], renderStates(states, ['name']))
+
+
+class SparseFieldsTests(SimpleTestCase):
+
+    def test_selection(self):
+        self.assertIsNone(sparseFields({}, STUDENT_OUTPUT))
+        self.assertEqual(sparseFields({'fields': 'alias, id'}, STUDENT_OUTPUT), ['id', 'alias'])
+        self.assertEqual(sparseFields({'exclude': 'features,states,behaviors'}, STUDENT_OUTPUT), ['id', 'alias', 'age', 'gender'])
+        self.assertEqual(sparseFields({'fields': 'id,alias', 'exclude': 'id'}, STUDENT_OUTPUT), ['alias'])
+
+        with self.assertRaises(ValueError):
+            sparseFields({'fields': 'id,version'}, STUDENT_OUTPUT)
+
+    def test_projection(self):
+        self.assertEqual(documentFields(STUDENT_OUTPUT, ['alias', 'features']), ['id', 'alias', 'features', 'featureMap'])
+        self.assertEqual(documentFields(STUDENT_OUTPUT, []), ['id'])
+
+
+class FakePage(list):
+    """Raw documents standing in for a queryset: only `limit` is used by cursorPage."""
+
+    def limit(self, count):
+        return FakePage(self[:count])
+
+
+class PaginationTests(SimpleTestCase):
+
+    def test_cursor(self):
+        for id in (ObjectId(), ObjectId('000000000000000000000000'), ObjectId('ffffffffffffffffffffffff')):
+            with self.subTest(id=id):
+                token = encodeCursor(id)
+                self.assertNotIn('=', token)
+                self.assertEqual(decodeCursor(token), id)
+
+    def test_invalid_cursor(self):
+        for token in ('', 'abc', '!!!!', encodeCursor(ObjectId())[:-2]):
+            with self.subTest(token=token):
+                with self.assertRaises(ValueError):
+                    decodeCursor(token)
+
+        response = views.StudentViews.as_view()(APIRequestFactory().get('/api/students/', {'after': 'abc'}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_limit(self):
+        self.assertEqual(pageLimit(None), settings.PAGE_SIZE)
+        self.assertEqual(pageLimit('1'), 1)
+        self.assertEqual(pageLimit(str(settings.MAX_PAGE_SIZE)), settings.MAX_PAGE_SIZE)
+        for limit in ('0', '-1', str(settings.MAX_PAGE_SIZE + 1), 'ten', '2.5'):
+            with self.subTest(limit=limit):
+                with self.assertRaises(ValueError):
+                    pageLimit(limit)
+
+        response = views.StudentViews.as_view()(APIRequestFactory().get('/api/students/', {'after': '', 'limit': '0'}))
+        self.assertEqual(response.status_code, 400)
+
+    def page(self, count, limit) -> tuple:
+        documents = FakePage({'_id': ObjectId()} for _ in range(count))
+        request = APIRequestFactory().get('/api/students/', {'after': '', 'limit': limit, 'fields': 'id,alias'})
+        return documents, cursorPage(request, documents, lambda page: [str(document['_id']) for document in page], limit)
+
+    def test_next(self):
+        documents, page = self.page(3, 2)
+        self.assertEqual(page['results'], [str(document['_id']) for document in documents[:2]])
+
+        params = parse_qs(urlparse(page['next']).query)
+        self.assertEqual(params['after'], [encodeCursor(documents[1]['_id'])])
+        self.assertEqual(params['limit'], ['2'])
+        self.assertEqual(params['fields'], ['id,alias'])
+
+    def test_last_page(self):
+        for count in (0, 1, 2):
+            with self.subTest(count=count):
+                _, page = self.page(count, 2)
+                self.assertEqual(len(page['results']), count)
+                self.assertIsNone(page['next'])
+
+
+class IngestionParsingTests(SimpleTestCase):
+    """Record validation and NDJSON parsing of /api/students/features/bulk/, without MongoDB."""
+
+    def test_records(self):
+        student, feature = ObjectId(), ObjectId()
+        cases = [
+            ({'student': str(student), 'features': [{'feature': str(feature), 'value': 1}]}, student, [(feature, 1)], []),
+            ({'student': str(student), 'features': []}, student, [], []),
+            ({'student': 'nope', 'features': []}, None, [], ['student']),
+            ({'student': str(student)}, student, [], ['features']),
+            ({'student': str(student), 'features': [{'feature': str(feature)}, {'feature': 5}, 'x']}, student, [(feature, None)], ['features']),
+            (['not', 'a', 'record'], None, [], ['non_field_errors']),
+        ]
+        for record, studentId, pairs, errors in cases:
+            with self.subTest(record=record):
+                self.assertEqual(parseRecord(record)[:2], (studentId, pairs))
+                self.assertEqual(list(parseRecord(record)[2]), errors)
+
+        # Feature errors keep one entry per item, in order
+        _, _, errors = parseRecord({'student': str(student), 'features': [{'feature': str(feature)}, {'feature': 5}]})
+        self.assertEqual(errors['features'][0], {})
+        self.assertEqual(list(errors['features'][1]), ['feature'])
+
+    def parse(self, text):
+        return NDJSONParser().parse(BytesIO(text.encode()))
+
+    def test_ndjson(self):
+        self.assertEqual(self.parse('{"a": 1}\n\n  \n[2]\n"three"'), [{'a': 1}, [2], 'three'])
+        self.assertEqual(self.parse(''), [])
+
+        with self.assertRaisesMessage(ParseError, 'line 3'):
+            self.parse('{"a": 1}\n\n{"a": \n')
+
+    def test_not_a_list(self):
+        view = views.StudentFeatureBulkView.as_view()
+        for body in ({'student': str(ObjectId()), 'features': []}, 'records', 5):
+            with self.subTest(body=body):
+                response = view(APIRequestFactory().post('/api/students/features/bulk/', body, format='json'))
+                self.assertEqual(response.status_code, 400)
+
+        response = view(APIRequestFactory().post('/api/students/features/bulk/', b'{"a": \n', content_type='application/x-ndjson'))
+        self.assertEqual(response.status_code, 400)
+
+
+@skipUnless(mongoAvailable(), 'MongoDB is not available')
+class IngestFeaturesTests(SimpleTestCase):
+    """ingestFeatures on TEST_DATABASE: per-record errors and the last record of a student winning."""
+
+    def setUp(self):
+        useDatabase(getattr(settings, 'TEST_DATABASE', 'vibes_test'))
+        clearCollections()
+
+        self.number, self.untyped = Feature._get_collection().insert_many([
+            {'name': 'number', 'type': 'numeric'},
+            {'name': 'untyped'},
+        ]).inserted_ids
+        self.first, self.second, self.third = Student._get_collection().insert_many([
+            {'alias': 'first', 'features': [], 'version': 0},
+            {'alias': 'second', 'features': [{'feature': self.untyped, 'value': 'kept'}], 'version': 0},
+            {'alias': 'third', 'features': [], 'version': 0},
+        ]).inserted_ids
+
+    def tearDown(self):
+        clearCollections()
+        useDatabase(settings.DATABASES['default']['NAME'])
+
+    def record(self, student, *pairs) -> dict:
+        return {'student': str(student), 'features': [{'feature': str(feature), 'value': value} for feature, value in pairs]}
+
+    def features(self, student) -> list:
+        return [(feature['feature'], feature['value']) for feature in Student._get_collection().find_one({'_id': student})['features']]
+
+    def test_errors(self):
+        result = ingestFeatures([
+            self.record(self.first, (self.number, '2')),
+            self.record(ObjectId(), (self.number, 1)),
+            {'student': 'nope', 'features': []},
+            self.record(self.second, (ObjectId(), 1)),
+            self.record(self.third, (self.number, 'two')),
+        ], chunkSize=2).asDict()
+
+        self.assertEqual((result['received'], result['applied'], result['matched'], result['modified']), (5, 1, 1, 1))
+        self.assertEqual([error['index'] for error in result['errors']], [1, 2, 3, 4])
+        self.assertEqual(list(result['errors'][0]['errors']), ['student'])
+        self.assertEqual(list(result['errors'][1]['errors']), ['student'])
+        self.assertEqual(list(result['errors'][2]['errors']['features'][0]), ['feature'])
+        self.assertEqual(list(result['errors'][3]['errors']['features'][0]), ['value'])
+        self.assertEqual(self.features(self.first), [(self.number, 2)])
+        self.assertEqual(self.features(self.second), [(self.untyped, 'kept')])
+        self.assertEqual(self.features(self.third), [])
+
+    def test_last_record_wins(self):
+        result = ingestFeatures([
+            self.record(self.first, (self.number, 1)),
+            self.record(self.second, (self.untyped, 'a')),
+            self.record(self.first, (self.number, 2), (self.untyped, 'b')),
+            # A failing later record still replaces the earlier valid one
+            self.record(self.third, (self.number, 3)),
+            self.record(self.third, (self.number, 'three')),
+        ]).asDict()
+
+        self.assertEqual((result['received'], result['applied']), (5, 2))
+        self.assertEqual([error['index'] for error in result['errors']], [4])
+        self.assertEqual(self.features(self.first), [(self.number, 2), (self.untyped, 'b')])
+        self.assertEqual(self.features(self.second), [(self.untyped, 'a')])
+        self.assertEqual(self.features(self.third), [])
+        self.assertEqual(Student._get_collection().find_one({'_id': self.first})['version'], 1)
+
+
+class FakeStudents:
+    """Stands in for the student collection: `find` by `_id` or `_id: {$in}`, returning copies."""
+
+    def __init__(self, students):
+        self.students = students
+
+    def find(self, query, projection = None):
+        ids = query['_id']['$in'] if isinstance(query['_id'], dict) else [query['_id']]
+        return [dict(student) for student in self.students if student['_id'] in ids]
+
+    def find_one(self, query, projection = None):
+        return next(iter(self.find(query)), None)
+
+    def update_one(self, query, update):
+        for student in self.students:
+            if student['_id'] == query['_id']:
+                for field, amount in update['$inc'].items():
+                    student[field] = student.get(field, 0) + amount
+
+
+class DependencyTests(SimpleTestCase):
+    """Which students and states incremental re-inference reaches, without MongoDB."""
+
+    def setUp(self):
+        self.a, self.b = ObjectId(), ObjectId()
+        self.states = [
+            {'_id': 'high a', 'features': [{'feature': self.a, 'operator': 'gte', 'base': 3}]},
+            {'_id': 'b is x', 'features': [{'feature': self.b, 'operator': 'eq', 'base': 'x'}]},
+            {'_id': 'no rules', 'features': []},
+        ]
+        self.behaviors = [{'_id': 'active', 'states': [{'state': 'high a', 'required': True}]}]
+        self.students = []
+        self.writes = []
+
+        catalog = Catalog(1, self.states, self.behaviors)
+        for target in [
+            patch.object(dependencies, 'getCatalog', return_value=catalog),
+            patch.object(dependencies, 'bulkSet', side_effect=lambda updates, field, report: self.writes.extend((field, *update) for update in updates)),
+            patch.object(Student, '_get_collection', return_value=FakeStudents(self.students)),
+        ]:
+            target.start()
+            self.addCleanup(target.stop)
+
+    def student(self, features, states = (), behaviors = ()) -> ObjectId:
+        id = ObjectId()
+        self.students.append({'_id': id, 'features': features, 'states': list(states), 'behaviors': list(behaviors)})
+        return id
+
+    def test_changed_features(self):
+        a, b = self.a, self.b
+        cases = [
+            ([{'feature': a, 'value': 1}], [{'feature': a, 'value': 1}], set()),
+            ([{'feature': a, 'value': 1}], [{'feature': a, 'value': 2}], {a}),
+            ([{'feature': a, 'value': 1}], [{'feature': a, 'value': 1.0}, {'feature': b, 'value': 'x'}], {b}),
+            ([{'feature': a, 'value': 1}, {'feature': b}], [], {a, b}),
+            ([{'feature': a, 'value': 1}, {'feature': a, 'value': 2}], [{'feature': a, 'value': 2}, {'feature': a, 'value': 1}], {a}),
+            (None, [], set()),
+        ]
+        for old, new, expected in cases:
+            with self.subTest(old=old, new=new):
+                self.assertEqual(dependencies.changedFeatures(old, new), expected)
+
+    def test_merge_ids(self):
+        cases = [
+            # Kept in stored order, new matches appended
+            (['x', 'y'], {'x', 'z'}, ['z', 'x'], ['x', 'y', 'z']),
+            # Affected ids that no longer match are dropped, others are left alone
+            (['x', 'y'], {'x', 'y'}, [], []),
+            (['x', 'y'], {'z'}, [], ['x', 'y']),
+            ([], {'x'}, ['x'], ['x']),
+        ]
+        for current, affected, matched, expected in cases:
+            with self.subTest(current=current, affected=affected, matched=matched):
+                self.assertEqual(dependencies.mergeIds(current, affected, matched), expected)
+
+    def test_dependency_index(self):
+        index = dependencies.DependencyIndex.load()
+        self.assertEqual(index.statesFor({self.a}), {'high a'})
+        self.assertEqual(index.statesFor({self.a, self.b, ObjectId()}), {'high a', 'b is x'})
+        self.assertEqual(index.behaviorsFor({'high a', 'b is x'}), {'active'})
+        self.assertEqual(index.behaviorsFor({'no rules'}), set())
+
+    def test_feature_edit(self):
+        # Only the states reading the edited feature are re-evaluated
+        student = self.student([{'feature': self.a, 'value': 5}, {'feature': self.b, 'value': 'x'}])
+        counts = dependencies.reinferStudent(student, {self.a})
+
+        self.assertEqual(counts, {'states': 1, 'behaviors': 1})
+        self.assertEqual(self.writes, [('states', student, ['high a']), ('behaviors', student, ['active'])])
+
+        self.writes.clear()
+        self.assertEqual(dependencies.reinferStudent(student, {ObjectId()}), {'states': 0, 'behaviors': 0})
+        self.assertEqual(self.writes, [])
+
+    def test_feature_edit_unmatches(self):
+        student = self.student([{'feature': self.a, 'value': 1}], states=['high a', 'b is x'], behaviors=['active'])
+        dependencies.reinferStudent(student, {self.a})
+
+        # 'b is x' does not read the edited feature, so it is kept
+        self.assertEqual(self.writes, [('states', student, ['b is x']), ('behaviors', student, [])])
+
+    def test_students(self):
+        # Every state is re-evaluated, rule-less ones included
+        held = self.student([{'feature': self.b, 'value': 'x'}], states=['no rules'])
+        unchanged = self.student([{'feature': self.b, 'value': 'y'}])
+        counts = dependencies.reinferStudents([held, unchanged])
+
+        self.assertEqual(counts, {'states': 1, 'behaviors': 0})
+        self.assertEqual(self.writes, [('states', held, ['b is x'])])
+
+    def test_rule_edit(self):
+        # A rule edit reaches the students holding the old or new features, or the state itself
+        self.assertEqual(
+            dependencies.stateStudents('high a', [self.a, self.b]),
+            {'$or': [{'features.feature': {'$in': [self.a, self.b]}}, {'states': 'high a'}]}
+        )
+        self.assertEqual(
+            dependencies.behaviorStudents('active', ['high a']),
+            {'$or': [{'states': {'$in': ['high a']}}, {'behaviors': 'active'}]}
+        )
+
+        student = self.student([{'feature': self.a, 'value': 1}], states=['high a', 'b is x'], behaviors=['active'])
+        self.assertEqual(dependencies.applyStates([dict(self.students[0])], ['high a']), {student: {'high a'}})
+        self.assertEqual(self.writes, [('states', student, ['b is x'])])
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class InferenceCacheTests(SimpleTestCase):
+    """The single-student inference caches and their keys, without MongoDB."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        clock = patch.object(cache, 'time', self.clock)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def requests(self, result) -> float:
+        return CACHE_REQUESTS.labels(result)._value.get()
+
+    def test_lru(self):
+        local = cache.LocalInferenceCache(maxEntries=2, ttl=60)
+        local.set('a', 1)
+        local.set('b', 2)
+        self.assertEqual(local.get('a'), 1)
+        # 'b' is now the least recently used
+        local.set('c', 3)
+
+        self.assertIsNone(local.get('b'))
+        self.assertEqual((local.get('a'), local.get('c')), (1, 3))
+        local.set('a', 4)
+        local.set('d', 5)
+        self.assertEqual((local.get('a'), local.get('c'), local.get('d')), (4, None, 5))
+        self.assertEqual(local.stats(), {'hits': 5, 'misses': 2, 'entries': 2})
+
+    def test_ttl(self):
+        local = cache.LocalInferenceCache(maxEntries=10, ttl=60)
+        local.set('a', 1)
+        self.clock.now += 60
+        self.assertEqual(local.get('a'), 1)
+        self.clock.now += 1
+        self.assertIsNone(local.get('a'))
+        self.assertEqual(local.stats(), {'hits': 1, 'misses': 1, 'entries': 0})
+
+        # Setting again restarts the time to live
+        local.set('a', 2)
+        self.clock.now += 30
+        local.set('a', 3)
+        self.clock.now += 45
+        self.assertEqual(local.get('a'), 3)
+
+    def test_counters(self):
+        hits, misses = self.requests('hit'), self.requests('miss')
+        for backend in (cache.LocalInferenceCache(), cache.DjangoInferenceCache('default', ttl=60)):
+            with self.subTest(backend=type(backend).__name__):
+                key = ('states', 'compiled', str(ObjectId()), 0, 1)
+                self.assertIsNone(backend.get(key))
+                backend.set(key, {'states': []})
+                self.assertEqual(backend.get(key), {'states': []})
+                self.assertEqual((backend.hits, backend.misses), (1, 1))
+
+        self.assertEqual((self.requests('hit') - hits, self.requests('miss') - misses), (2, 2))
+        self.assertEqual(cache.NoInferenceCache().get(key), None)
+
+    def test_key_versions(self):
+        studentId = ObjectId()
+        students = FakeStudents([{'_id': studentId, 'version': 3}])
+        catalogs = [Catalog(7, [], [])]
+        for target in [
+            patch.object(Student, '_get_collection', return_value=students),
+            patch.object(cache, 'getCatalog', side_effect=lambda: catalogs[-1]),
+        ]:
+            target.start()
+            self.addCleanup(target.stop)
+
+        key = cache.inferenceKey('states', 'compiled', studentId)
+        self.assertEqual(key, ('states', 'compiled', str(studentId), 3, 7))
+        self.assertEqual(cache.inferenceKey('states', 'compiled', str(studentId)), key)
+        self.assertNotEqual(cache.inferenceKey('behaviors', 'compiled', studentId), key)
+        self.assertNotEqual(cache.inferenceKey('states', 'snapshot', studentId), key)
+
+        # A student write or a rule edit moves the key, so older entries are never read
+        cache.bumpStudentVersion(studentId)
+        bumped = cache.inferenceKey('states', 'compiled', studentId)
+        self.assertEqual(bumped[3], 4)
+        catalogs.append(Catalog(8, [], []))
+        self.assertEqual(cache.inferenceKey('states', 'compiled', studentId)[3:], (4, 8))
+
+        self.assertIsNone(cache.inferenceKey('states', 'compiled', ObjectId()))
+
+
+class CompareValuesTests(SimpleTestCase):
+    """compareValues follows the BSON order the aggregation operators compare with."""
+
+    def test_order(self):
+        cases = [
+            (1, 2, -1),
+            (2, 2.0, 0),
+            (Decimal128('2.5'), 2.5, 0),
+            (10, 9.5, 1),
+            # missing < null < numbers < strings < objects < arrays < ObjectId < booleans < dates
+            (MISSING, None, -1),
+            (None, MISSING, 1),
+            (None, None, 0),
+            (None, -100, -1),
+            ('1', 100, 1),
+            ('a', 'b', -1),
+            ({'a': 1}, 'z', 1),
+            ({'a': 1}, {'a': 1}, 0),
+            ({'a': 1}, {'a': 2}, -1),
+            ([1, 2], [1, 3], -1),
+            ([1, 2], [1], 1),
+            (ObjectId(), [1], 1),
+            (True, ObjectId(), 1),
+            (False, True, -1),
+            (datetime(2020, 1, 1), True, 1),
+        ]
+        for value, base, expected in cases:
+            with self.subTest(value=value, base=base):
+                self.assertEqual(compareValues(value, base), expected)
+
+
+class CompileRuleTests(SimpleTestCase):
+
+    def test_predicates(self):
+        cases = [
+            ('gte', 3, 3, True),
+            ('gt', 3, 3, False),
+            ('lt', 3, 2.5, True),
+            ('lte', 3, 3.0, True),
+            ('eq', 'a', 'a', True),
+            ('eq', 1, True, False),
+            # Across types the BSON order decides: strings sort above numbers
+            ('gte', 3, '1', True),
+            ('lt', 3, '1', False),
+            # A missing value sorts below null, which sorts below numbers
+            ('lt', 3, None, True),
+            ('lte', 3, MISSING, True),
+            ('eq', None, None, True),
+            ('eq', None, MISSING, False),
+            ('gt', None, MISSING, False),
+            # Unknown operators, `ne` included, never match
+            ('ne', 3, 4, False),
+            ('ne', 3, 3, False),
+            (None, 3, 3, False),
+        ]
+        for operator, base, value, expected in cases:
+            with self.subTest(operator=operator, base=base, value=value):
+                self.assertEqual(compileRule(operator, base)(value), expected)
+
+
+class StateRuleIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.a, self.b = ObjectId(), ObjectId()
+        self.states = [
+            {'_id': 'high a', 'features': [{'feature': self.a, 'operator': 'gte', 'base': 3}]},
+            {'_id': 'low a and b', 'features': [
+                {'feature': self.a, 'operator': 'lt', 'base': 3},
+                {'feature': self.b, 'operator': 'eq', 'base': 'x'},
+            ]},
+            {'_id': 'no rules', 'features': []},
+            {'_id': 'unknown operator', 'features': [{'feature': self.a, 'operator': 'ne', 'base': 1}]},
+        ]
+        self.index = StateRuleIndex(self.states)
+
+    def matched(self, features) -> list:
+        return [state.id for state in self.index.match(features)]
+
+    def test_match(self):
+        cases = [
+            ([{'feature': self.a, 'value': 3}], ['high a']),
+            ([{'feature': self.a, 'value': 2}, {'feature': self.b, 'value': 'x'}], ['low a and b']),
+            # Every rule of a state needs its feature
+            ([{'feature': self.a, 'value': 2}], []),
+            ([{'feature': self.b, 'value': 'x'}], []),
+            # A feature without a value is missing, below every number
+            ([{'feature': self.a}, {'feature': self.b, 'value': 'x'}], ['low a and b']),
+            # Each occurrence of a repeated feature must pass
+            ([{'feature': self.a, 'value': 5}, {'feature': self.a, 'value': 1}], []),
+            ([{'feature': self.a, 'value': 5}, {'feature': self.a, 'value': 4}], ['high a']),
+            ([], []),
+        ]
+        for features, expected in cases:
+            with self.subTest(features=features):
+                self.assertEqual(self.matched(features), expected)
+
+
+class BehaviorBitIndexTests(SimpleTestCase):
+    """
+    Expected matches follow innferBehaviors: a behavior is looked up through any state it
+    lists, and matches when the student holds every state not marked `required: False`.
+    """
+
+    def setUp(self):
+        s1, s2, s3, deleted = self.s1, self.s2, self.s3, self.deleted = [ObjectId() for _ in range(4)]
+
+        def behavior(name, *states):
+            return {'_id': name, 'states': [{'state': state, 'required': required} for state, required in states]}
+
+        self.index = BehaviorBitIndex([
+            behavior('optional only', (s1, False), (s2, False)),
+            behavior('duplicate', (s1, True), (s1, True)),
+            behavior('duplicate mixed', (s1, True), (s1, False)),
+            behavior('deleted state', (s1, True), (deleted, True)),
+            behavior('deleted optional', (s1, True), (deleted, False)),
+            {'_id': 'required by default', 'states': [{'state': s2}]},
+            behavior('required and optional', (s1, True), (s3, False)),
+        ])
+
+    def test_match(self):
+        cases = [
+            ([self.s1], ['optional only', 'duplicate', 'duplicate mixed', 'deleted optional', 'required and optional']),
+            ([self.s2], ['optional only', 'required by default']),
+            ([self.s3], []),
+            ([self.s1, self.s1], ['optional only', 'duplicate', 'duplicate mixed', 'deleted optional', 'required and optional']),
+            # A student still holding a deleted state keeps the behaviors requiring it
+            ([self.deleted], []),
+            ([self.s1, self.deleted], ['optional only', 'duplicate', 'duplicate mixed', 'deleted state', 'deleted optional', 'required and optional']),
+            ([ObjectId()], []),
+            ([], []),
+        ]
+        for states, expected in cases:
+            with self.subTest(states=states):
+                self.assertEqual([behavior.id for behavior in self.index.match(states)], expected)
+
+
+class SnapshotTests(SimpleTestCase):
+    """Row writes keep the built value indexes in step, and expired snapshots are rebuilt outside the lock."""
+
+    def setUp(self):
+        self.a, self.b = ObjectId(), ObjectId()
+        self.ids = [ObjectId() for _ in range(5)]
+        self.matrix = FeatureMatrix(rows=2, columns=1)
+        for studentId, value in zip(self.ids, [3, 1, 'high', 2, 1]):
+            self.matrix.setRow(self.student(studentId, (self.a, value), (self.b, 1)))
+
+    def tearDown(self):
+        snapshot.current = None
+
+    def student(self, studentId, *features):
+        return {'_id': studentId, 'features': [{'feature': feature, 'value': value} for feature, value in features]}
+
+    def assertIndexed(self, featureId):
+        index = self.matrix.valueIndexes[self.matrix.columns[featureId]]
+        built = ValueIndex.build(self.matrix, featureId)
+        self.assertEqual(list(index.values), sorted(index.values))
+        self.assertEqual(sorted(zip(index.values, map(str, index.ids))), sorted(zip(built.values, map(str, built.ids))))
+        self.assertEqual(sorted(index.others, key=str), sorted(built.others, key=str))
+
+    def test_writes_update_value_indexes(self):
+        for featureId in (self.a, self.b):
+            self.matrix.valueIndexes[self.matrix.columns[featureId]] = ValueIndex.build(self.matrix, featureId)
+
+        writes = [
+            lambda: self.matrix.setRow(self.student(self.ids[0], (self.a, 0))),
+            lambda: self.matrix.setRow(self.student(self.ids[1], (self.a, 'low'), (self.b, 1))),
+            lambda: self.matrix.setRow(self.student(self.ids[2], (self.a, 5), (self.b, 2))),
+            lambda: self.matrix.setRow(self.student(self.ids[3], (self.a, 1), (self.a, 4))),
+            lambda: self.matrix.setRow(self.student(self.ids[3], (self.a, 1))),
+            lambda: self.matrix.removeRow(self.ids[4]),
+            lambda: self.matrix.setRow(self.student(ObjectId(), (self.a, 1), (self.b, 'x'))),
+            lambda: self.matrix.setRow(self.student(ObjectId(), (ObjectId(), 1))),
+        ]
+        for step, write in enumerate(writes):
+            write()
+            with self.subTest(step=step):
+                self.assertIndexed(self.a)
+                self.assertIndexed(self.b)
+
+    def test_value_index_after_write(self):
+        snapshot.current = self.matrix
+        index = getValueIndex(self.a)
+        self.matrix.setRow(self.student(self.ids[2], (self.a, 0)))
+
+        self.assertIs(getValueIndex(self.a), index)
+        self.assertEqual(list(index.values), [0, 1, 1, 2, 3])
+        self.assertEqual(index.others, [])
+
+    def test_rebuild_outside_lock(self):
+        fresh = FeatureMatrix()
+        written = ObjectId()
+
+        def load():
+            self.assertFalse(snapshot.lock.locked())
+            snapshot.refreshStudents([written])
+            return fresh
+
+        self.matrix.builtAt -= 3600
+        snapshot.current = self.matrix
+        with patch.object(FeatureMatrix, 'load', side_effect=load), patch.object(FeatureMatrix, 'refresh') as refresh:
+            self.assertIs(snapshot.getSnapshot(), fresh)
+
+        # The write made during the build reaches both the expired snapshot and the new one
+        self.assertEqual([set(call.args[0]) for call in refresh.call_args_list], [{written}, {written}])
+        self.assertIsNone(snapshot.rebuilding)
+
+    def test_expired_snapshot_served_while_rebuilding(self):
+        self.matrix.builtAt -= 3600
+        snapshot.current = self.matrix
+        with snapshot.building, patch.object(FeatureMatrix, 'load') as load:
+            self.assertIs(snapshot.getSnapshot(), self.matrix)
+        load.assert_not_called()
+
+
+@skipUnless(mongoAvailable(), 'needs a MongoDB server')
+class EngineEquivalenceTests(SimpleTestCase):
+    """The in-process engines infer what the aggregation pipelines infer, on TEST_DATABASE."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        useDatabase(getattr(settings, 'TEST_DATABASE', 'vibes_test'))
+        clearCollections()
+
+        a, b, c, d = cls.features = [ObjectId() for _ in range(4)]
+        Feature._get_collection().insert_many([{'_id': feature, 'name': f'feature {index}'} for index, feature in enumerate(cls.features)])
+
+        def rule(feature, operator, base):
+            return {'feature': feature, 'operator': operator, 'base': base}
+
+        cls.states = [
+            {'_id': ObjectId(), 'name': 'high a', 'domain': 'd', 'features': [rule(a, 'gte', 3)]},
+            {'_id': ObjectId(), 'name': 'low a with b', 'domain': 'd', 'features': [rule(a, 'lt', 3), rule(b, 'eq', 'x')]},
+            {'_id': ObjectId(), 'name': 'b above 2', 'domain': 'd', 'features': [rule(b, 'gte', 2)]},
+            {'_id': ObjectId(), 'name': 'null c', 'domain': 'd', 'features': [rule(c, 'eq', None)]},
+            {'_id': ObjectId(), 'name': 'a and c', 'domain': 'd', 'features': [rule(a, 'gt', 2.5), rule(c, 'lte', 0)]},
+            {'_id': ObjectId(), 'name': 'no rules', 'domain': 'd', 'features': []},
+            {'_id': ObjectId(), 'name': 'unknown operator', 'domain': 'd', 'features': [rule(a, 'ne', 1)]},
+        ]
+        State._get_collection().insert_many(cls.states)
+
+        high, low, _, null, both = (state['_id'] for state in cls.states[:5])
+        Behavior._get_collection().insert_many([
+            {'name': 'high and both', 'domain': 'd', 'states': [{'state': high, 'required': True}, {'state': both, 'required': True}]},
+            {'name': 'optional only', 'domain': 'd', 'states': [{'state': low, 'required': False}, {'state': null, 'required': False}]},
+            {'name': 'duplicate', 'domain': 'd', 'states': [{'state': high, 'required': True}, {'state': high, 'required': False}]},
+            {'name': 'deleted state', 'domain': 'd', 'states': [{'state': high, 'required': True}, {'state': ObjectId(), 'required': True}]},
+            {'name': 'required by default', 'domain': 'd', 'states': [{'state': null}]},
+        ])
+
+        def student(alias, *features):
+            return {'alias': alias, 'age': 12, 'gender': 'F', 'features': list(features), 'states': [], 'behaviors': [], 'version': 0}
+
+        Student._get_collection().insert_many([
+            student('numbers', {'feature': a, 'value': 3}, {'feature': b, 'value': 'x'}, {'feature': d, 'value': 1}),
+            student('low a', {'feature': a, 'value': 2}, {'feature': b, 'value': 'x'}, {'feature': d, 'value': 2.5}),
+            student('string a', {'feature': a, 'value': '5'}, {'feature': b, 'value': 1}, {'feature': d, 'value': 2}),
+            student('nulls', {'feature': a, 'value': None}, {'feature': c, 'value': None}),
+            student('no value', {'feature': a}, {'feature': c, 'value': 0}),
+            student('repeated', {'feature': a, 'value': 4}, {'feature': a, 'value': 1}, {'feature': c, 'value': -1}),
+            student('repeated pass', {'feature': a, 'value': 4}, {'feature': a, 'value': 5}, {'feature': c, 'value': 0}, {'feature': d, 'value': 3}),
+            student('boolean', {'feature': b, 'value': True}, {'feature': d, 'value': 0}),
+            student('decimal', {'feature': a, 'value': Decimal128('2.9')}, {'feature': b, 'value': 2}, {'feature': c, 'value': 0.0}, {'feature': d, 'value': Decimal128('2.9')}),
+            student('empty'),
+        ])
+        bumpCatalogVersion()
+        snapshot.current = None
+
+    @classmethod
+    def tearDownClass(cls):
+        clearCollections()
+        useDatabase(settings.DATABASES['default']['NAME'])
+        super().tearDownClass()
+
+    def inferred(self, engine, field) -> dict:
+        return {
+            student['_id']: sorted(str(item['_id']) for item in student[field])
+            for student in engine.infer() if student[field]
+        }
+
+    def test_states(self):
+        expected = self.inferred(getStateEngine('aggregation'), 'states')
+        self.assertTrue(expected)
+        for name in ('compiled', 'snapshot'):
+            with self.subTest(engine=name):
+                self.assertEqual(self.inferred(getStateEngine(name), 'states'), expected)
+
+    def test_behaviors(self):
+        writeBack(
+            ((student['_id'], [state['_id'] for state in student['states']]) for student in getStateEngine('compiled').infer()),
+            'states'
+        )
+
+        expected = self.inferred(getBehaviorEngine('aggregation'), 'behaviors')
+        self.assertTrue(expected)
+        self.assertEqual(self.inferred(getBehaviorEngine('bitset'), 'behaviors'), expected)
+
+    def stored(self, field) -> dict:
+        return {
+            student['_id']: (sorted(str(id) for id in student.get(field) or []), student.get('version', 0))
+            for student in Student._get_collection().find({}, {field: 1, 'version': 1})
+        }
+
+    def assertMerged(self, merge, field, expected, untouched = ()):
+        """Runs `merge` and checks each student holds its expected ids, its version bumped only on change."""
+        before = self.stored(field)
+        merge()
+        for studentId, (ids, version) in self.stored(field).items():
+            with self.subTest(student=studentId):
+                if studentId in untouched:
+                    self.assertEqual((ids, version), before[studentId])
+                    continue
+                self.assertEqual(ids, expected.get(studentId, []))
+                self.assertEqual(version, before[studentId][1] + (ids != before[studentId][0]))
+
+    def test_merge(self):
+        students = Student._get_collection()
+        stale = ObjectId()
+        states = self.inferred(getStateEngine('compiled'), 'states')
+        engine = getStateEngine('aggregation')
+
+        # Stale ids are replaced, or emptied for students that no longer infer any
+        students.update_many({}, {'$set': {'states': [stale]}})
+        self.assertMerged(engine.merge, 'states', states)
+        self.assertMerged(engine.merge, 'states', states)
+
+        first, second = [student['_id'] for student in students.find({}, {'_id': 1}).sort('_id', 1).limit(2)]
+        students.update_many({'_id': {'$in': [first, second]}}, {'$set': {'states': [stale]}})
+        self.assertMerged(lambda: engine.merge(idStudent=str(first)), 'states', states, untouched={second})
+        engine.merge()
+
+        behaviors = self.inferred(getBehaviorEngine('bitset'), 'behaviors')
+        self.assertTrue(behaviors)
+        students.update_many({}, {'$set': {'behaviors': [stale]}})
+        self.assertMerged(getBehaviorEngine('aggregation').merge, 'behaviors', behaviors)
+
+    def test_preview(self):
+        inferred = self.inferred(getStateEngine('aggregation'), 'states')
+        drafts = [{key: value for key, value in state.items() if key != '_id'} for state in self.states]
+        studentIds = sorted(student['_id'] for student in Student._get_collection().find({}, {'_id': 1}))
+
+        results = {}
+        for engine in ('compiled', 'snapshot'):
+            with self.subTest(engine=engine):
+                preview = previewStates(drafts, sample=2, engine=engine)
+                self.assertEqual(preview['students'], len(studentIds))
+
+                for state, result in zip(self.states, preview['states']):
+                    matching = sorted(studentId for studentId, ids in inferred.items() if str(state['_id']) in ids)
+                    self.assertEqual(result['matched'], len(matching), state['name'])
+                    self.assertEqual(result['sample'], matching[:2], state['name'])
+
+                # Neither the rule-less state nor the unknown operator ever match
+                self.assertEqual(preview['states'][5:], [{'matched': 0, 'sample': []}] * 2)
+                results[engine] = preview
+
+        self.assertEqual(results['snapshot'], results['compiled'])
+        self.assertEqual(previewStates(drafts[:1])['states'][0]['sample'], [])
+        with self.assertRaises(ValueError):
+            previewStates(drafts, engine='aggregation')
+
+    def test_value_counts(self):
+        # Query operators only compare values of the same type and match any occurrence,
+        # so the one rule stateQuery is equivalent on a feature holding single numbers
+        feature = self.features[3]
+        index = getValueIndex(feature)
+        students = Student._get_collection()
+        for operator in TESTS:
+            for threshold in (-1, 0, 1, 2, 2.5, 2.9, 3, 5):
+                with self.subTest(operator=operator, threshold=threshold):
+                    query = stateQuery({'features': [{'feature': feature, 'operator': operator, 'base': threshold}]})
+                    self.assertEqual(index.count(operator, threshold), students.count_documents(query))
+                    self.assertCountEqual(index.studentIds(operator, threshold), students.distinct('_id', query))
+
+
+@skipUnless(mongoAvailable(), 'MongoDB is not available')
+class WriteBackTests(SimpleTestCase):
+    """writeBack only writes changed sets and, with a scope, empties the students the inference left out."""
+
+    def setUp(self):
+        useDatabase(getattr(settings, 'TEST_DATABASE', 'vibes_test'))
+        clearCollections()
+
+        self.state, self.other = ObjectId(), ObjectId()
+        self.same, self.changed, self.stale, self.outside, self.empty = Student._get_collection().insert_many([
+            {'alias': alias, 'states': states, 'version': 0}
+            for alias, states in [
+                ('same', [self.state, self.other]),
+                ('changed', [self.other]),
+                ('stale', [self.state]),
+                ('outside', [self.state]),
+                ('empty', []),
+            ]
+        ]).inserted_ids
+
+    def tearDown(self):
+        clearCollections()
+        useDatabase(settings.DATABASES['default']['NAME'])
+
+    def stored(self, studentId) -> tuple:
+        student = Student._get_collection().find_one({'_id': studentId})
+        return student['states'], student['version']
+
+    def test_unchanged_skipped(self):
+        report = writeBack([(self.same, [self.other, self.state]), (self.changed, [self.state])], 'states', chunkSize=1)
+
+        self.assertEqual(report.asDict(), {'matched': 1, 'modified': 1, 'skipped': 1})
+        self.assertEqual(self.stored(self.same), ([self.state, self.other], 0))
+        self.assertEqual(self.stored(self.changed), ([self.state], 1))
+        self.assertEqual(self.stored(self.stale), ([self.state], 0))
+
+    def test_scope_clears_stale(self):
+        scope = {'_id': {'$ne': self.outside}}
+        report = writeBack([(self.same, [self.state, self.other])], 'states', chunkSize=1, scope=scope)
+
+        self.assertEqual(report.asDict(), {'matched': 2, 'modified': 2, 'skipped': 1})
+        self.assertEqual(self.stored(self.same), ([self.state, self.other], 0))
+        self.assertEqual(self.stored(self.changed), ([], 1))
+        self.assertEqual(self.stored(self.stale), ([], 1))
+        self.assertEqual(self.stored(self.outside), ([self.state], 0))
+        self.assertEqual(self.stored(self.empty), ([], 0))
+
+        self.assertEqual(writeBack([(self.same, [self.state, self.other])], 'states', scope=scope).asDict(), {'matched': 0, 'modified': 0, 'skipped': 1})
+
+
+@skipUnless(mongoAvailable(), 'MongoDB is not available')
+@override_settings(INFERENCE_PARTITION_SIZE=2)
+class InferenceJobTests(SimpleTestCase):
+    """Status changes and progress counts of background jobs, run synchronously on TEST_DATABASE."""
+
+    def setUp(self):
+        useDatabase(getattr(settings, 'TEST_DATABASE', 'vibes_test'))
+        clearCollections()
+        InferenceJob._get_collection().delete_many({})
+
+        self.feature = Feature._get_collection().insert_one({'name': 'a'}).inserted_id
+        self.state = State._get_collection().insert_one({'name': 'high a', 'domain': 'd', 'features': [
+            {'feature': self.feature, 'operator': 'gte', 'base': 3},
+        ]}).inserted_id
+        Student._get_collection().insert_many([
+            {'alias': f'student {value}', 'features': [{'feature': self.feature, 'value': value}], 'states': [], 'version': 0}
+            for value in (1, 3, 4, 5)
+        ] + [
+            {'alias': 'stale', 'features': [], 'states': [self.state], 'version': 0},
+        ])
+        bumpCatalogVersion()
+
+    def tearDown(self):
+        clearCollections()
+        InferenceJob._get_collection().delete_many({})
+        useDatabase(settings.DATABASES['default']['NAME'])
+
+    def job(self, **fields) -> InferenceJob:
+        return InferenceJob(**{'status': 'pending', 'createdAt': datetime.now(timezone.utc), **fields}).save()
+
+    def counts(self, job) -> tuple:
+        job.reload()
+        return job.status, job.total, job.processed, job.matched, job.modified, job.skipped
+
+    def test_full_job(self):
+        job = self.job(kind='states', engine='compiled')
+        runJob(job.id)
+
+        # Three students gain the state, the stale one loses it, over three ranges
+        self.assertEqual(self.counts(job), ('done', 5, 5, 4, 4, 0))
+        self.assertIsNotNone(job.startedAt)
+        self.assertIsNotNone(job.finishedAt)
+        self.assertEqual(Student._get_collection().count_documents({'states': self.state}), 3)
+
+        again = self.job(kind='states', engine='compiled')
+        runJob(again.id)
+        self.assertEqual(self.counts(again), ('done', 5, 5, 0, 0, 3))
+
+    def test_rule_job(self):
+        job = self.job(kind='state', engine='incremental', target=self.state, sources=[self.feature])
+        runRuleJob(job.id)
+
+        self.assertEqual(self.counts(job)[:3], ('done', 5, 5))
+        self.assertEqual(job.modified, 4)
+        self.assertEqual(Student._get_collection().count_documents({'states': self.state}), 3)
+
+    def test_failures(self):
+        # A missing job is logged, not raised out of the worker thread
+        with self.assertLogs('main.inference.jobs', 'ERROR'):
+            runJob(ObjectId())
+            runRuleJob(ObjectId())
+
+        job = self.job(kind='states', engine='unknown')
+        with self.assertLogs('main.inference.jobs', 'ERROR'):
+            runJob(job.id)
+        self.assertEqual(self.counts(job)[:3], ('failed', 0, 0))
+        self.assertTrue(job.error)
+
+    def test_reap_stale(self):
+        old = datetime.now(timezone.utc) - timedelta(seconds=settings.INFERENCE_JOB_STALE_AFTER + 60)
+        recent = datetime.now(timezone.utc)
+        stalled = self.job(kind='states', engine='compiled', status='running', createdAt=old, updatedAt=old)
+        running = self.job(kind='states', engine='compiled', status='running', createdAt=old, updatedAt=recent)
+        lost = self.job(kind='states', engine='compiled', createdAt=old)
+        queued = self.job(kind='states', engine='compiled', createdAt=recent)
+        done = self.job(kind='states', engine='compiled', status='done', createdAt=old, updatedAt=old)
+
+        self.assertEqual(reapStaleJobs(), 2)
+        for job, status in [(stalled, 'failed'), (running, 'running'), (lost, 'failed'), (queued, 'pending'), (done, 'done')]:
+            with self.subTest(job=job.id):
+                job.reload()
+                self.assertEqual(job.status, status)
+
+        # A reaped job whose worker shows up late is not run
+        runJob(lost.id)
+        self.assertEqual(self.counts(lost)[:3], ('failed', 0, 0))
+
+
+class RangeEngine:
+    """Engine stand-in returning the raw students of each range, in reverse order."""
+
+    def infer(self, match = None):
+        return list(Student._get_collection().find(match or {}, {'_id': 1}).sort('_id', -1))
+
+
+@skipUnless(mongoAvailable(), 'MongoDB is not available')
+class PartitionTests(SimpleTestCase):
+    """`_id` ranges of the student collection on TEST_DATABASE."""
+
+    def setUp(self):
+        useDatabase(getattr(settings, 'TEST_DATABASE', 'vibes_test'))
+        clearCollections()
+
+    def tearDown(self):
+        clearCollections()
+        useDatabase(settings.DATABASES['default']['NAME'])
+
+    def insert(self, count) -> list:
+        clearCollections()
+        if not count:
+            return []
+        return sorted(Student._get_collection().insert_many([{'alias': str(index)} for index in range(count)]).inserted_ids)
+
+    def test_ranges(self):
+        students = Student._get_collection()
+        for count in (0, 1, 2, 3, 5, 7):
+            ids = self.insert(count)
+            for partitionSize in (1, 2, 3, 10):
+                with self.subTest(count=count, partitionSize=partitionSize):
+                    ranges = studentIdRanges(partitionSize)
+                    covered = [student['_id'] for bounds in ranges for student in students.find(rangeMatch(*bounds)).sort('_id', 1)]
+
+                    # Every id exactly once, in order, each range full but the last
+                    self.assertEqual(covered, ids)
+                    self.assertEqual(len(ranges), max(1, -(-count // partitionSize)))
+                    self.assertEqual((ranges[0][0], ranges[-1][1]), (None, None))
+                    sizes = [students.count_documents(rangeMatch(*bounds)) for bounds in ranges]
+                    self.assertTrue(all(size == partitionSize for size in sizes[:-1]))
+
+    def test_infer_partitions(self):
+        for count, workers in [(0, 2), (1, 4), (7, 2), (7, 10)]:
+            ids = self.insert(count)
+            with self.subTest(count=count, workers=workers):
+                rows = list(inferPartitions(RangeEngine(), workers=workers, partitionSize=2))
+                self.assertEqual([row['_id'] for row in rows], ids)
+
+
+@skipUnless(mongoAvailable(), 'MongoDB is not available')
+@override_settings(INFERENCE_INCREMENTAL=False)
+class StudentFeatureLayoutTests(SimpleTestCase):
+    """Feature PATCH writes and the featurelayout command, in both layouts, on TEST_DATABASE."""
+
+    def setUp(self):
+        useDatabase(getattr(settings, 'TEST_DATABASE', 'vibes_test'))
+        clearCollections()
+
+        self.a, self.b, self.c = Feature._get_collection().insert_many([
+            {'name': 'a', 'type': 'numeric'},
+            {'name': 'b'},
+            {'name': 'c'},
+        ]).inserted_ids
+        self.student = Student._get_collection().insert_one({'alias': 'listed', 'version': 0, 'features': [
+            {'feature': self.a, 'value': 1},
+            {'feature': self.b, 'value': 'x'},
+            {'feature': self.a, 'value': 2},
+        ]}).inserted_id
+
+    def tearDown(self):
+        clearCollections()
+        useDatabase(settings.DATABASES['default']['NAME'])
+
+    def stored(self) -> dict:
+        return Student._get_collection().find_one({'_id': self.student})
+
+    def patch(self, *pairs):
+        body = [{'feature': str(feature), 'value': value} for feature, value in pairs]
+        request = APIRequestFactory().patch(f'/api/students/{self.student}/features/', body, format='json')
+        return views.StudentFeatureView.as_view()(request, id=str(self.student))
+
+    def test_patch_list(self):
+        response = self.patch((self.a, '5'), (self.c, True))
+        self.assertEqual(response.status_code, 200)
+
+        # Every occurrence is set, the new feature appended, the version bumped once
+        student = self.stored()
+        self.assertEqual(
+            [(feature['feature'], feature['value']) for feature in student['features']],
+            [(self.a, 5), (self.b, 'x'), (self.a, 5), (self.c, True)]
+        )
+        self.assertEqual(student['version'], 1)
+
+        self.patch((self.b, 'y'))
+        self.assertEqual(self.stored()['features'][1]['value'], 'y')
+        self.assertEqual(self.stored()['version'], 2)
+
+    def test_patch_map(self):
+        call_command('featurelayout', to='map', stdout=StringIO())
+        with override_settings(STUDENT_FEATURE_LAYOUT='map'):
+            self.patch((self.b, 'y'), (self.c, 3))
+
+        student = self.stored()
+        self.assertEqual(student['featureMap'], {str(self.a): 2, str(self.b): 'y', str(self.c): 3})
+        self.assertEqual(student['version'], 1)
+
+    def test_feature_layout(self):
+        output = StringIO()
+        call_command('featurelayout', to='map', stdout=output)
+        self.assertIn('1 students converted to the map layout.', output.getvalue())
+        self.assertIn('STUDENT_FEATURE_LAYOUT is still "list".', output.getvalue())
+
+        # A repeated feature keeps its last value in the map
+        student = self.stored()
+        self.assertEqual(student['featureMap'], {str(self.a): 2, str(self.b): 'x'})
+        self.assertEqual(student['features'], [])
+
+        output = StringIO()
+        call_command('featurelayout', to='map', stdout=output)
+        self.assertIn('0 students converted', output.getvalue())
+
+        with override_settings(STUDENT_FEATURE_LAYOUT='list'):
+            output = StringIO()
+            call_command('featurelayout', stdout=output)
+        self.assertEqual(output.getvalue().strip(), '1 students converted to the list layout.')
+        student = self.stored()
+        self.assertNotIn('featureMap', student)
+        self.assertEqual([(feature['feature'], feature['value']) for feature in student['features']], [(self.a, 2), (self.b, 'x')])
+
+
+class EmbeddedListErrorTests(SimpleTestCase):
+
+    def test_one_entry_per_item(self):
+        serializer = StateSerializer(data={'name': 'calm', 'domain': 'mood', 'features': [
+            {'feature': str(ObjectId()), 'operator': 'gte', 'base': 1},
+            {'feature': 5, 'operator': 'gte', 'base': 1},
+        ]})
+
+        self.assertFalse(serializer.is_valid())
+        errors = serializer.errors['features']
+        self.assertIsInstance(errors, list)
+        self.assertEqual(errors[0], {})
+        self.assertEqual(list(errors[1]), ['feature'])
+
+
+class CoerceValueTests(SimpleTestCase):
+
+    def test_conversions(self):
+        cases = [
+            (toNumber, '3', 3),
+            (toNumber, ' 2.5 ', 2.5),
+            (toNumber, '1e3', 1000),
+            (toNumber, 4.0, 4),
+            (toNumber, '1e20', 1e20),
+            (toNumber, -1e20, -1e20),
+            (toNumber, str(2 ** 63 - 1), 2 ** 63 - 1),
+            (toNumber, str(2 ** 64), float(2 ** 64)),
+            (toNumber, 'nan', ValueError),
+            (toNumber, 'inf', ValueError),
+            (toNumber, float('nan'), ValueError),
+            (toNumber, float('-inf'), ValueError),
+            (toNumber, True, ValueError),
+            (toNumber, 'three', ValueError),
+            (toBoolean, 'true', True),
+            (toBoolean, ' No ', False),
+            (toBoolean, '0', False),
+            (toBoolean, 1, True),
+            (toBoolean, 0.0, False),
+            (toBoolean, 2, ValueError),
+            (toBoolean, 'maybe', ValueError),
+            (toCategory, 'red', 'red'),
+            (toCategory, 3, '3'),
+            (toCategory, True, 'true'),
+            (toCategory, {'color': 'red'}, ValueError),
+            (toCategory, ['red'], ValueError),
+        ]
+        for coerce, value, expected in cases:
+            with self.subTest(coerce=coerce.__name__, value=value):
+                if expected is ValueError:
+                    with self.assertRaises(ValueError):
+                        coerce(value)
+                else:
+                    result = coerce(value)
+                    self.assertEqual(result, expected)
+                    self.assertIs(type(result), type(expected))
+
+    def test_untyped(self):
+        for type in (None, 'unknown', 'numeric', 'boolean', 'categorical'):
+            with self.subTest(type=type):
+                self.assertIsNone(coerceValue(type, None))
+        self.assertEqual(coerceValue(None, '3'), '3')
+        self.assertEqual(coerceValue('unknown', [1]), [1])
+
+    def test_parse(self):
+        self.assertEqual(parseValue(None, '1e3'), 1000)
+        self.assertEqual(parseValue(None, 'red'), 'red')
+        self.assertEqual(parseValue('categorical', '3'), '3')
+        self.assertIs(parseValue('boolean', 'yes'), True)
+        with self.assertRaises(ValueError):
+            parseValue('numeric', 'red')
+
+    def test_items(self):
+        number, flag = ObjectId(), ObjectId()
+        items = [
+            {'feature': number, 'value': '7'},
+            {'feature': flag, 'value': 'maybe'},
+            {'feature': ObjectId(), 'value': 'kept'},
+        ]
+
+        errors = coerceItems(items, 'value', {number: 'numeric', flag: 'boolean'})
+        self.assertEqual([item['value'] for item in items], [7, 'maybe', 'kept'])
+        self.assertEqual(errors[0], {})
+        self.assertEqual(list(errors[1]), ['value'])
+        self.assertEqual(errors[2], {})
+
+
+@skipUnless(mongoAvailable(), 'MongoDB is not available')
+class CoerceFeaturesCommandTests(SimpleTestCase):
+    """The coercefeatures command rewrites stored values and bases to their feature type, on TEST_DATABASE."""
+
+    def setUp(self):
+        useDatabase(getattr(settings, 'TEST_DATABASE', 'vibes_test'))
+        clearCollections()
+
+        self.number, self.flag, self.untyped = ObjectId(), ObjectId(), ObjectId()
+        Feature._get_collection().insert_many([
+            {'_id': self.number, 'name': 'number', 'type': 'numeric'},
+            {'_id': self.flag, 'name': 'flag', 'type': 'boolean'},
+            {'_id': self.untyped, 'name': 'untyped'},
+        ])
+        students = Student._get_collection()
+        self.listed = students.insert_one({'alias': 'list', 'version': 0, 'features': [
+            {'feature': self.number, 'value': '1e3'},
+            {'feature': self.flag, 'value': 'maybe'},
+            {'feature': self.untyped, 'value': '5'},
+        ]}).inserted_id
+        self.mapped = students.insert_one({'alias': 'map', 'version': 0, 'features': [], 'featureMap': {
+            str(self.number): 2.0,
+            str(self.flag): '0',
+        }}).inserted_id
+        self.typed = students.insert_one({'alias': 'typed', 'version': 0, 'features': [{'feature': self.number, 'value': 3}]}).inserted_id
+        self.state = State._get_collection().insert_one({'name': 'on', 'domain': 'd', 'features': [
+            {'feature': self.flag, 'operator': 'eq', 'base': 'true'},
+        ]}).inserted_id
+
+    def tearDown(self):
+        clearCollections()
+        useDatabase(settings.DATABASES['default']['NAME'])
+
+    def run_command(self, *args) -> str:
+        output = StringIO()
+        call_command('coercefeatures', *args, stdout=output)
+        return output.getvalue()
+
+    def test_dry_run(self):
+        output = self.run_command('--dry-run')
+        self.assertIn('2 students and 1 states would change.', output)
+        self.assertIn('1 student values and 0 state bases could not be coerced.', output)
+        self.assertEqual(Student._get_collection().find_one({'_id': self.listed})['features'][0]['value'], '1e3')
+
+    def test_coerce(self):
+        output = self.run_command()
+        self.assertIn('2 students and 1 states changed.', output)
+
+        students = Student._get_collection()
+        listed = students.find_one({'_id': self.listed})
+        self.assertEqual([feature['value'] for feature in listed['features']], [1000, 'maybe', '5'])
+        self.assertEqual(listed['version'], 1)
+        mapped = students.find_one({'_id': self.mapped})
+        self.assertEqual(mapped['featureMap'], {str(self.number): 2, str(self.flag): False})
+        self.assertIs(type(mapped['featureMap'][str(self.number)]), int)
+        self.assertEqual(students.find_one({'_id': self.typed})['version'], 0)
+        self.assertIs(State._get_collection().find_one({'_id': self.state})['features'][0]['base'], True)
+
+        self.assertIn('0 students and 0 states changed.', self.run_command())
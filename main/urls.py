@@ -4,23 +4,31 @@ from . import views
 # URLConf   
 urlpatterns = [
     path('students/', views.StudentViews.as_view()),
+    path('students/features/bulk/', views.StudentFeatureBulkView.as_view()),
     path('students/<str:id>/', views.StudentDetailView.as_view()),
     path('students/<str:id>/features/', views.StudentFeatureView.as_view()),
 
     path('features/', views.FeatureViews.as_view()),
     path('features/<str:id>/', views.FeatureDetailView.as_view()),
+    path('features/<str:id>/distribution/', views.FeatureDistributionView.as_view()),
 
     path('states/', views.StateViews.as_view()),
     path('states/<str:id>/', views.StateDetailView.as_view()),
+    path('states/<str:id>/students/', views.StateStudentsView.as_view()),
 
     path('behaviors/', views.BehaviorViews.as_view()),
     path('behaviors/<str:id>/', views.BehaviorDetailView.as_view()),
     
+    path('infer/jobs/', views.InferenceJobViews.as_view()),
+    path('infer/jobs/<str:id>/', views.InferenceJobDetailView.as_view()),
+
     path('infer/states/', views.StudentStateInferatorView.as_view()),
+    path('infer/states/preview/', views.StatePreviewView.as_view()),
     path('infer/states/<str:idStudent>/', views.StudentStateInferatorView.as_view()),
 
     path('infer/behaviors/', views.StudentBehaviorInferatorView.as_view()),
     path('infer/behaviors/<str:idStudent>/', views.StudentBehaviorInferatorView.as_view()),
 
     path('get-csrf-token/', views.get_csrf_token),
+    path('metrics', views.metrics),
 ]
\ No newline at end of file
@@ -1,46 +1,120 @@
-import json
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.decorators import APIView
+from rest_framework.parsers import JSONParser
+from prometheus_client import CONTENT_TYPE_LATEST
 
-from django.http import JsonResponse, Http404
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, Http404
 from django.middleware.csrf import get_token
 from django.views.decorators.csrf import ensure_csrf_cookie
 
 from mongoengine.errors import ValidationError
 
-from .pipelines.student import innferStates, innferBehaviors
-from .models import Student, Feature, StudentFeature, State, Behavior
-from .serializers import StudentSerializer, FeatureSerializer, StudentFeatureSerializer, StateSerializer, BehaviorSerializer, BehaviorStateSerializer
+from .inference.engines import getStateEngine, getBehaviorEngine, PartitionedEngine
+from .inference.writeback import writeBack, mergeBack
+from .inference.jobs import startJob, startRuleJob, reapStaleJobs
+from .inference.snapshot import refreshStudents
+from .inference.preview import previewStates
+from .inference.distribution import getValueIndex
+from .inference.rules import TESTS
+from .featuretypes import parseValue
+from .metrics import inferenceRun, exposition
+from .inference import dependencies
+from .inference.catalog import getCatalog, bumpCatalogVersion
+from .inference.cache import getInferenceCache, inferenceKey, bumpStudentVersion
+from .pagination import STREAM_FORMATS, afterCursor, pageLimit, cursorPage, streamResponse
+from .parsers import NDJSONParser
+from .layouts import MAP, FEATURE_FIELDS, featureLayout, studentFeatures, featuresUpdate, stateQuery
+from .ingestion import ingestFeatures
+from .rendering import STUDENT_OUTPUT, STATE_OUTPUT, BEHAVIOR_OUTPUT, FEATURE_OUTPUT, sparseFields, documentFields, renderStudents, renderStates, renderBehaviors, renderFeatures
+from .models import Student, Feature, State, Behavior, InferenceJob
+from .serializers import StudentSerializer, FeatureSerializer, StudentFeatureSerializer, StateSerializer, BehaviorSerializer, InferenceJobSerializer
 
 @ensure_csrf_cookie
 def get_csrf_token(request):
     return JsonResponse({'csrfToken': get_token(request)})
+
+def metrics(request):
+    return HttpResponse(exposition(), content_type=CONTENT_TYPE_LATEST)
+
+def inferenceMode(engine, idStudent) -> str:
+    if idStudent:
+        return 'student'
+    return 'parallel' if isinstance(engine, PartitionedEngine) else 'full'
+
+def studentInferenceKey(kind, engine, idStudent):
+    """Cache key of one student's inference result. Unknown or malformed ids are a 404."""
+    try:
+        key = inferenceKey(kind, engine.name, idStudent)
+    except InvalidId:
+        raise Http404
+    if key is None:
+        raise Http404
+    return key
+
+def unmatchedStudent(idStudent, field) -> dict:
+    """Engine output row of a student holding no state or behavior; engines yield nothing for them."""
+    student = Student._get_collection().find_one({'_id': ObjectId(idStudent)}, {'alias': 1, 'age': 1, 'gender': 1})
+    if student is None:
+        raise Http404
+    return {'_id': student['_id'], 'alias': student.get('alias'), 'age': student.get('age'), 'gender': student.get('gender'), field: []}
+
 class StudentViews(APIView):
     def get(self, request):
-        students = Student.objects.all()
+        """
+        Lists students. `?after=` (empty for the first page) pages by `_id` cursor and
+        answers {results, next}; `?stream=json|ndjson` streams every student. Without
+        either, `?skip=&limit=` still return a plain list, as clients of that shape
+        expect, so `?limit=` alone does not turn cursor paging on.
+        """
+        try:
+            fields = sparseFields(request.GET, STUDENT_OUTPUT)
+        except ValueError as e:
+            return Response({'fields': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        students = Student.objects.only(*documentFields(STUDENT_OUTPUT, fields)).as_pymongo()
+        render = lambda page: renderStudents(page, fields=fields)
+
+        stream = request.GET.get('stream', None)
+        if stream or 'after' in request.GET:
+            if stream and stream not in STREAM_FORMATS:
+                return Response({'stream': f'Expected one of: {", ".join(STREAM_FORMATS)}'}, status=status.HTTP_400_BAD_REQUEST)
+
+            try:
+                students = afterCursor(students, request.GET.get('after'))
+                limit = pageLimit(request.GET.get('limit'))
+            except ValueError as e:
+                return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            if stream:
+                if request.GET.get('limit'):
+                    students = students.limit(limit)
+                return streamResponse(students, render, stream)
+
+            return Response(cursorPage(request, students, render, limit))
 
         skip = request.GET.get('skip', None)
         limit = request.GET.get('limit', None)
 
-        print('Skip', skip)
-        print('Limit', limit)
-
         if skip:
             students = students.skip(int(skip))
 
         if limit:
             students = students.limit(int(limit))
 
-        serializer = StudentSerializer(students, many=True)
-        return Response(serializer.data)
+        return Response(render(students))
 
     def post(self, request):
         serializer = StudentSerializer(data=request.data)
         valid = serializer.is_valid()
         if valid:
             student = serializer.save()
+            refreshStudents([student.id])
             serialized_student = serializer.to_representation(student)
             
             return Response(serialized_student, status=status.HTTP_201_CREATED)
@@ -49,17 +123,23 @@ class StudentViews(APIView):
 
 class StudentDetailView(APIView):
 
-    def get_object(self, id):
+    def get_object(self, id, fields = None):
         try:
-            return Student.objects.get(id=id)
+            students = Student.objects if fields is None else Student.objects.only(*documentFields(STUDENT_OUTPUT, fields))
+            return students.get(id=id)
         except Student.DoesNotExist:
             raise Http404
         except ValidationError as e:
             raise Http404
 
     def get(self, request, id):
-        student = self.get_object(id)
-        serializer = StudentSerializer(student)
+        try:
+            fields = sparseFields(request.GET, STUDENT_OUTPUT)
+        except ValueError as e:
+            return Response({'fields': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        student = self.get_object(id, fields)
+        serializer = StudentSerializer(student, fields=fields)
         return Response(serializer.data)
     
     def put(self, request, id):
@@ -67,24 +147,31 @@ class StudentDetailView(APIView):
         serializer = StudentSerializer(student, data=request.data)
         if serializer.is_valid():
             serializer.save()
+            bumpStudentVersion(student.id)
+            refreshStudents([student.id])
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def delete(self, request, id):
         student = self.get_object(id)
         student.delete()
+        refreshStudents([student.id])
         return Response(status=status.HTTP_204_NO_CONTENT)  
 
 class FeatureViews(APIView):
     def get(self, request):
-        feature = Feature.objects.all()
+        try:
+            fields = sparseFields(request.GET, FEATURE_OUTPUT)
+        except ValueError as e:
+            return Response({'fields': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        feature = Feature.objects.only(*documentFields(FEATURE_OUTPUT, fields)).as_pymongo()
 
         domain = request.GET.get('domain', None)
         if domain:
             feature = feature.filter(domain=domain) 
 
-        serializer = FeatureSerializer(feature, many=True)
-        return Response(serializer.data)
+        return Response(renderFeatures(feature, fields))
 
     def post(self, request):
         serializer = FeatureSerializer(data=request.data)
@@ -95,17 +182,23 @@ class FeatureViews(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class FeatureDetailView(APIView):
-    def get_object(self, id):
+    def get_object(self, id, fields = None):
         try:
-            return Feature.objects.get(id=id)
+            features = Feature.objects if fields is None else Feature.objects.only(*documentFields(FEATURE_OUTPUT, fields))
+            return features.get(id=id)
         except Feature.DoesNotExist:
             raise Http404
         except ValidationError as e:
             raise Http404
 
     def get(self, request, id):
-        feature = self.get_object(id)
-        serializer = FeatureSerializer(feature)
+        try:
+            fields = sparseFields(request.GET, FEATURE_OUTPUT)
+        except ValueError as e:
+            return Response({'fields': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        feature = self.get_object(id, fields)
+        serializer = FeatureSerializer(feature, fields=fields)
         return Response(serializer.data)
 
     def put(self, request, id):
@@ -121,88 +214,230 @@ class FeatureDetailView(APIView):
         feature.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
     
+def listParam(request, name, parse) -> list:
+    text = request.GET.get(name)
+    if not text:
+        return []
+    return [parse(item.strip()) for item in text.split(',')]
+
+class FeatureDistributionView(APIView):
+    """
+    Counts of students per threshold (`?thresholds=1,2.5&operator=gte`), histograms
+    (`?bins=10` or `?edges=0,5,10`) and quantiles (`?quantiles=0.5,0.9`) of one feature,
+    answered from its sorted value index.
+    """
+
+    def get(self, request, id):
+        try:
+            feature = Feature._get_collection().find_one({'_id': ObjectId(id)}, {'type': 1})
+        except InvalidId:
+            raise Http404
+        if feature is None:
+            raise Http404
+
+        operator = request.GET.get('operator')
+        if operator and operator not in TESTS:
+            return Response({'operator': f'Expected one of: {", ".join(TESTS)}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            thresholds = listParam(request, 'thresholds', lambda text: parseValue(feature.get('type'), text))
+        except ValueError as e:
+            return Response({'thresholds': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            edges = listParam(request, 'edges', float)
+            bins = int(request.GET.get('bins') or 0)
+            quantiles = listParam(request, 'quantiles', float)
+        except ValueError:
+            return Response({'detail': 'bins must be an integer, edges and quantiles numbers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        maxBins = getattr(settings, 'DISTRIBUTION_MAX_BINS', 200)
+        if edges != sorted(edges) or bins < 0 or bins > maxBins:
+            return Response({'detail': f'edges must be ascending and bins between 0 and {maxBins}'}, status=status.HTTP_400_BAD_REQUEST)
+        if any(not 0 <= fraction <= 1 for fraction in quantiles):
+            return Response({'quantiles': 'quantiles must be between 0 and 1'}, status=status.HTTP_400_BAD_REQUEST)
+
+        index = getValueIndex(feature['_id'])
+        distribution = {
+            'feature': id,
+            'students': index.students,
+            'numeric': len(index.values),
+            'min': float(index.values[0]) if len(index.values) else None,
+            'max': float(index.values[-1]) if len(index.values) else None,
+        }
+
+        if thresholds:
+            distribution['thresholds'] = index.counts(thresholds, [operator] if operator else None)
+        if edges or bins:
+            distribution['histogram'] = index.histogram(edges or index.bins(bins))
+        if quantiles:
+            distribution['quantiles'] = index.quantiles(quantiles)
+
+        return Response(distribution)
+
 class StudentFeatureView(APIView):
-    def get_student(self, id) -> Student:
+    def get_features(self, id) -> list:
         try:
-            return Student.objects.get(id=id)
-        except Student.DoesNotExist:
+            student = Student._get_collection().find_one({'_id': ObjectId(id)}, FEATURE_FIELDS)
+        except InvalidId:
             raise Http404
-        except ValidationError as e:
+        if student is None:
             raise Http404
-        
+        return studentFeatures(student)
+
     def get(self, request, id):   
-        pipeline = [
+        features = self.get_features(id)
+        known = {
+            feature['_id']: feature
+            for feature in Feature._get_collection().find(
+                {'_id': {'$in': [feature['feature'] for feature in features]}},
+                {'name': 1, 'domain': 1}
+            )
+        }
+
+        return Response([
             {
-                '$match': {
-                    '_id': ObjectId(id)
-                }
-            }, 
-            
-            {
-                '$unwind': '$features'
-            }, 
-            
-            {
-                '$lookup': {
-                    'from': 'feature', 
-                    'localField': 'features.feature', 
-                    'foreignField': '_id', 
-                    'as': 'feature_info'
-                }
-            }, 
-            
-            {
-                '$unwind': '$feature_info'
-            }, 
-            
-            {
-                '$project': {
-                    '_id': 0, 
-                    'id': { '$toString' : '$features.feature' }, 
-                    'name': '$feature_info.name', 
-                    'domain': '$feature_info.domain', 
-                    'value': '$features.value'
-                }
-            }
-        ]
-        
-        features = list(Student.objects().aggregate(pipeline))
-        
-        return Response(features)
-    
-    def post(self, request, id):
+                'id': str(feature['feature']),
+                'name': known[feature['feature']].get('name'),
+                'domain': known[feature['feature']].get('domain'),
+                'value': feature.get('value'),
+            } for feature in features if feature['feature'] in known
+        ])
+
+    def validate(self, request):
+        serializer = StudentFeatureSerializer(data=request.data, many=True)
+        if serializer.is_valid():
+            return [(feature['feature'], feature['value']) for feature in serializer.validated_data], None
+
+        errors = serializer.errors
+        if isinstance(errors, list):
+            errors = [error for error in errors if error]
+        elif 'non_field_errors' not in errors:
+            errors = list(errors.values())
+        return None, Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-        student = self.get_student(id)
-        invalids = []
-        features = []
+    def reinfer(self, id, oldFeatures):
+        if not dependencies.isEnabled():
+            return
 
-        for feature in request.data:
-            serializer = StudentFeatureSerializer(data=feature)
-            if serializer.is_valid():
-                features.append(StudentFeature(**feature))
+        newFeatures = studentFeatures(Student._get_collection().find_one({'_id': ObjectId(id)}, FEATURE_FIELDS))
+        dependencies.reinferStudent(ObjectId(id), dependencies.changedFeatures(oldFeatures, newFeatures))
 
-            else:
-                invalids.append(serializer.errors)
+    def post(self, request, id):
+        """Replaces every feature of the student."""
+        oldFeatures = self.get_features(id)
 
-        if len(invalids) > 0:
-            return Response(invalids, status=status.HTTP_400_BAD_REQUEST)
+        pairs, error = self.validate(request)
+        if error:
+            return error
 
-        student.features = features
-        student.save()
+        Student._get_collection().update_one({'_id': ObjectId(id)}, {**featuresUpdate(pairs), '$inc': {'version': 1}})
+        refreshStudents([ObjectId(id)])
+        self.reinfer(id, oldFeatures)
         
         return Response(request.data)
+
+    def patch(self, request, id):
+        """Sets the given features, keeping the others."""
+        oldFeatures = self.get_features(id)
+
+        pairs, error = self.validate(request)
+        if error:
+            return error
+        if not pairs:
+            return Response(request.data)
+
+        collection = Student._get_collection()
+        student = collection.find_one({'_id': ObjectId(id)}, {'featureMap': 1, 'features.0': 1})
+
+        if featureLayout() == MAP and student.get('featureMap'):
+            collection.update_one({'_id': ObjectId(id)}, {
+                '$set': {f'featureMap.{featureId}': value for featureId, value in pairs},
+                '$inc': {'version': 1},
+            })
+        elif featureLayout() == MAP or student.get('featureMap'):
+            # Not in the configured layout yet: rewrite it once with the merged values
+            merged = {feature['feature']: feature.get('value') for feature in oldFeatures}
+            merged.update(pairs)
+            collection.update_one({'_id': ObjectId(id)}, {**featuresUpdate(merged.items()), '$inc': {'version': 1}})
+        else:
+            # One round trip bumping the version once: every occurrence of a submitted
+            # feature is set, the new ones are appended
+            values = dict(pairs)
+            present = {feature['feature'] for feature in oldFeatures}
+            existing = [featureId for featureId in values if featureId in present]
+            added = [{'feature': featureId, 'value': value} for featureId, value in values.items() if featureId not in present]
+            updates = []
+            if existing:
+                updates.append((
+                    {'$set': {f'features.$[f{index}].value': values[featureId] for index, featureId in enumerate(existing)}},
+                    [{f'f{index}.feature': featureId} for index, featureId in enumerate(existing)]
+                ))
+            if added:
+                updates.append(({'$push': {'features': {'$each': added}}}, None))
+            updates[0][0]['$inc'] = {'version': 1}
+            operations = [UpdateOne({'_id': ObjectId(id)}, update, array_filters=filters) for update, filters in updates]
+            collection.bulk_write(operations)
+
+        refreshStudents([ObjectId(id)])
+        self.reinfer(id, oldFeatures)
+
+        return Response(request.data)
+    
+class StudentFeatureBulkView(APIView):
+    parser_classes = [JSONParser, NDJSONParser]
+
+    def post(self, request):
+        records = request.data
+        if not isinstance(records, list):
+            return Response({'detail': 'Expected a list of {student, features} records.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        result = ingestFeatures(records)
+        refreshStudents(result.touched)
+        output = result.asDict()
+
+        if request.GET.get('infer') in ('1', 'true') and result.touched:
+            output['inferred'] = dependencies.reinferStudents(result.touched)
+
+        if result.errors and not result.applied:
+            return Response(output, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(output)
     
 class StudentStateInferatorView(APIView):
     
     def get(self, request, idStudent = None): 
 
-        pipeline = innferStates(idStudent=idStudent)
-        studentsStates = list(Student.objects().aggregate(pipeline))
+        merge = request.GET.get('merge') in ('1', 'true')
+        try:
+            engine = getStateEngine(request.GET.get('engine') or ('aggregation' if merge else None))
+        except ValueError as e:
+            return Response({'engine': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if merge:
+            return mergeResponse(engine, 'states', idStudent)
+
+        if not idStudent and request.GET.get('parallel') in ('1', 'true'):
+            engine = PartitionedEngine(engine)
+
+        cache = getInferenceCache()
+        if idStudent:
+            cached = cache.get(studentInferenceKey('states', engine, idStudent))
+            if cached is not None:
+                return Response(cached, headers={'X-Inference-Cache': 'hit'})
+
+        with inferenceRun('states', engine.name, inferenceMode(engine, idStudent)) as run:
+            studentsStates = list(engine.infer(idStudent=idStudent))
+            run['students'] = len(studentsStates)
+
+        if idStudent and not studentsStates:
+            studentsStates = [unmatchedStudent(idStudent, 'states')]
         
-        for student in studentsStates:
-            _student = Student.objects.get(id=student['_id'])
-            _student.states = [ state["_id"] for state in student['states'] ]
-            _student.save()
+        report = writeBack(
+            ((student['_id'], [ state["_id"] for state in student['states'] ]) for student in studentsStates),
+            'states',
+            scope=None if idStudent else {}
+        )
 
         outputStates = [
             {
@@ -221,24 +456,87 @@ class StudentStateInferatorView(APIView):
         ]
 
         if idStudent:
-            return Response(outputStates[0])
+            # Keyed after the write-back, which bumps the version when the result changed
+            key = inferenceKey('states', engine.name, idStudent)
+            if key is not None:
+                cache.set(key, outputStates[0])
+            return Response(outputStates[0], headers={**report.asHeaders(), 'X-Inference-Cache': 'miss'})
 
-        return Response(outputStates)
+        return Response(outputStates, headers=report.asHeaders())
     
+class StatePreviewView(APIView):
+    """Match counts of unsaved state definitions, in the `StateSerializer` format. Nothing is written."""
+
+    def post(self, request):
+        many = isinstance(request.data, list)
+        serializer = StateSerializer(data=request.data, many=many)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        states = serializer.validated_data if many else [serializer.validated_data]
+
+        maxSample = getattr(settings, 'MAX_PAGE_SIZE', 1000)
+        try:
+            sample = int(request.GET.get('sample') or 0)
+        except ValueError:
+            return Response({'sample': 'sample must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if sample < 0 or sample > maxSample:
+            return Response({'sample': f'sample must be between 0 and {maxSample}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            preview = previewStates(states, sample, request.GET.get('engine') or 'compiled')
+        except ValueError as e:
+            return Response({'engine': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'students': preview['students'],
+            'states': [
+                {
+                    'name': state['name'],
+                    'domain': state['domain'],
+                    'matched': result['matched'],
+                    'sample': [str(studentId) for studentId in result['sample']],
+                } for state, result in zip(states, preview['states'])
+            ],
+        })
+
 class StudentBehaviorInferatorView(APIView):
     
     def get(self, request, idStudent = None): 
 
-        pipeline = innferBehaviors(idStudent=idStudent)
+        merge = request.GET.get('merge') in ('1', 'true')
         try:
-            studentsBehaviors = list(Student.objects().aggregate(pipeline))
-        except:
-            return Response(pipeline, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            engine = getBehaviorEngine(request.GET.get('engine') or ('aggregation' if merge else None))
+        except ValueError as e:
+            return Response({'engine': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if merge:
+            return mergeResponse(engine, 'behaviors', idStudent)
+
+        if not idStudent and request.GET.get('parallel') in ('1', 'true'):
+            engine = PartitionedEngine(engine)
+
+        cache = getInferenceCache()
+        if idStudent:
+            cached = cache.get(studentInferenceKey('behaviors', engine, idStudent))
+            if cached is not None:
+                return Response(cached, headers={'X-Inference-Cache': 'hit'})
+
+        try:
+            with inferenceRun('behaviors', engine.name, inferenceMode(engine, idStudent)) as run:
+                studentsBehaviors = list(engine.infer(idStudent=idStudent))
+                run['students'] = len(studentsBehaviors)
+        except OperationFailure:
+            return Response(engine.describe(idStudent=idStudent), status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        if idStudent and not studentsBehaviors:
+            studentsBehaviors = [unmatchedStudent(idStudent, 'behaviors')]
         
-        for student in studentsBehaviors:
-            _student = Student.objects.get(id=student['_id'])
-            _student.behaviors = [ behavior["_id"] for behavior in student['behaviors'] ]
-            _student.save()
+        report = writeBack(
+            ((student['_id'], [ behavior["_id"] for behavior in student['behaviors'] ]) for student in studentsBehaviors),
+            'behaviors',
+            scope=None if idStudent else {}
+        )
 
         outputBehaviors = [
             {
@@ -257,20 +555,119 @@ class StudentBehaviorInferatorView(APIView):
         ]
 
         if idStudent:
-            return Response(outputBehaviors[0])
+            # Keyed after the write-back, which bumps the version when the result changed
+            key = inferenceKey('behaviors', engine.name, idStudent)
+            if key is not None:
+                cache.set(key, outputBehaviors[0])
+            return Response(outputBehaviors[0], headers={**report.asHeaders(), 'X-Inference-Cache': 'miss'})
 
-        return Response(outputBehaviors)
+        return Response(outputBehaviors, headers=report.asHeaders())
     
 
+def mergeResponse(engine, field, idStudent = None):
+    """Result of an inference written back with $merge: counts, or the stored result of one student."""
+    if not hasattr(engine, 'merge'):
+        return Response({'merge': f'The {engine.name} engine cannot merge, use engine=aggregation.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    with inferenceRun(field, engine.name, 'merge'):
+        counts = mergeBack(engine, field, idStudent)
+
+    if not idStudent:
+        return Response(counts, headers={'X-Writeback-Modified': str(counts['modified'])})
+
+    student = Student._get_collection().find_one({'_id': ObjectId(idStudent)}, {'alias': 1, 'age': 1, 'gender': 1, field: 1})
+    if student is None:
+        raise Http404
+
+    catalog = getCatalog()
+    references = catalog.statesById if field == 'states' else catalog.behaviorsById
+    return Response({
+        "id" : str(student['_id']),
+        "age" : student.get("age"),
+        "alias" : student.get('alias'),
+        "gender" : student.get("gender"),
+        field : [
+            {
+                "id" : str(id),
+                "name" : references[id]["name"],
+                "domain" : references[id]["domain"],
+            } for id in student.get(field) or [] if id in references
+        ]
+    }, headers={'X-Writeback-Modified': str(counts['modified'])})
+
+class InferenceJobViews(APIView):
+
+    def get(self, request):
+        try:
+            limit = pageLimit(request.GET.get('limit'))
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        reapStaleJobs()
+        jobs = InferenceJob.objects.order_by('-createdAt').limit(limit)
+        serializer = InferenceJobSerializer(jobs, many=True)
+        return Response(serializer.data)
+
+    def post(self, request):
+        serializer = InferenceJobSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            job = startJob(serializer.validated_data['kind'], serializer.validated_data.get('engine'))
+        except ValueError as e:
+            return Response({'engine': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            InferenceJobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': f'{request.path}{job.id}/'}
+        )
+
+class InferenceJobDetailView(APIView):
+
+    def get(self, request, id):
+        reapStaleJobs()
+        try:
+            job = InferenceJob.objects.get(id=id)
+        except (InferenceJob.DoesNotExist, ValidationError):
+            raise Http404
+
+        serializer = InferenceJobSerializer(job)
+        return Response(serializer.data)
+
+def ruleEditResponse(request, kind, id, sourceIds, data, code = status.HTTP_200_OK):
+    """
+    Re-infers an edited state or behavior ('state' or 'behavior') before answering. Past
+    INFERENCE_INCREMENTAL_MAX_STUDENTS affected students a job does it instead, answered with 202.
+    """
+    if not dependencies.isEnabled():
+        return Response(data, status=code)
+
+    if dependencies.affectedCount(kind, id, sourceIds) > getattr(settings, 'INFERENCE_INCREMENTAL_MAX_STUDENTS', 10000):
+        job = startRuleJob(kind, id, sourceIds)
+        return Response(
+            data if data is not None else InferenceJobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': request.build_absolute_uri(f'/api/infer/jobs/{job.id}/')}
+        )
+
+    dependencies.reinferRule(kind, id, sourceIds)
+    return Response(data, status=code)
+
 class StateViews(APIView):
     def get(self, request):
-        states = State.objects.all()
+        try:
+            fields = sparseFields(request.GET, STATE_OUTPUT)
+        except ValueError as e:
+            return Response({'fields': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        states = State.objects.only(*documentFields(STATE_OUTPUT, fields)).as_pymongo()
         domain = request.GET.get('domain', None)
         if domain:
             states = states.filter(domain=domain)
             
-        serializer = StateSerializer(states, many=True)
-        return Response(serializer.data)
+        return Response(renderStates(states, fields))
 
     def post(self, request):
         serializer = StateSerializer(data=request.data)
@@ -278,46 +675,87 @@ class StateViews(APIView):
         if valid:
             state = serializer.save()
             serialized_state = serializer.to_representation(state)
-            
-            return Response(serialized_state, status=status.HTTP_201_CREATED)
+            return ruleEditResponse(request, 'state', state.id, dependencies.stateFeatureIds(state), serialized_state, status.HTTP_201_CREATED)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     
 class StateDetailView(APIView):
 
-    def get_object(self, id) -> State:
+    def get_object(self, id, fields = None) -> State:
         try:
-            return State.objects.get(id=id)
+            states = State.objects if fields is None else State.objects.only(*documentFields(STATE_OUTPUT, fields))
+            return states.get(id=id)
         except State.DoesNotExist:
             raise Http404
         except ValidationError as e:
             raise Http404
 
     def get(self, request, id):
-        state = self.get_object(id)
-        serializer = StateSerializer(state)
+        try:
+            fields = sparseFields(request.GET, STATE_OUTPUT)
+        except ValueError as e:
+            return Response({'fields': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        state = self.get_object(id, fields)
+        serializer = StateSerializer(state, fields=fields)
         return Response(serializer.data)
     
     def put(self, request, id):
         state = self.get_object(id)
+        oldFeatures = dependencies.stateFeatureIds(state)
         serializer = StateSerializer(state, data=request.data)
         if serializer.is_valid():
             serializer.save()
-            return Response(serializer.data)
+            return ruleEditResponse(request, 'state', state.id, oldFeatures | dependencies.stateFeatureIds(state), serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def delete(self, request, id):
         state = self.get_object(id)
         state.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)  
+        bumpCatalogVersion()
+        return ruleEditResponse(request, 'state', state.id, [], None, status.HTTP_204_NO_CONTENT)  
     
 
+class StateStudentsView(APIView):
+    """Students whose stored features satisfy the rules of a state, found with one query."""
+
+    def get(self, request, id):
+        try:
+            state = State._get_collection().find_one({'_id': ObjectId(id)}, {'features': 1})
+        except InvalidId:
+            raise Http404
+        if state is None:
+            raise Http404
+
+        query = stateQuery(state)
+
+        if request.GET.get('count') in ('1', 'true'):
+            return Response({'count': Student._get_collection().count_documents(query) if query else 0})
+
+        try:
+            fields = sparseFields(request.GET, STUDENT_OUTPUT)
+        except ValueError as e:
+            return Response({'fields': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            students = Student.objects(__raw__=query or {'_id': None}).only(*documentFields(STUDENT_OUTPUT, fields)).as_pymongo()
+            students = afterCursor(students, request.GET.get('after'))
+            limit = pageLimit(request.GET.get('limit'))
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(cursorPage(request, students, lambda page: renderStudents(page, fields=fields), limit))
+
 class BehaviorViews(APIView):
     def get(self, request):
-        behaviors = Behavior.objects.all()
-        serializer = BehaviorSerializer(behaviors, many=True)
-        return Response(serializer.data)
+        try:
+            fields = sparseFields(request.GET, BEHAVIOR_OUTPUT)
+        except ValueError as e:
+            return Response({'fields': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        behaviors = Behavior.objects.only(*documentFields(BEHAVIOR_OUTPUT, fields)).as_pymongo()
+        return Response(renderBehaviors(behaviors, fields))
 
     def post(self, request):
         serializer = BehaviorSerializer(data=request.data)
@@ -325,36 +763,43 @@ class BehaviorViews(APIView):
         if valid:
             behavior = serializer.save()
             serialized_behavior = serializer.to_representation(behavior)
-            
-            return Response(serialized_behavior, status=status.HTTP_201_CREATED)
+            return ruleEditResponse(request, 'behavior', behavior.id, dependencies.behaviorStateIds(behavior), serialized_behavior, status.HTTP_201_CREATED)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     
 class BehaviorDetailView(APIView):
 
-    def get_object(self, id) -> Behavior:
+    def get_object(self, id, fields = None) -> Behavior:
         try:
-            return Behavior.objects.get(id=id)
+            behaviors = Behavior.objects if fields is None else Behavior.objects.only(*documentFields(BEHAVIOR_OUTPUT, fields))
+            return behaviors.get(id=id)
         except Behavior.DoesNotExist:
             raise Http404
         except ValidationError as e:
             raise Http404
 
     def get(self, request, id):
-        behavior = self.get_object(id)
-        serializer = BehaviorSerializer(behavior)
+        try:
+            fields = sparseFields(request.GET, BEHAVIOR_OUTPUT)
+        except ValueError as e:
+            return Response({'fields': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        behavior = self.get_object(id, fields)
+        serializer = BehaviorSerializer(behavior, fields=fields)
         return Response(serializer.data)
     
     def put(self, request, id):
         behavior = self.get_object(id)
+        oldStates = dependencies.behaviorStateIds(behavior)
         serializer = BehaviorSerializer(behavior, data=request.data)
         if serializer.is_valid():
             serializer.save()
-            return Response(serializer.data)
+            return ruleEditResponse(request, 'behavior', behavior.id, oldStates | dependencies.behaviorStateIds(behavior), serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def delete(self, request, id):
         behavior = self.get_object(id)
         behavior.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)  
\ No newline at end of file
+        bumpCatalogVersion()
+        return ruleEditResponse(request, 'behavior', behavior.id, [], None, status.HTTP_204_NO_CONTENT)  
\ No newline at end of file